@@ -1,13 +1,26 @@
 import os
 import streamlit as st
-from openai import OpenAI
+from condition_config import get_sentence_budget
+from generation_params import get_generation_params
+from history_window import fit_history
+from llm_client import get_shared_client
+from participant_claim import NOT_REGISTERED, TAKEN, claim_participant, is_valid_participant_id
+from prefix_cache import record_cached_tokens
+from response_cache import get_canned_turn
+from speculation import speculate
+from stream_mux import assistant_message, cancelled_messages, chat_job, fallback_turns, stream_concurrently
 from dotenv import load_dotenv
 import json
 import glob
 import datetime  # For time measurement
 import time  # Add this import for time.sleep()
 import uuid
-from supabase import create_client, Client
+from supabase import Client
+from supabase_client import get_supabase
+from write_behind import get_write_behind, save_problem_message
+
+# prompts/debate/conditions.json의 조건 id
+CONDITION_ID = "app2"
 
 
 # Page configuration
@@ -94,7 +107,10 @@ if "token_usage" not in st.session_state:
 # Supabase 클라이언트 초기화
 supabase_url = st.secrets["SUPABASE_URL"]
 supabase_key = st.secrets["SUPABASE_KEY"]
-supabase: Client = create_client(supabase_url, supabase_key)
+# 프로세스 전체에서 공유하는 클라이언트 (rerun마다 새로 만들지 않고 keep-alive 연결 재사용)
+supabase: Client = get_supabase(supabase_url, supabase_key)
+# 세션 데이터는 저널에 남긴 뒤 백그라운드에서 Supabase에 씀 (제출 버튼이 DB 응답을 기다리지 않음)
+write_behind = get_write_behind(supabase_url, supabase_key)
 
 # Usage time tracking function
 def update_session_time():
@@ -118,7 +134,7 @@ def update_session_time():
     st.session_state.interaction_count += 1
 
 def get_openai_client():
-    """Create and return an OpenAI client configured with environment variables"""
+    """Return the shared OpenAI client configured with environment variables"""
     token = st.secrets["OPENAI_API_KEY"]
     endpoint = st.secrets["OPENAI_API_BASE"]
     
@@ -126,10 +142,37 @@ def get_openai_client():
         st.error("GitHub token not found in environment variables. Please check your .env file.")
         st.stop()
         
-    return OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
+    # 프로세스 전체에서 공유하는 클라이언트 (keep-alive 연결 재사용)
+    return get_shared_client(endpoint, token)
+
+def discard_speculation():
+    """Stop the pre-generated answers still running (the turn moved on or the conversation ended)"""
+    speculation = st.session_state.pop("speculation", None)
+    if speculation is not None:
+        speculation.discard()
+
+def speculate_next_turn():
+    """Pre-generate answers for the likely next prompts while the participant reads (once per turn)"""
+    speculation = st.session_state.get("speculation")
+    if speculation is not None and speculation.turn == st.session_state.current_turn:
+        return
+    # 지난 턴의 예측 중 아직 돌고 있는 것은 멈춤 (맞힌 항목 외에는 끝까지 생성하지 않도록)
+    discard_speculation()
+    client = get_openai_client()
+    model_name = st.secrets["OPENAI_API_MODEL"]
+
+    def build_requests(prompt):
+        # 다음 턴의 요청과 똑같이 구성 (질문이 기록에 추가된 뒤 generate_debate_responses가 호출됨)
+        history = [msg for msg in st.session_state.messages if msg["role"] != "system" and "type" not in msg]
+        history.append({"role": "user", "content": prompt})
+        return {
+            "pro": {"messages": fit_history(st.session_state.system_message_pro, history, prompt)[0], "model": model_name,
+                    **get_generation_params(CONDITION_ID, "pro")},
+            "con": {"messages": fit_history(st.session_state.system_message_con, history, prompt)[0], "model": model_name,
+                    **get_generation_params(CONDITION_ID, "con")},
+        }
+
+    st.session_state.speculation = speculate(CONDITION_ID, st.session_state.current_turn, client, build_requests)
 
 def generate_debate_responses(prompt):
     """Generate two separate responses - one pro, one con"""
@@ -146,88 +189,60 @@ def generate_debate_responses(prompt):
             history.append(msg)
     
     # Generate pro messages
-    pro_messages = [{"role": "system", "content": st.session_state.system_message_pro}] + history + [{"role": "user", "content": prompt}]
+    # 토큰 예산을 넘는 오래된 턴은 빼거나 요약 (시스템 프롬프트와 최근 턴은 그대로 유지)
+    pro_messages, pro_window = fit_history(st.session_state.system_message_pro, history, prompt)
     
     # Generate con messages
-    con_messages = [{"role": "system", "content": st.session_state.system_message_con}] + history + [{"role": "user", "content": prompt}]
+    con_messages, con_window = fit_history(st.session_state.system_message_con, history, prompt)
     
     try:
         # Display response in chat format
         status_placeholder = st.empty()
         status_placeholder.markdown("Generating response...", unsafe_allow_html=True)
         
-        # Generate pro response
-        full_pro_response = ""
-        usage_pro = None
-        
-        pro_response = client.chat.completions.create(
-            messages=pro_messages,
-            model=model_name,
-            stream=True,
-            stream_options={'include_usage': True}
-        )
-        
-        # Add pro response
+        # 찬성/반대 요청을 동시에 보내고 두 스트림을 이 스레드에서 렌더링
+        # 턴 지연 시간이 (찬성 + 반대)가 아니라 max(찬성, 반대)가 됨
         pro_placeholder = st.empty()
-        
-        # Stream pro response
-        for chunk in pro_response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_pro_response += content_chunk
-                pro_placeholder.markdown(
-                    f"<div class='pro-name'>Purpli</div><div class='pro-bubble'>{full_pro_response}▌</div>",
-                    unsafe_allow_html=True
-                )
-                
-            if chunk.usage:
-                usage_pro = chunk.usage
-        
-        # Update final pro response (remove cursor)
-        pro_placeholder.markdown(
-            f"<div class='pro-name'>Purpli</div><div class='pro-bubble'>{full_pro_response}</div>",
-            unsafe_allow_html=True
-        )
-        
-        # Generate con response
-        full_con_response = ""
-        usage_con = None
-        
-        con_response = client.chat.completions.create(
-            messages=con_messages,
-            model=model_name,
-            stream=True,
-            stream_options={'include_usage': True}
-        )
-        
-        # Add con response
         con_placeholder = st.empty()
         
-        # Stream con response
-        for chunk in con_response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_con_response += content_chunk
-                con_placeholder.markdown(
-                    f"<div class='con-name'>Yellowy</div><div class='con-bubble'>{full_con_response}▌</div>",
-                    unsafe_allow_html=True
-                )
-                
-            if chunk.usage:
-                usage_con = chunk.usage
-        
-        # Update final con response (remove cursor)
-        con_placeholder.markdown(
-            f"<div class='con-name'>Yellowy</div><div class='con-bubble'>{full_con_response}</div>",
-            unsafe_allow_html=True
-        )
+        results = stream_concurrently([
+            chat_job(
+                "pro", pro_placeholder,
+                "<div class='pro-name'>Purpli</div><div class='pro-bubble'>{}</div>",
+                client, messages=pro_messages, model=model_name,
+                sentence_budget=get_sentence_budget(CONDITION_ID, "pro"),
+                similarity_scope=(CONDITION_ID, st.session_state.current_turn),
+                speculation=st.session_state.get("speculation"),
+                fallback_condition=CONDITION_ID,
+                generation_condition=CONDITION_ID
+            ),
+            chat_job(
+                "con", con_placeholder,
+                "<div class='con-name'>Yellowy</div><div class='con-bubble'>{}</div>",
+                client, messages=con_messages, model=model_name,
+                sentence_budget=get_sentence_budget(CONDITION_ID, "con"),
+                similarity_scope=(CONDITION_ID, st.session_state.current_turn),
+                speculation=st.session_state.get("speculation"),
+                fallback_condition=CONDITION_ID,
+                generation_condition=CONDITION_ID
+            ),
+        ], on_cancel=lambda partial: st.session_state.messages.extend(cancelled_messages(partial)),
+           on_queue=lambda position: status_placeholder.markdown(
+               f"Many participants are chatting right now. Waiting in line (position {position})..." if position else "Generating response...",
+               unsafe_allow_html=True
+           ))
+        
+        full_pro_response = results["pro"]["content"]
+        usage_pro = results["pro"]["usage"]
+        full_con_response = results["con"]["content"]
+        usage_con = results["con"]["usage"]
         
         # Remove status display
         status_placeholder.empty()
         
         # Add responses to session state
-        st.session_state.messages.append({"role": "assistant", "content": full_pro_response, "type": "pro"})
-        st.session_state.messages.append({"role": "assistant", "content": full_con_response, "type": "con"})
+        st.session_state.messages.append(assistant_message("pro", results["pro"]))
+        st.session_state.messages.append(assistant_message("con", results["con"]))
         
         # Save usage statistics
         if usage_pro and usage_con:
@@ -238,7 +253,11 @@ def generate_debate_responses(prompt):
             st.session_state.usage_stats.append({
                 "prompt_tokens": usage_pro_dict.get("prompt_tokens", 0) + usage_con_dict.get("prompt_tokens", 0),
                 "completion_tokens": usage_pro_dict.get("completion_tokens", 0) + usage_con_dict.get("completion_tokens", 0),
-                "total_tokens": usage_pro_dict.get("total_tokens", 0) + usage_con_dict.get("total_tokens", 0)
+                "total_tokens": usage_pro_dict.get("total_tokens", 0) + usage_con_dict.get("total_tokens", 0),
+                "history_tokens_saved": pro_window["tokens_saved"] + con_window["tokens_saved"],
+                "endpoints": {"pro": results["pro"]["endpoint"], "con": results["con"]["endpoint"]},
+                # 프롬프트 접두사 캐시에서 처리된 토큰 수 (프로바이더가 알려준 경우)
+                "cached_tokens": record_cached_tokens(CONDITION_ID, usage_pro, usage_con)
             })
         
         # If process display is activated
@@ -478,10 +497,14 @@ def save_to_supabase(score=None):
             total_prompt = sum(u["prompt_tokens"] for u in st.session_state.usage_stats)
             total_completion = sum(u["completion_tokens"] for u in st.session_state.usage_stats)
             total_tokens = sum(u["total_tokens"] for u in st.session_state.usage_stats)
+            # 캐시 토큰을 알려준 턴만 합산 (하나도 없으면 0이 아니라 NULL로 저장해서 적중률 계산에서 빠지도록)
+            reported_cached = [u["cached_tokens"] for u in st.session_state.usage_stats if u.get("cached_tokens") is not None]
+            total_cached = sum(reported_cached) if reported_cached else None
         else:
             total_prompt = 0
             total_completion = 0
             total_tokens = 0
+            total_cached = None
         
         # 저장할 데이터 준비 (테이블 구조에 맞게 조정)
         data = {
@@ -494,20 +517,26 @@ def save_to_supabase(score=None):
             "total_tokens": total_tokens,
             "prompt_tokens": total_prompt,
             "completion_tokens": total_completion,
+            "cached_tokens": total_cached,
+            "condition": CONDITION_ID,  # 조건별 캐시 적중률 리포트용
             "score": score,
             "messages": st.session_state.messages
         }
+        # 대체 답변이 나간 턴 (분석에서 걸러낼 수 있도록, CIRCUIT_ENABLED=1일 때만 생김)
+        turns = fallback_turns(st.session_state.messages)
+        if turns:
+            data["fallback_turns"] = turns
         
         # Supabase에 데이터 저장 (LLM2 테이블에 저장)
-        result = supabase.table("LLM2").insert(data).execute()
-        
-        # 저장 성공 여부 확인
-        if result.data:
-            return True
-        return False
+        # (로컬 스풀에 기록되면 바로 반환, 삽입은 백그라운드에서 재시도와 함께 처리)
+        write_behind.enqueue("LLM2", data)
+        # 로컬 스풀에는 저장됨. DB 기록이 계속 실패하고 있으면 대기 중인 행 수와 마지막 오류를 완료 페이지에 표시
+        st.session_state.save_problem = save_problem_message(write_behind.delivery_status())
+        return True
     
     except Exception as e:
         st.error(f"데이터 저장 중 오류 발생: {str(e)}")
+        st.session_state.save_problem = f"데이터 저장 중 오류 발생: {str(e)}"
         return False
 
 # 참가자 ID 검증 함수 추가
@@ -524,28 +553,15 @@ def validate_participant_id(participant_id):
             return True, "Admin access confirmed"
         
         # Format check: a, b, c, d followed by 3 digits (001~100)
-        import re
-        if not re.match(r'^[a-d][0-9]{3}$', participant_id):
-            return False, "Invalid participant ID format. Must be a, b, c, or d + 3 digits (e.g., a001)"
-        
-        # Check if number part is in 001-100 range
-        num_part = int(participant_id[1:])
-        if num_part < 1 or num_part > 100:
-            return False, "Invalid participant ID. Number must be in 1-100 range."
+        if not is_valid_participant_id(participant_id):
+            return False, "Invalid participant ID format. Must be a, b, c, or d + 3 digits from 001 to 100 (e.g., a001)"
         
-        # Look up ID in Supabase
-        result = supabase.table("participants").select("*").eq("id", participant_id).execute()
-        
-        # If ID doesn't exist in participants table
-        if not result.data:
+        # Claim the ID in one round trip (two logins with the same ID cannot both pass)
+        status = claim_participant(supabase, participant_id)
+        if status == NOT_REGISTERED:
             return False, "Participant ID not registered."
-        
-        # Check if ID is already used
-        if result.data[0].get("used", False):
+        if status == TAKEN:
             return False, "This participant ID has already been used."
-        
-        # If valid ID, update used status
-        supabase.table("participants").update({"used": True, "used_at": datetime.datetime.now().isoformat()}).eq("id", participant_id).execute()
         return True, "Participant verified successfully."
     
     except Exception as e:
@@ -578,22 +594,19 @@ def show_participant_id_page():
                 time.sleep(1)
                 st.rerun()
             else:
-                # 중복 체크
-                result = supabase.table("participants").select("id").eq("id", participant_id).execute()
-                if result.data:
-                    st.error("Your participant ID has been already taken.")
+                # 중복 체크와 등록을 한 번의 왕복으로 (같은 ID를 동시에 입력해도 한 명만 통과)
+                try:
+                    status = claim_participant(supabase, participant_id, register=True)
+                except Exception as e:
+                    st.warning(f"Could not save participant ID to DB: {e}")
                 else:
-                    try:
-                        supabase.table("participants").insert({
-                            "id": participant_id,
-                            "created_at": datetime.datetime.now().isoformat()
-                        }).execute()
+                    if status == TAKEN:
+                        st.error("Your participant ID has been already taken.")
+                    else:
                         st.session_state.app_state = "chat"
                         st.success("Participant ID saved. You can start chatting!")
                         time.sleep(1)
                         st.rerun()
-                    except Exception as e:
-                        st.warning(f"Could not save participant ID to DB: {e}")
 
 # 대화 페이지
 def show_chat_page():
@@ -633,16 +646,20 @@ def show_chat_page():
                             st.session_state.interaction_start = datetime.datetime.now()
                             
                             st.session_state.conversation_started = True
-                            st.session_state.current_turn = 1
                             user_prompt = "Purpli, Yellowy, can you tell me about cloning of a deceased pet?"  # 이 부분도 변경
                             st.session_state.messages.append({"role": "user", "content": user_prompt})
                             
-                            # 고정된 첫 응답
-                            purpli_response = "Cloning a deceased pet involves using biotechnology to create a new animal that is genetically identical to the original. For many people, pets are like family, so the idea of meeting them again in any form can be deeply comforting. With today's advanced technology, cloning has become a realistic option. Some also believe it's worth preserving the genes of special animals—like service dogs or police dogs—through cloning."
-                            yellowy_response = "However, cloning from a deceased pet involves complex steps—DNA must be extracted from preserved tissue, then an embryo is formed and implanted into a surrogate. Even if the cloned pet looks the same and shares the same genes, it won't have the same memories or personality, and the sense of loss may still remain. There are many abandoned animals waiting to be adopted, and providing care for them may be a more meaningful choice than cloning."
-                            
-                            st.session_state.messages.append({"role": "assistant", "content": purpli_response, "type": "pro"})
-                            st.session_state.messages.append({"role": "assistant", "content": yellowy_response, "type": "con"})
+                            # 고정된 첫 응답 (prompts/debate/conditions.json의 canned_turns)
+                            canned = get_canned_turn(CONDITION_ID, user_prompt)
+                            if canned:
+                                st.session_state.current_turn = 1
+                                purpli_response = canned["pro"]
+                                yellowy_response = canned["con"]
+                                st.session_state.messages.append({"role": "assistant", "content": purpli_response, "type": "pro"})
+                                st.session_state.messages.append({"role": "assistant", "content": yellowy_response, "type": "con"})
+                            else:
+                                # 설정된 첫 응답이 없으면 API로 생성
+                                generate_debate_responses(user_prompt)
                             
                             st.rerun()
                 i += 1
@@ -681,6 +698,7 @@ def show_chat_page():
             
             # Next 버튼
             if st.button("Next", key="next_to_survey", type="primary"):
+                discard_speculation()
                 st.session_state.app_state = "survey"
                 st.rerun()
         
@@ -688,6 +706,9 @@ def show_chat_page():
 
     # Chat input (Only show if conversation not finished)
     if st.session_state.conversation_started and st.session_state.current_turn < st.session_state.max_turns:
+        # 참가자가 답변을 읽는 동안 다음 질문 후보의 답을 미리 생성 (조건에서 speculation을 켠 경우만)
+        speculate_next_turn()
+        
         if prompt := st.chat_input("Enter a topic you want to discuss..."):
             # Display user message without chatbot icon
             st.markdown(
@@ -732,9 +753,6 @@ def show_survey_page():
             else:
                 st.warning("피드백이 저장되었지만, 데이터베이스 저장에 문제가 있었습니다.")
     
-            # 일정 시간 후 완료 페이지로 이동
-            time.sleep(2)
-    
             # 완료 페이지로 이동
             st.session_state.app_state = "complete"
             st.rerun()
@@ -748,10 +766,14 @@ def show_complete_page():
     
     with col2:
         st.markdown("<h1 style='text-align: center; margin-top: 100px;'>Thank you for your participation!</h1>", unsafe_allow_html=True)
+        # 제출 직후의 저장 경고는 rerun으로 사라지므로 여기서 다시 보여줌
+        if st.session_state.get("save_problem"):
+            st.warning(st.session_state.save_problem)
         
         # 다시 시작 버튼 (옵션)
         st.markdown("<div style='text-align: center; margin-top: 50px;'>", unsafe_allow_html=True)
         if st.button("Start a new conversation", type="primary", key="restart_btn"):
+            discard_speculation()
             # 대화 페이지로 돌아가기 및 초기화
             st.session_state.app_state = "chat"
             st.session_state.messages = [{"role": "assistant", "content": "You will engage in a four-turn conversation with a chatbot about \"Cloning of a deceased pet\". Click the button with the question to begin the first turn. After that, you will have three more turns to continue the conversation by typing freely. Start the conversation — Purpli and Yellowy will respond together.", "type": "system"}]
@@ -1,6 +1,13 @@
 import os
 import streamlit as st
-from openai import OpenAI
+from hedged_request import get_hedge_stats
+from history_window import fit_history
+from llm_client import get_shared_client
+from llm_sidecar import open_llm_stream
+from prefix_cache import record_cached_tokens
+from rate_limiter import acquire_permit, usage_tokens
+from stream_mux import SCRIPT_INTERRUPTS, read_stream, record_cancelled
+from stream_render import StreamRenderer
 from dotenv import load_dotenv
 import json
 import glob
@@ -56,7 +63,7 @@ def load_experiments():
     return experiments
 
 def get_openai_client():
-    """Create and return an OpenAI client configured with environment variables"""
+    """Return the shared OpenAI client configured with environment variables"""
     token = os.getenv("GITHUB_TOKEN")
     endpoint = os.getenv("GITHUB_ENDPOINT", "https://models.github.ai/inference")
     
@@ -64,53 +71,52 @@ def get_openai_client():
         st.error("GitHub token not found in environment variables. Please check your .env file.")
         st.stop()
         
-    return OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
+    # 프로세스 전체에서 공유하는 클라이언트 (keep-alive 연결 재사용)
+    return get_shared_client(endpoint, token)
 
 def generate_response(prompt, system_message):
     """Generate a response from the model and track usage"""
     client = get_openai_client()
     model_name = os.getenv("GITHUB_MODEL", "openai/gpt-4o")
     
-    # Prepare messages by including system message first
-    messages = [{"role": "system", "content": system_message}]
-    
     # Add all previous messages from history (excluding the newest user message that we'll add below)
-    for msg in st.session_state.messages[:-1]:  # 마지막 사용자 메시지 제외
-        if msg["role"] != "system":  # Skip system messages as we've already added it
-            messages.append(msg)
+    # 마지막 사용자 메시지와 중단된(cancelled) 부분 응답은 제외
+    history = [msg for msg in st.session_state.messages[:-1] if msg["role"] != "system" and not msg.get("cancelled")]
     
-    # Add the new user message (which is already in session_state.messages)
-    messages.append({"role": "user", "content": prompt})
+    # 대화가 길어지면 오래된 턴은 빼거나 요약해서 토큰 예산 안에서 보냄
+    messages, window = fit_history(system_message, history, prompt)
     
     try:
         # Container for the assistant's response in the chat interface
         response_container = st.chat_message("assistant")
-        full_response = ""
         usage = None
         
-        response = client.chat.completions.create(
-            messages=messages,
-            model=model_name,
-            stream=True,
-            stream_options={'include_usage': True}
-        )
+        # Stream the response (델타를 모아서 일정 간격으로만 다시 그림)
+        renderer = StreamRenderer(response_container.empty(), unsafe_allow_html=False)
         
-        # Stream the response
-        message_placeholder = response_container.empty()
-        for chunk in response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_response += content_chunk
-                message_placeholder.markdown(full_response + "▌")
-                    
-            if chunk.usage:
-                usage = chunk.usage
+        # 요청 한도를 넘으면 순서대로 기다림 (대기 순번을 응답 자리에 표시)
+        permit = acquire_permit(messages, on_wait=lambda position: renderer.placeholder.markdown(
+            f"Waiting in line (position {position})..." if position else ""
+        ))
+        try:
+            # 엔드포인트는 라우터가 고르고, 첫 토큰이 늦으면 헤지 요청 / 연결 오류는 재시도 예산 안에서 재시도
+            request = {"messages": messages, "model": model_name, "stream": True, "stream_options": {'include_usage': True}}
+            response = open_llm_stream(client, request, "assistant")
+            
+            try:
+                usage = read_stream(response, renderer.update, "assistant", messages)
+            except SCRIPT_INTERRUPTS:
+                # rerun/세션 종료로 중단되면 (연결은 read_stream이 끊음) 부분 응답을 cancelled 표시와 함께 기록
+                record_cancelled([renderer.text])
+                if renderer.text:
+                    st.session_state.messages.append({"role": "assistant", "content": renderer.text, "cancelled": True})
+                raise
+        finally:
+            # 미리 차감한 추정 토큰을 실제 usage로 정산
+            permit.release(usage_tokens(usage))
         
         # Update the final response without the cursor
-        message_placeholder.markdown(full_response)
+        full_response = renderer.finish()
         
         # Add the message to history
         st.session_state.messages.append({"role": "assistant", "content": full_response})
@@ -122,7 +128,11 @@ def generate_response(prompt, system_message):
             st.session_state.usage_stats.append({
                 "prompt_tokens": usage_dict.get("prompt_tokens", 0),
                 "completion_tokens": usage_dict.get("completion_tokens", 0),
-                "total_tokens": usage_dict.get("total_tokens", 0)
+                "total_tokens": usage_dict.get("total_tokens", 0),
+                "history_tokens_saved": window["tokens_saved"],
+                "endpoint": response.endpoint,
+                # 프롬프트 접두사 캐시에서 처리된 토큰 수 (프로바이더가 알려준 경우)
+                "cached_tokens": record_cached_tokens("app_class", usage)
             })
         
         # If show process is enabled, display the process details AFTER the response
@@ -152,6 +162,22 @@ def generate_response(prompt, system_message):
                         st.markdown(f"- Prompt tokens: {usage_dict.get('prompt_tokens', 0)}")
                         st.markdown(f"- Completion tokens: {usage_dict.get('completion_tokens', 0)}")
                         st.markdown(f"- Total tokens: {usage_dict.get('total_tokens', 0)}")
+                
+                # Container for render coalescing stats
+                render_expander = st.expander("Render Statistics", expanded=False)
+                with render_expander:
+                    st.markdown(f"- Deltas received: {renderer.stats['deltas']}")
+                    st.markdown(f"- Renders sent: {renderer.stats['renders']}")
+                    st.markdown(f"- Bytes sent: {renderer.stats['bytes_sent']}")
+                    st.markdown(f"- Bytes saved: {renderer.bytes_saved}")
+                
+                # 이번 요청의 시도별 시간 (헤지/재시도 포함)
+                attempt_expander = st.expander("Request Attempts", expanded=False)
+                with attempt_expander:
+                    for attempt in response.attempts:
+                        ttft = f"{attempt['ttft'] * 1000:.0f} ms" if attempt["ttft"] is not None else "-"
+                        st.markdown(f"- {attempt['kind']}: started +{attempt['offset'] * 1000:.0f} ms, first token {ttft}, {attempt['outcome']}")
+                    st.json(get_hedge_stats())
         
         return True
     except Exception as e:
@@ -276,6 +302,8 @@ with st.sidebar:
                 st.write(f"- Prompt tokens: {usage['prompt_tokens']}")
                 st.write(f"- Completion tokens: {usage['completion_tokens']}")
                 st.write(f"- Total tokens: {usage['total_tokens']}")
+                if usage.get("history_tokens_saved"):
+                    st.write(f"- Prompt tokens saved by the history window: {usage['history_tokens_saved']}")
                 st.divider()
             
             # Calculate total usage
@@ -287,6 +315,7 @@ with st.sidebar:
             st.write(f"- Total prompt tokens: {total_prompt}")
             st.write(f"- Total completion tokens: {total_completion}")
             st.write(f"- Total tokens: {total}")
+            st.write(f"- Prompt tokens saved by the history window: {sum(u.get('history_tokens_saved', 0) for u in st.session_state.usage_stats)}")
         else:
             st.write("No usage data available yet.")
     
@@ -1,10 +1,26 @@
 import streamlit as st
 import os
 import time
-from openai import OpenAI
+from condition_config import get_sentence_budget
+from generation_params import get_generation_params, record_latency
+from history_window import fit_history
+from llm_client import get_shared_client
+from llm_sidecar import open_llm_stream
+from participant_claim import NOT_REGISTERED, TAKEN, claim_participant, is_valid_participant_id
+from prefix_cache import record_cached_tokens
+from response_cache import get_canned_turn
+from rate_limiter import acquire_permit, usage_tokens
+from stream_mux import SCRIPT_INTERRUPTS, cancelled_messages, read_stream, record_cancelled
+from stream_render import StreamRenderer
+from token_accounting import account_usage
 import datetime
 import uuid
-from supabase import create_client, Client  # 추가
+from supabase import Client  # 추가
+from supabase_client import get_supabase
+from write_behind import get_write_behind, save_problem_message
+
+# prompts/debate/conditions.json의 조건 id
+CONDITION_ID = "app_r"
 
 # 사용자 ID 생성 (세션 시작시 한번만)
 if "user_id" not in st.session_state:
@@ -13,7 +29,10 @@ if "user_id" not in st.session_state:
 # Supabase 클라이언트 초기화
 supabase_url = st.secrets["SUPABASE_URL"]
 supabase_key = st.secrets["SUPABASE_KEY"]
-supabase: Client = create_client(supabase_url, supabase_key)
+# 프로세스 전체에서 공유하는 클라이언트 (rerun마다 새로 만들지 않고 keep-alive 연결 재사용)
+supabase: Client = get_supabase(supabase_url, supabase_key)
+# 세션 데이터는 저널에 남긴 뒤 백그라운드에서 Supabase에 씀 (제출 버튼이 DB 응답을 기다리지 않음)
+write_behind = get_write_behind(supabase_url, supabase_key)
 
 # Page configuration
 st.set_page_config(
@@ -54,7 +73,7 @@ if "interaction_start" not in st.session_state:
     st.session_state.interaction_start = None
 
 if "token_usage" not in st.session_state:
-    st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "history_tokens_saved": 0, "cached_tokens": None}
 
 # 파일 상단에 앱 상태 관리를 위한 변수 추가 (23-27줄 근처)
 
@@ -202,7 +221,7 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 def get_openai_client():
-    """Create and return an OpenAI client configured with environment variables"""
+    """Return the shared OpenAI client configured with environment variables"""
     token = st.secrets["OPENAI_API_KEY"]
     endpoint = st.secrets["OPENAI_API_BASE"]
     
@@ -210,10 +229,8 @@ def get_openai_client():
         st.error("GitHub token not found in environment variables. Please check your .env file.")
         st.stop()
         
-    return OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
+    # 프로세스 전체에서 공유하는 클라이언트 (keep-alive 연결 재사용)
+    return get_shared_client(endpoint, token)
 
 def generate_response(prompt):
     """Generate a response from the chatbot"""
@@ -224,64 +241,85 @@ def generate_response(prompt):
     model_name = st.secrets["OPENAI_API_MODEL"]
     
     # Create message history for the API call
-    messages = [{"role": "system", "content": st.session_state.system_message}]
-    
-    # Add conversation history
-    for msg in st.session_state.messages:
-        messages.append({"role": msg["role"], "content": msg["content"]})
+    # (중단되어 cancelled 표시된 부분 응답은 모델에 다시 보내지 않음)
+    history = [{"role": msg["role"], "content": msg["content"]} for msg in st.session_state.messages if not msg.get("cancelled")]
     
-    # Add the current prompt
-    messages.append({"role": "user", "content": prompt})
+    # 토큰 예산을 넘는 오래된 턴은 빼거나 요약 (시스템 프롬프트와 최근 턴은 그대로 유지)
+    messages, window = fit_history(st.session_state.system_message, history, prompt)
     
     try:
-        # If this is the first turn, we want to use the predefined response
-        if st.session_state.current_turn == 0:
-            predefined_response = """Cloning from a deceased pet involves complex steps—DNA must be extracted from preserved tissue, then an embryo is formed and implanted into a surrogate. Even if the cloned pet looks the same and shares the same genes, it won't have the same memories or personality, and the sense of loss may still remain. There are many abandoned animals waiting to be adopted, and providing care for them may be a more meaningful choice than cloning.
-
-However, cloning a deceased pet involves using biotechnology to create a new animal that is genetically identical to the original. For many people, pets are like family, so the idea of meeting them again in any form can be deeply comforting. With today's advanced technology, cloning has become a realistic option. Some also believe it's worth preserving the genes of special animals—like service dogs or police dogs—through cloning."""
+        # If this is the first turn, we want to use the predefined response (prompts/debate/conditions.json)
+        canned = get_canned_turn(CONDITION_ID, prompt) if st.session_state.current_turn == 0 else None
+        if canned:
+            predefined_response = canned["greeni"]
             
-            # Update token usage (approximate since we're not actually calling the API)
-            st.session_state.token_usage["prompt_tokens"] += len(prompt.split())
-            st.session_state.token_usage["completion_tokens"] += len(predefined_response.split())
-            st.session_state.token_usage["total_tokens"] += len(prompt.split()) + len(predefined_response.split())
+            # Update token usage (estimated with the local tokenizer since we're not actually calling the API)
+            usage = account_usage(CONDITION_ID, None, messages, predefined_response)
+            st.session_state.token_usage["prompt_tokens"] += usage.prompt_tokens
+            st.session_state.token_usage["completion_tokens"] += usage.completion_tokens
+            st.session_state.token_usage["total_tokens"] += usage.total_tokens
             
             # Increment turn counter
             st.session_state.current_turn += 1
             
             return predefined_response
         
-        # For subsequent turns, use the API
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=0.7,
-            stream=True
+        # Initialize placeholder for streaming response
+        # (델타를 모아서 일정 간격으로만 다시 그림)
+        renderer = StreamRenderer(
+            st.empty(),
+            "<div class='bot-name'>Greeni</div><div class='bot-bubble'>{}</div>"
         )
         
-        # Initialize placeholder for streaming response
-        placeholder = st.empty()
-        full_response = ""
+        # 조건별 생성 파라미터 (max_tokens는 측정한 지연 시간에 따라 조정될 수 있음)
+        generation = get_generation_params(CONDITION_ID, "greeni")
         
-        # Stream the response
-        for chunk in response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_response += content_chunk
-                placeholder.markdown(
-                    f"<div class='bot-name'>Greeni</div><div class='bot-bubble'>{full_response}▌</div>",
-                    unsafe_allow_html=True
-                )
+        # 요청 한도를 넘으면 순서대로 기다림 (대기 순번을 말풍선 자리에 표시)
+        permit = acquire_permit(messages, on_wait=lambda position: renderer.placeholder.markdown(
+            f"Many participants are chatting right now. Waiting in line (position {position})..." if position else ""
+        ), max_tokens=generation.get("max_tokens"))
+        usage = None
+        try:
+            # For subsequent turns, use the API
+            # 엔드포인트는 라우터가 고르고, 첫 토큰이 늦으면 헤지 요청 / 연결 오류는 재시도 예산 안에서 재시도
+            request = {"model": model_name, "messages": messages, **generation, "stream": True,
+                       "stream_options": {"include_usage": True}}
+            started = time.monotonic()
+            response = open_llm_stream(client, request, "greeni")
+            
+            # Stream the response (설정된 문장 수에 도달하면 스트림을 바로 닫음)
+            try:
+                usage = read_stream(response, renderer.update, "greeni", messages, get_sentence_budget(CONDITION_ID, "greeni"))
+            except SCRIPT_INTERRUPTS:
+                # rerun/세션 종료로 중단되면 (연결은 read_stream이 끊음) 부분 응답을 cancelled 표시와 함께 기록
+                record_cancelled([renderer.text])
+                st.session_state.messages.extend(cancelled_messages({"greeni": renderer.text}))
+                raise
+        finally:
+            # 미리 차감한 추정 토큰을 실제 usage로 정산
+            permit.release(usage_tokens(usage))
+        
+        # 요청부터 마지막 토큰까지 걸린 시간으로 max_tokens를 조정
+        record_latency(CONDITION_ID, "greeni", time.monotonic() - started)
         
         # Update the placeholder with the final response (no cursor)
-        placeholder.markdown(
-            f"<div class='bot-name'>Greeni</div><div class='bot-bubble'>{full_response}</div>",
-            unsafe_allow_html=True
-        )
+        full_response = renderer.finish()
         
-        # Update token usage (approximate)
-        st.session_state.token_usage["prompt_tokens"] += len(prompt.split())
-        st.session_state.token_usage["completion_tokens"] += len(full_response.split())
-        st.session_state.token_usage["total_tokens"] += len(prompt.split()) + len(full_response.split())
+        # Update token usage (reported by the provider; estimated with the local tokenizer if it sent none)
+        usage = account_usage(CONDITION_ID, usage, messages, full_response)
+        st.session_state.token_usage["prompt_tokens"] += usage.prompt_tokens
+        st.session_state.token_usage["completion_tokens"] += usage.completion_tokens
+        st.session_state.token_usage["total_tokens"] += usage.total_tokens
+        st.session_state.token_usage["history_tokens_saved"] += window["tokens_saved"]
+        # 프롬프트 접두사 캐시에서 처리된 토큰 수 (프로바이더가 알려준 경우)
+        # (알려주지 않는 프로바이더면 None으로 남겨서 0으로 저장되지 않도록)
+        cached = record_cached_tokens(CONDITION_ID, usage)
+        if cached is not None:
+            st.session_state.token_usage["cached_tokens"] = (st.session_state.token_usage.get("cached_tokens") or 0) + cached
+        # 턴별로 응답한 엔드포인트 기록 (지연 시간 분석용)
+        st.session_state.token_usage.setdefault("endpoints", []).append(response.endpoint)
+        # 턴별로 실제 쓴 생성 파라미터 기록 (참가자별 분석용으로 함께 저장)
+        st.session_state.token_usage.setdefault("generation", []).append(generation)
         
         # Increment turn counter
         st.session_state.current_turn += 1
@@ -318,21 +356,24 @@ def save_to_supabase(score=None):
             "total_tokens": st.session_state.token_usage["total_tokens"],
             "prompt_tokens": st.session_state.token_usage["prompt_tokens"],
             "completion_tokens": st.session_state.token_usage["completion_tokens"],
+            "cached_tokens": st.session_state.token_usage.get("cached_tokens"),
+            "condition": CONDITION_ID,  # 조건별 캐시 적중률 리포트용
+            "generation": st.session_state.token_usage.get("generation", []),  # 턴별 max_tokens / temperature / stop
             "score": score,
             "messages": st.session_state.messages
              }
 
         
         # Supabase에 데이터 저장
-        result = supabase.table("LLM1_R").insert(data).execute()
-        
-        # 저장 성공 여부 확인
-        if result.data:
-            return True
-        return False
+        # (로컬 스풀에 기록되면 바로 반환, 삽입은 백그라운드에서 재시도와 함께 처리)
+        write_behind.enqueue("LLM1_R", data)
+        # 로컬 스풀에는 저장됨. DB 기록이 계속 실패하고 있으면 대기 중인 행 수와 마지막 오류를 완료 페이지에 표시
+        st.session_state.save_problem = save_problem_message(write_behind.delivery_status())
+        return True
     
     except Exception as e:
         st.error(f"데이터 저장 중 오류 발생: {str(e)}")
+        st.session_state.save_problem = f"데이터 저장 중 오류 발생: {str(e)}"
         return False
 
 def validate_participant_id(participant_id):
@@ -348,28 +389,15 @@ def validate_participant_id(participant_id):
             return True, "Admin access confirmed"
         
         # Format check: a, b, c, d followed by 3 digits (001~100)
-        import re
-        if not re.match(r'^[a-d][0-9]{3}$', participant_id):
-            return False, "Invalid participant ID format. Must be a, b, c, or d + 3 digits (e.g., a001)"
-        
-        # Check if number part is in 001-100 range
-        num_part = int(participant_id[1:])
-        if num_part < 1 or num_part > 100:
-            return False, "Invalid participant ID. Number must be in 1-100 range."
+        if not is_valid_participant_id(participant_id):
+            return False, "Invalid participant ID format. Must be a, b, c, or d + 3 digits from 001 to 100 (e.g., a001)"
         
-        # Look up ID in Supabase
-        result = supabase.table("participants").select("*").eq("id", participant_id).execute()
-        
-        # If ID doesn't exist in participants table
-        if not result.data:
+        # Claim the ID in one round trip (two logins with the same ID cannot both pass)
+        status = claim_participant(supabase, participant_id)
+        if status == NOT_REGISTERED:
             return False, "Participant ID not registered."
-        
-        # Check if ID is already used
-        if result.data[0].get("used", False):
+        if status == TAKEN:
             return False, "This participant ID has already been used."
-        
-        # If valid ID, update used status
-        supabase.table("participants").update({"used": True, "used_at": datetime.datetime.now().isoformat()}).eq("id", participant_id).execute()
         return True, "Participant verified successfully."
     
     except Exception as e:
@@ -430,7 +458,7 @@ with st.sidebar:
         st.session_state.conversation_started = False
         st.session_state.current_turn = 0
         st.session_state.interaction_start = None
-        st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "history_tokens_saved": 0, "cached_tokens": None}
         st.success("Conversation reset!")
 
 # 설문조사 페이지 표시 여부를 위한 상태 변수 추가
@@ -489,9 +517,6 @@ def show_chat_page():
             else:
                 st.warning("피드백이 저장되었지만, 데이터베이스 저장에 문제가 있었습니다.")
             
-            # 일정 시간 후 완료 페이지로 이동
-            time.sleep(2)
-            
             # 앱 상태를 완료 페이지로 설정
             st.session_state.app_state = "complete"
             st.rerun()
@@ -595,22 +620,19 @@ def show_participant_id_page():
                 time.sleep(1)
                 st.rerun()
             else:
-                # 중복 체크
-                result = supabase.table("participants").select("id").eq("id", participant_id).execute()
-                if result.data:
-                    st.error("Your participant ID has been already taken.")
+                # 중복 체크와 등록을 한 번의 왕복으로 (같은 ID를 동시에 입력해도 한 명만 통과)
+                try:
+                    status = claim_participant(supabase, participant_id, register=True)
+                except Exception as e:
+                    st.warning(f"Could not save participant ID to DB: {e}")
                 else:
-                    try:
-                        supabase.table("participants").insert({
-                            "id": participant_id,
-                            "created_at": datetime.datetime.now().isoformat()
-                        }).execute()
+                    if status == TAKEN:
+                        st.error("Your participant ID has been already taken.")
+                    else:
                         st.session_state.app_state = "chat"
                         st.success("Participant ID saved. You can start chatting!")
                         time.sleep(1)
                         st.rerun()
-                    except Exception as e:
-                        st.warning(f"Could not save participant ID to DB: {e}")
 
 def show_complete_page():
     """완료 페이지 표시"""
@@ -619,6 +641,9 @@ def show_complete_page():
     
     with col2:
         st.markdown("<h1 style='text-align: center; margin-top: 100px;'>Thank you for your participation!</h1>", unsafe_allow_html=True)
+        # 제출 직후의 저장 경고는 rerun으로 사라지므로 여기서 다시 보여줌
+        if st.session_state.get("save_problem"):
+            st.warning(st.session_state.save_problem)
         
         # 다시 시작 버튼 (옵션)
         st.markdown("<div style='text-align: center; margin-top: 50px;'>", unsafe_allow_html=True)
@@ -630,7 +655,7 @@ def show_complete_page():
             st.session_state.conversation_started = False
             st.session_state.current_turn = 0
             st.session_state.interaction_start = None
-            st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            st.session_state.token_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "history_tokens_saved": 0, "cached_tokens": None}
             st.session_state.show_survey = False
             st.session_state.next_clicked = False
             st.session_state.show_next_button = False
@@ -0,0 +1,212 @@
+"""Run scripted pilot conversations against every condition of the experiment files.
+
+Each conversation (experiment, condition, script, repeat) is written as one JSONL line with the
+transcript, per-turn usage and latency. Conversations already in the output file are skipped, so an
+interrupted batch resumes where it stopped. Failed ones are retried: their error rows are dropped from
+the file first, so every conversation ends up with exactly one row. Hedged attempts are admitted by the
+batch's own rate limiter, like the primary calls.
+
+    python 2LLM/batch_runner.py --repeats 5 --workers 32 --output pilot.jsonl
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from history_window import fit_history
+from llm_client import get_shared_client
+from llm_sidecar import open_llm_stream
+from prefix_cache import cached_tokens
+from rate_limiter import LLM_MAX_IN_FLIGHT, LLM_RPM_LIMIT, LLM_TPM_LIMIT, RateLimiter, estimate_request_tokens, usage_tokens
+from stream_mux import read_stream
+from token_accounting import account_usage
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_EXPERIMENTS = os.path.join(ROOT, "prompts", "experiment-*.json")
+DEFAULT_SCRIPTS = os.path.join(ROOT, "prompts", "pilot", "scripts.json")
+
+
+def load_conditions(pattern, only=None):
+    """[(experiment file stem, experiment name, condition)] for every condition of the matching files"""
+    conditions = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        experiment = os.path.splitext(os.path.basename(path))[0]
+        for condition in data.get("conditions", []):
+            if only and condition["id"] not in only and f"{experiment}/{condition['id']}" not in only:
+                continue
+            conditions.append((experiment, data.get("experiment_name", experiment), condition))
+    return conditions
+
+
+def load_scripts(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)["scripts"]
+
+
+def conversation_key(experiment, condition_id, script_id, repeat):
+    return f"{experiment}/{condition_id}/{script_id}/{repeat}"
+
+
+def completed_keys(path):
+    """Keys of the conversations that already finished without an error (the resume checkpoint).
+
+    Rewrites the file without error rows, half-written lines and repeated rows of a key, so the
+    retried conversations are not written next to their old failures.
+    """
+    keys = set()
+    if not os.path.exists(path):
+        return keys
+    kept = []
+    dropped = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                dropped += 1  # 중단될 때 반쯤 쓰인 마지막 줄
+                continue
+            if record.get("error") or record["key"] in keys:
+                dropped += 1
+                continue
+            keys.add(record["key"])
+            kept.append(line if line.endswith("\n") else line + "\n")
+    if dropped:
+        # 임시 파일에 쓴 뒤 바꿔치기 (도중에 중단돼도 기존 결과를 잃지 않도록)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(kept)
+        os.replace(tmp_path, path)
+    return keys
+
+
+def run_turn(client, limiter, request, label):
+    """One streamed completion; returns (text, usage or None, endpoint, ttft seconds, total seconds)"""
+    permit = limiter.acquire(estimate_request_tokens(request["messages"], request.get("max_tokens")))
+    usage = None
+    try:
+        started = time.monotonic()
+        # 헤지도 배치 한도로 받음 (프로세스 전체 한도가 아니라)
+        stream = open_llm_stream(client, request, label, limiter=limiter)
+        ttft = time.monotonic() - started
+        parts = []
+        usage = read_stream(stream, parts.append, label, request["messages"])
+        return "".join(parts), usage, stream.endpoint, ttft, time.monotonic() - started
+    finally:
+        permit.release(usage_tokens(usage))
+
+
+def run_conversation(client, limiter, model, temperature, job):
+    """Play one script against one condition, the same way app_class.py builds each request"""
+    experiment, experiment_name, condition, script, repeat = job
+    key = conversation_key(experiment, condition["id"], script["id"], repeat)
+    record = {
+        "key": key, "experiment": experiment, "experiment_name": experiment_name,
+        "condition": condition["id"], "script": script["id"], "repeat": repeat, "model": model,
+        "started_at": datetime.datetime.now().isoformat(), "turns": [], "error": None,
+    }
+    opening = condition.get("opening_message")
+    history = [{"role": "assistant", "content": opening}] if opening else []
+    started = time.monotonic()
+    try:
+        for prompt in script["turns"]:
+            messages, window = fit_history(condition.get("system_prompt", "You are a helpful assistant."), history, prompt)
+            request = {"model": model, "messages": messages, "stream": True, "stream_options": {"include_usage": True}}
+            if temperature is not None:
+                request["temperature"] = temperature
+            text, usage, endpoint, ttft, total = run_turn(client, limiter, request, key)
+            reported = usage is not None
+            usage = account_usage(f"{experiment}/{condition['id']}", usage, messages, text)
+            record["turns"].append({
+                "user": prompt,
+                "assistant": text,
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens,
+                "cached_tokens": cached_tokens(usage),
+                "usage_reported": reported,
+                "history_tokens_saved": window["tokens_saved"],
+                "endpoint": endpoint,
+                "ttft_ms": round(ttft * 1000),
+                "latency_ms": round(total * 1000),
+            })
+            history += [{"role": "user", "content": prompt}, {"role": "assistant", "content": text}]
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["transcript"] = history
+    record["total_tokens"] = sum(turn["total_tokens"] for turn in record["turns"])
+    record["elapsed_ms"] = round((time.monotonic() - started) * 1000)
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--experiments", default=DEFAULT_EXPERIMENTS, help="glob of experiment files")
+    parser.add_argument("--scripts", default=DEFAULT_SCRIPTS, help="scripted user turns (prompts/pilot/scripts.json)")
+    parser.add_argument("--condition", action="append", help="condition id or experiment/condition to run (default: all)")
+    parser.add_argument("--repeats", type=int, default=1, help="conversations per condition and script")
+    parser.add_argument("--output", default="pilot_transcripts.jsonl")
+    parser.add_argument("--workers", type=int, default=16, help="conversations run at the same time")
+    parser.add_argument("--rpm", type=int, default=LLM_RPM_LIMIT, help="requests per minute (0 = no limit)")
+    parser.add_argument("--tpm", type=int, default=LLM_TPM_LIMIT, help="tokens per minute (0 = no limit)")
+    parser.add_argument("--max-in-flight", type=int, default=LLM_MAX_IN_FLIGHT)
+    parser.add_argument("--model", default=None, help="default: GITHUB_MODEL")
+    parser.add_argument("--temperature", type=float, default=None)
+    args = parser.parse_args()
+
+    load_dotenv()
+    token = os.getenv("GITHUB_TOKEN")
+    if not token:
+        parser.error("GITHUB_TOKEN not found in environment variables. Please check your .env file.")
+    client = get_shared_client(os.getenv("GITHUB_ENDPOINT", "https://models.github.ai/inference"), token)
+    model = args.model or os.getenv("GITHUB_MODEL", "openai/gpt-4o")
+    limiter = RateLimiter(args.rpm, args.tpm, args.max_in_flight)
+
+    conditions = load_conditions(args.experiments, args.condition)
+    scripts = load_scripts(args.scripts)
+    done = completed_keys(args.output)
+    jobs = [
+        (experiment, experiment_name, condition, script, repeat)
+        for experiment, experiment_name, condition in conditions
+        for script in scripts
+        if not script.get("experiments") or experiment in script["experiments"]
+        for repeat in range(args.repeats)
+        if conversation_key(experiment, condition["id"], script["id"], repeat) not in done
+    ]
+    print(f"{len(conditions)} conditions x {len(scripts)} scripts x {args.repeats} repeats: "
+          f"{len(jobs)} to run, {len(done)} already done")
+
+    started = time.monotonic()
+    finished = failed = 0
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="pilot")
+    try:
+        futures = [executor.submit(run_conversation, client, limiter, model, args.temperature, job) for job in jobs]
+        with open(args.output, 'a', encoding='utf-8') as out:
+            for future in as_completed(futures):
+                record = future.result()
+                # 대화 하나가 끝날 때마다 바로 기록 (중단돼도 여기까지가 체크포인트)
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                finished += 1
+                failed += bool(record["error"])
+                elapsed = time.monotonic() - started
+                print(f"[{finished}/{len(jobs)}] {record['key']} "
+                      f"{'ERROR ' + record['error'] if record['error'] else str(record['total_tokens']) + ' tokens'} "
+                      f"({finished / elapsed * 60:.1f} conversations/min)")
+    except KeyboardInterrupt:
+        print("interrupted; run again with the same --output to resume")
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise SystemExit(130)
+    executor.shutdown()
+    print(f"done: {finished - failed} ok, {failed} failed in {time.monotonic() - started:.0f}s")
+    print(limiter.get_stats())
+
+
+if __name__ == "__main__":
+    main()
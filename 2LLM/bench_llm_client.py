@@ -0,0 +1,133 @@
+"""Benchmark: one OpenAI client per call vs. the shared pooled client.
+
+Starts a local OpenAI-compatible streaming server that counts accepted connections and
+adds an artificial handshake delay to every new connection (standing in for TCP+TLS),
+then simulates concurrent participants taking debate turns.
+
+    python 2LLM/bench_llm_client.py --participants 40 --turns 4 --handshake-ms 80
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from openai import OpenAI
+
+import llm_client
+
+
+class FakeCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive 허용
+
+    def setup(self):
+        super().setup()
+        # 새 연결마다 한 번씩만 호출됨 -> 핸드셰이크 비용 흉내
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.handshake_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for i in range(self.server.tokens):
+            chunk = {
+                "id": "bench",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "bench",
+                "choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}],
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            time.sleep(self.server.token_delay)
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+def start_server(handshake_delay, token_delay, tokens):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCompletionHandler)
+    server.daemon_threads = True
+    server.handle_error = lambda request, client_address: None  # 클라이언트가 끊은 연결은 무시
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.handshake_delay = handshake_delay
+    server.token_delay = token_delay
+    server.tokens = tokens
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_turn(client, ttfts):
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
+        model="bench",
+        messages=[{"role": "user", "content": "Is it ethical?"}],
+        stream=True,
+    )
+    first = None
+    for chunk in stream:
+        if first is None and chunk.choices and chunk.choices[0].delta.content:
+            first = time.perf_counter() - start
+    ttfts.append(first)
+
+
+def run_mode(mode, base_url, participants, turns):
+    ttfts = []
+
+    def participant():
+        for _ in range(turns):
+            if mode == "per-call":
+                # 기존 방식: 턴마다 새 클라이언트
+                client = OpenAI(base_url=base_url, api_key="bench")
+                run_turn(client, ttfts)
+                client.close()
+            else:
+                run_turn(llm_client.get_shared_client(base_url, "bench"), ttfts)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=participants) as pool:
+        for _ in range(participants):
+            pool.submit(participant)
+    return ttfts, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--handshake-ms", type=float, default=80.0)
+    parser.add_argument("--token-ms", type=float, default=5.0)
+    parser.add_argument("--tokens", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'connections':>11} {'turns':>6} {'ttft p50':>9} {'ttft p95':>9} {'wall':>7}")
+    for mode in ("per-call", "shared"):
+        server = start_server(args.handshake_ms / 1000, args.token_ms / 1000, args.tokens)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        ttfts, wall = run_mode(mode, base_url, args.participants, args.turns)
+        ttfts.sort()
+        p50 = statistics.median(ttfts) * 1000
+        p95 = ttfts[int(len(ttfts) * 0.95) - 1] * 1000
+        print(f"{mode:<10} {server.connections:>11} {len(ttfts):>6} {p50:>7.1f}ms {p95:>7.1f}ms {wall:>6.2f}s")
+        server.shutdown()
+        llm_client.close_shared_clients()
+    print(llm_client.get_client_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Benchmark: create_client on every Streamlit rerun vs. the shared pooled Supabase client.
+
+Starts a local PostgREST-like server that counts accepted connections and adds an artificial
+handshake delay to every new connection (standing in for TCP+TLS), then simulates participants
+clicking through a session: a client is requested on every rerun, the participant id is checked
+and marked used, and the session row is inserted at the end.
+
+    python 2LLM/bench_supabase_client.py --participants 40 --reruns 20 --handshake-ms 80 --think-ms 200
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from supabase import create_client
+
+import supabase_client
+
+BENCH_KEY = "bench-anon-key"
+
+
+class FakePostgrestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive 허용
+
+    def setup(self):
+        super().setup()
+        # 새 연결마다 한 번씩만 호출됨 -> 핸드셰이크 비용 흉내
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.handshake_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, rows):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.request_delay)
+        with self.server.lock:
+            self.server.requests += 1
+        body = json.dumps(rows).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply([{"id": "P001", "used": False}])
+
+    def do_POST(self):
+        self._reply([{"id": 1}])
+
+    def do_PATCH(self):
+        self._reply([{"id": "P001", "used": True}])
+
+
+class FakePostgrestServer(ThreadingHTTPServer):
+    request_queue_size = 256  # 동시에 들어오는 연결이 backlog에서 끊기지 않도록
+
+
+def start_server(handshake_delay, request_delay=0.0):
+    server = FakePostgrestServer(("127.0.0.1", 0), FakePostgrestHandler)
+    server.daemon_threads = True
+    server.handle_error = lambda request, client_address: None
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.requests = 0
+    server.handshake_delay = handshake_delay
+    server.request_delay = request_delay
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def participant_journey(mode, url, reruns, think, latencies, constructed):
+    """One participant: a client per rerun (or the shared one), id check on the first rerun, insert on the last"""
+    for rerun in range(reruns):
+        # 참가자가 읽고 클릭하는 사이의 시간 (모두가 동시에 움직이지 않도록 무작위)
+        time.sleep(random.uniform(0, think))
+        if mode == "per-rerun":
+            # 기존 방식: 모듈 맨 위의 create_client가 클릭할 때마다 다시 실행됨
+            client = create_client(url, BENCH_KEY)
+            constructed.append(1)
+        else:
+            client = supabase_client.get_supabase(url, BENCH_KEY)
+        started = time.perf_counter()
+        if rerun == 0:
+            client.table("participants").select("*").eq("id", "P001").execute()
+            client.table("participants").update({"used": True}).eq("id", "P001").execute()
+        elif rerun == reruns - 1:
+            client.table("LLM2").insert({"participant_id": "P001", "messages": []}).execute()
+        else:
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def run_mode(mode, url, participants, reruns, think):
+    latencies = []
+    constructed = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=participants) as pool:
+        futures = [pool.submit(participant_journey, mode, url, reruns, think, latencies, constructed) for _ in range(participants)]
+        for future in futures:
+            future.result()
+    clients = len(constructed) if mode == "per-rerun" else supabase_client.get_supabase_stats()["clients_created"]
+    return latencies, clients, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=40)
+    parser.add_argument("--reruns", type=int, default=20, help="script reruns (clicks) per participant session")
+    parser.add_argument("--handshake-ms", type=float, default=80.0)
+    parser.add_argument("--think-ms", type=float, default=200.0, help="max random pause between reruns")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'clients':>8} {'per participant':>15} {'connections':>11} {'per participant':>15} "
+          f"{'queries':>8} {'p50':>8} {'p95':>8} {'wall':>7}")
+    for mode in ("per-rerun", "shared"):
+        server = start_server(args.handshake_ms / 1000)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        latencies, clients, wall = run_mode(mode, url, args.participants, args.reruns, args.think_ms / 1000)
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000
+        print(f"{mode:<10} {clients:>8} {clients / args.participants:>15.1f} {server.connections:>11} "
+              f"{server.connections / args.participants:>15.2f} {server.requests:>8} "
+              f"{p50:>6.1f}ms {p95:>6.1f}ms {wall:>6.2f}s")
+        server.shutdown()
+        supabase_client.close_supabase_clients()
+    print(supabase_client.get_supabase_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark: one upsert per submitted row vs. rows coalesced into bulk upserts per table.
+
+Reuses the fake PostgREST server of bench_supabase_client (with an extra per-request delay) and
+a throwaway spool, then has every participant submit their session row within a short spike, as at
+the end of a class session. Reports the requests sent and the submit-to-confirmed latency.
+
+    python 2LLM/bench_write_behind.py --participants 60 --spike-ms 3000 --request-ms 120
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+import bench_supabase_client
+import supabase_client
+import write_behind
+from record_spool import RecordSpool
+
+
+def wait_until_shipped(writer, participants, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = writer.get_stats()
+        if stats["flushed"] >= participants and stats["depth"] == 0:
+            return stats
+        time.sleep(0.05)
+    raise SystemExit(f"rows not shipped within {timeout}s: {writer.get_stats()}")
+
+
+def run_mode(bulk, window_ms, args):
+    server = bench_supabase_client.start_server(0, args.request_ms / 1000)
+    write_behind.WRITE_BEHIND_BULK = bulk
+    write_behind.WRITE_BEHIND_WINDOW_MS = window_ms
+    with tempfile.TemporaryDirectory() as directory:
+        spool = RecordSpool(os.path.join(directory, "bench.sqlite3"))
+        client = supabase_client.get_supabase(f"http://127.0.0.1:{server.server_address[1]}", bench_supabase_client.BENCH_KEY)
+        writer = write_behind.WriteBehindQueue(client, spool)
+
+        def submit(i):
+            time.sleep(random.uniform(0, args.spike_ms / 1000))
+            writer.enqueue("LLM2", {"participant_id": f"a{i:03d}", "messages": [{"role": "user", "content": "x" * 400}]})
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(args.participants)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = wait_until_shipped(writer, args.participants)
+    server.shutdown()
+    supabase_client.close_supabase_clients()
+    return stats, server.requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=60)
+    parser.add_argument("--spike-ms", type=float, default=3000.0, help="window in which every participant submits")
+    parser.add_argument("--request-ms", type=float, default=120.0, help="server time per request")
+    parser.add_argument("--window-ms", type=float, default=write_behind.WRITE_BEHIND_WINDOW_MS)
+    args = parser.parse_args()
+
+    print(f"{'mode':<10} {'requests':>8} {'rows/request':>12} {'p50':>8} {'p95':>8}")
+    for mode, bulk, window_ms in (("per-row", False, 0), ("coalesced", True, args.window_ms)):
+        stats, requests = run_mode(bulk, window_ms, args)
+        print(f"{mode:<10} {requests:>8} {args.participants / requests:>12.1f} "
+              f"{stats['flush_p50_ms']:>6}ms {stats['flush_p95_ms']:>6}ms")
+
+
+if __name__ == "__main__":
+    main()
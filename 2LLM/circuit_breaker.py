@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from collections import deque
+
+# 최근 호출 중 오류 또는 SLA를 넘긴 느린 응답의 비율이 기준을 넘으면 회로를 열고
+# CIRCUIT_OPEN_SECONDS 동안은 모델을 부르지 않고 미리 준비된 대체 답변을 보여줌
+# 실험 조건(참가자가 보는 답변)을 바꾸므로 기본은 꺼져 있음: CIRCUIT_ENABLED=1로 켬
+CIRCUIT_ENABLED = os.getenv("CIRCUIT_ENABLED", "0") == "1"
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))  # 판단에 쓰는 최근 호출 수
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_LATENCY_SLA = float(os.getenv("CIRCUIT_LATENCY_SLA", "10.0"))  # 첫 토큰까지 허용 시간(초)
+CIRCUIT_SLOW_RATE = float(os.getenv("CIRCUIT_SLOW_RATE", "0.5"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"  # 열린 뒤 시간이 지나 시험 호출 하나만 보내는 상태
+
+
+class CircuitBreaker:
+    """Open on a high error rate or too many calls over the latency SLA, then probe after a cool-down"""
+
+    def __init__(self, window=CIRCUIT_WINDOW, min_calls=CIRCUIT_MIN_CALLS, error_rate=CIRCUIT_ERROR_RATE,
+                 latency_sla=CIRCUIT_LATENCY_SLA, slow_rate=CIRCUIT_SLOW_RATE, open_seconds=CIRCUIT_OPEN_SECONDS):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency_sla = latency_sla
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._outcomes = deque(maxlen=window)  # (error, slow)
+        self._opened_at = 0.0
+        self._probe_at = None
+        self._lock = threading.Lock()
+        self._log = deque(maxlen=200)
+        self.stats = {"calls": 0, "errors": 0, "slow": 0, "opened": 0, "rejected": 0}
+
+    def _transition(self, state, reason):
+        self.state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+            self.stats["opened"] += 1
+        self._probe_at = None
+        self._log.append({"time": time.time(), "state": state, "reason": reason})
+
+    def allow(self):
+        """True if a model call may be made now (False = serve a fallback answer)"""
+        if not CIRCUIT_ENABLED:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.open_seconds:
+                self._transition(HALF_OPEN, "cool-down over")
+            if self.state == HALF_OPEN:
+                # 시험 호출은 하나만 (결과 없이 사라진 시험 호출은 시간이 지나면 다시 보냄)
+                if self._probe_at is None or now - self._probe_at >= self.latency_sla:
+                    self._probe_at = now
+                    return True
+            elif self.state == CLOSED:
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def record(self, latency=None, error=False):
+        """Record one finished call: seconds to its first token, or error=True"""
+        slow = not error and latency is not None and latency > self.latency_sla
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["errors"] += error
+            self.stats["slow"] += slow
+            if self.state == HALF_OPEN:
+                if error or slow:
+                    self._transition(OPEN, "probe failed" if error else "probe slow")
+                else:
+                    self._outcomes.clear()
+                    self._transition(CLOSED, "probe ok")
+                return
+            if self.state == OPEN:
+                return
+            self._outcomes.append((error, slow))
+            total = len(self._outcomes)
+            if total < self.min_calls:
+                return
+            errors = sum(e for e, _ in self._outcomes)
+            slows = sum(s for _, s in self._outcomes)
+            if errors / total >= self.error_rate:
+                self._transition(OPEN, f"error rate {errors}/{total}")
+            elif slows / total >= self.slow_rate:
+                self._transition(OPEN, f"slow calls {slows}/{total} over {self.latency_sla}s")
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, state=self.state, recent=len(self._outcomes), transitions=list(self._log)[-20:])
+
+
+_breaker = CircuitBreaker()
+
+
+def get_breaker():
+    return _breaker
+
+
+def get_breaker_stats():
+    """Return the breaker state, call / error / slow counts and recent state changes"""
+    return _breaker.get_stats()
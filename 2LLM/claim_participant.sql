@@ -0,0 +1,33 @@
+-- 참가자 ID를 한 번의 왕복으로 원자적으로 점유 (participant_claim.py에서 호출)
+-- 반환값: 'claimed' / 'taken' / 'not_registered'
+create or replace function claim_participant(p_id text, p_register boolean default false)
+returns text
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  if p_register then
+    -- ID 목록 없이 처음 입력될 때 등록하는 앱 (app, app_r, app2, app2_r)
+    insert into participants (id, created_at) values (p_id, now())
+    on conflict (id) do nothing;
+    if found then
+      return 'claimed';
+    end if;
+    return 'taken';
+  end if;
+
+  -- 미리 등록된 ID만 허용하는 앱 (kor2, kor2_t): 아직 사용되지 않은 행만 갱신됨
+  update participants set used = true, used_at = now()
+  where id = p_id and coalesce(used, false) = false;
+  if found then
+    return 'claimed';
+  end if;
+  if exists (select 1 from participants where id = p_id) then
+    return 'taken';
+  end if;
+  return 'not_registered';
+end;
+$$;
+
+grant execute on function claim_participant(text, boolean) to anon, authenticated;
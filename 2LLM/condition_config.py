@@ -0,0 +1,32 @@
+import json
+import os
+
+# 토론 앱별 설정 파일 (조건 id = 앱 파일 이름)
+CONDITIONS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "prompts", "debate", "conditions.json"
+)
+
+_conditions = None
+
+
+def load_conditions():
+    """Load the debate condition settings once per process"""
+    global _conditions
+    if _conditions is None:
+        try:
+            with open(CONDITIONS_PATH, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            _conditions = {cond["id"]: cond for cond in data.get("conditions", [])}
+        except (OSError, ValueError):
+            _conditions = {}
+    return _conditions
+
+
+def get_condition(condition_id):
+    """Return the settings for one condition (an empty dict if it is not configured)"""
+    return load_conditions().get(condition_id, {})
+
+
+def get_sentence_budget(condition_id, persona):
+    """Return the sentence budget for a persona in a condition, or None for no limit"""
+    return get_condition(condition_id).get("sentence_budget", {}).get(persona)
@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from llm_client import get_shared_client
+
+# 엔드포인트 목록 (JSON 배열): [{"name", "base_url", "api_key" 또는 "api_key_env", "model", "weight", "max_in_flight"}]
+# 설정이 없으면 각 앱이 원래 쓰던 클라이언트/모델 하나로만 보냄
+LLM_ENDPOINTS = os.getenv("LLM_ENDPOINTS", "")
+LLM_ENDPOINTS_FILE = os.getenv("LLM_ENDPOINTS_FILE", "")
+
+EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+PRIOR_TTFT = 1.0  # 측정값이 없는 엔드포인트의 TTFT 가정값(초)
+# 오류율 EWMA가 이 값을 넘으면 건강하지 않은 것으로 보고 다른 곳이 모두 안 될 때만 사용
+UNHEALTHY_ERROR_RATE = float(os.getenv("ROUTER_UNHEALTHY_ERROR_RATE", "0.5"))
+# 마지막 오류 후 이 시간(초)이 지나면 다시 요청을 보내서 회복됐는지 확인
+UNHEALTHY_RETRY_AFTER = float(os.getenv("ROUTER_UNHEALTHY_RETRY_AFTER", "30"))
+DEFAULT_MAX_IN_FLIGHT = int(os.getenv("ROUTER_DEFAULT_MAX_IN_FLIGHT", "64"))
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    """One OpenAI-compatible endpoint with its running latency and error averages"""
+
+    def __init__(self, name, client, model, weight=1.0, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.weight = weight
+        self.max_in_flight = max_in_flight
+        self.ttft = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = 0.0
+
+    @property
+    def healthy(self):
+        return self.error_rate < UNHEALTHY_ERROR_RATE or time.monotonic() - self.last_error > UNHEALTHY_RETRY_AFTER
+
+    @property
+    def saturated(self):
+        return bool(self.max_in_flight) and self.in_flight >= self.max_in_flight
+
+    def expected_ttft(self):
+        return self.ttft if self.ttft is not None else PRIOR_TTFT
+
+    def snapshot(self):
+        return {
+            "name": self.name, "model": self.model, "healthy": self.healthy, "in_flight": self.in_flight,
+            "ttft_ewma_ms": round(self.ttft * 1000) if self.ttft is not None else None,
+            "error_rate": round(self.error_rate, 3), "requests": self.requests, "errors": self.errors,
+        }
+
+
+class RoutedStream:
+    """Stream wrapper that reports TTFT / errors back to the router and frees the slot when done"""
+
+    def __init__(self, router, endpoint, stream, started):
+        self.router = router
+        self.endpoint = endpoint
+        self._stream = stream
+        self._started = started
+        self._ended = False
+
+    def __iter__(self):
+        first = True
+        error = False
+        try:
+            for chunk in self._stream:
+                if first:
+                    first = False
+                    self.router.report(self.endpoint, ttft=time.monotonic() - self._started)
+                yield chunk
+        except Exception:
+            error = True
+            raise
+        finally:
+            self._end(error)
+
+    def _end(self, error=False):
+        if not self._ended:
+            self._ended = True
+            self.router.finish(self.endpoint, error=error)
+
+    def close(self):
+        self._stream.close()
+        self._end()
+
+
+class Router:
+    """Send each request to the healthy endpoint with the lowest expected TTFT.
+
+    When that endpoint is saturated (max_in_flight reached) the request spills over to
+    the others, picked at random in proportion to weight / expected TTFT.
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self._lock = threading.Lock()
+        self._log = deque(maxlen=1000)
+
+    def pick(self, client, request, label=None):
+        """Choose an endpoint (the app's own client and model when none are configured)"""
+        candidates = self.endpoints or [_default_endpoint(client, request)]
+        with self._lock:
+            healthy = [e for e in candidates if e.healthy] or candidates
+            best = min(healthy, key=Endpoint.expected_ttft)
+            reason = "best"
+            if best.saturated:
+                others = [e for e in healthy if not e.saturated]
+                if others:
+                    weights = [e.weight / e.expected_ttft() for e in others]
+                    best = random.choices(others, weights=weights)[0]
+                    reason = "spillover"
+                else:
+                    reason = "saturated"
+            best.in_flight += 1
+            best.requests += 1
+            self._log.append({"time": time.time(), "label": label, "endpoint": best.name, "reason": reason})
+        return best
+
+    def report(self, endpoint, ttft):
+        with self._lock:
+            endpoint.ttft = ttft if endpoint.ttft is None else (1 - EWMA_ALPHA) * endpoint.ttft + EWMA_ALPHA * ttft
+
+    def finish(self, endpoint, error=False):
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.error_rate = (1 - EWMA_ALPHA) * endpoint.error_rate + EWMA_ALPHA * (1.0 if error else 0.0)
+            if error:
+                endpoint.errors += 1
+                endpoint.last_error = time.monotonic()
+
+    def create_stream(self, client, request, label=None):
+        """Start a streamed completion on the chosen endpoint (the endpoint's model replaces request["model"])"""
+        endpoint = self.pick(client, request, label)
+        started = time.monotonic()
+        try:
+            stream = endpoint.client.chat.completions.create(**dict(request, model=endpoint.model))
+        except Exception:
+            self.finish(endpoint, error=True)
+            raise
+        return RoutedStream(self, endpoint, stream, started)
+
+    def create(self, client, request, label=None):
+        """Non-streaming completion on the chosen endpoint; returns (response, endpoint name)"""
+        endpoint = self.pick(client, request, label)
+        started = time.monotonic()
+        try:
+            response = endpoint.client.chat.completions.create(**dict(request, model=endpoint.model))
+        except Exception:
+            self.finish(endpoint, error=True)
+            raise
+        self.report(endpoint, time.monotonic() - started)
+        self.finish(endpoint)
+        return response, endpoint.name
+
+    def get_stats(self):
+        with self._lock:
+            return [e.snapshot() for e in self.endpoints + list(_default_endpoints.values())]
+
+    def get_log(self, limit=100):
+        with self._lock:
+            return list(self._log)[-limit:]
+
+
+# 설정된 엔드포인트가 없을 때 앱 클라이언트별로 만드는 기본 엔드포인트
+_default_endpoints = {}
+_default_lock = threading.Lock()
+
+
+def _default_endpoint(client, request):
+    key = (id(client), request["model"])
+    with _default_lock:
+        endpoint = _default_endpoints.get(key)
+        if endpoint is None:
+            endpoint = Endpoint(f"{client.base_url.host}/{request['model']}", client, request["model"])
+            _default_endpoints[key] = endpoint
+        return endpoint
+
+
+def load_endpoints():
+    """Read the configured endpoint list (LLM_ENDPOINTS json or LLM_ENDPOINTS_FILE)"""
+    raw = LLM_ENDPOINTS
+    if not raw and LLM_ENDPOINTS_FILE:
+        with open(LLM_ENDPOINTS_FILE, 'r', encoding='utf-8') as f:
+            raw = f.read()
+    if not raw:
+        return []
+    endpoints = []
+    for i, item in enumerate(json.loads(raw)):
+        api_key = item.get("api_key") or os.getenv(item.get("api_key_env", ""), "")
+        endpoints.append(Endpoint(
+            item.get("name", f"endpoint-{i}"),
+            get_shared_client(item["base_url"], api_key),
+            item["model"],
+            float(item.get("weight", 1.0)),
+            int(item.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT)),
+        ))
+    return endpoints
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the process-wide router, reading the endpoint list on first use.
+
+    A malformed endpoint list is logged and ignored, so requests go to each app's own
+    client and model (the single default endpoint) instead of failing the import.
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            try:
+                endpoints = load_endpoints()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.error("could not read LLM_ENDPOINTS / LLM_ENDPOINTS_FILE (%s: %s); using the default endpoint",
+                             type(e).__name__, e)
+                endpoints = []
+            _router = Router(endpoints)
+        return _router
+
+
+def get_router_stats():
+    """Return per-endpoint EWMA TTFT, error rate and in-flight counts"""
+    return get_router().get_stats()
@@ -0,0 +1,74 @@
+import json
+import os
+import re
+import threading
+
+from condition_config import get_condition
+from similarity_cache import normalize_prompt
+
+# 조건별 대체 답변 파일 (conditions.json의 fallback_bank가 이 파일의 bank 이름을 가리킴)
+FALLBACKS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "prompts", "debate", "fallbacks.json"
+)
+
+_banks = None
+_stats = {}  # condition id -> {"served", "matched"}
+_lock = threading.Lock()
+
+
+def _compile(entry):
+    keywords = [normalize_prompt(k) for k in entry.get("keywords", [])]
+    # 단어 앞부분 일치 ("clon" -> cloning, "복제" -> 복제에)
+    pattern = re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, keywords)) + ")") if keywords else None
+    return {"pattern": pattern, "text": entry["text"]}
+
+
+def load_banks():
+    """Load and precompile the fallback banks once per process"""
+    global _banks
+    if _banks is None:
+        try:
+            with open(FALLBACKS_PATH, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            _banks = {
+                name: {persona: [_compile(e) for e in entries] for persona, entries in bank.items()}
+                for name, bank in data.get("banks", {}).items()
+            }
+        except (OSError, ValueError):
+            _banks = {}
+    return _banks
+
+
+def has_fallback(condition_id, persona):
+    """True if the condition has fallback answers for this persona"""
+    bank = load_banks().get(get_condition(condition_id).get("fallback_bank"), {})
+    return bool(bank.get(persona))
+
+
+def pick_fallback(condition_id, persona, prompt):
+    """Fallback answer whose keywords best match the prompt (the keyword-less default otherwise), or None"""
+    entries = load_banks().get(get_condition(condition_id).get("fallback_bank"), {}).get(persona)
+    if not entries:
+        return None
+    text = normalize_prompt(prompt)
+    best, best_score = None, 0
+    default = None
+    for entry in entries:
+        if entry["pattern"] is None:
+            default = default or entry
+            continue
+        score = len(set(entry["pattern"].findall(text)))
+        if score > best_score:
+            best, best_score = entry, score
+    with _lock:
+        stats = _stats.setdefault(condition_id, {"served": 0, "matched": 0})
+        stats["served"] += 1
+        if best is not None:
+            stats["matched"] += 1
+    return (best or default or entries[0])["text"]
+
+
+def get_fallback_stats():
+    """Return how many fallback answers were served per condition (matched = chosen by keyword)"""
+    with _lock:
+        return {cid: dict(s) for cid, s in _stats.items()}
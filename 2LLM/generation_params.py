@@ -0,0 +1,138 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from condition_config import get_condition
+
+# 적응형 조정 기본값 (조건의 generation.adaptive에서 덮어씀)
+DEFAULT_TARGET_P95 = float(os.getenv("GENERATION_TARGET_P95", "8.0"))  # 초
+DEFAULT_WINDOW = 20       # p95를 계산할 최근 응답 수
+DEFAULT_MIN_SAMPLES = 10  # 이만큼 모이기 전에는 조정하지 않음
+DEFAULT_STEP = 0.2        # 한 번에 줄이거나 늘리는 비율
+DEFAULT_HEADROOM = 0.7    # p95가 목표의 이 비율 아래면 다시 늘림
+DEFAULT_MIN_MAX_TOKENS = 64
+
+logger = logging.getLogger(__name__)
+
+_controllers = {}  # (condition id, persona) -> MaxTokensController
+_log = deque(maxlen=200)  # 최근 조정 기록 (모든 조건)
+_lock = threading.Lock()
+
+
+def _for_persona(value, persona):
+    """A setting given once for the condition or per persona ({"pro": 300, "con": 300})"""
+    return value.get(persona) if isinstance(value, dict) else value
+
+
+class MaxTokensController:
+    """Tighten max_tokens while the p95 latency of a persona's answers is over target, relax it with headroom"""
+
+    def __init__(self, condition_id, persona, ceiling, target_p95=DEFAULT_TARGET_P95, floor=DEFAULT_MIN_MAX_TOKENS,
+                 window=DEFAULT_WINDOW, min_samples=DEFAULT_MIN_SAMPLES, step=DEFAULT_STEP, headroom=DEFAULT_HEADROOM):
+        self.condition_id = condition_id
+        self.persona = persona
+        self.ceiling = ceiling
+        self.floor = min(floor, ceiling)
+        self.target_p95 = target_p95
+        self.min_samples = min(min_samples, window)
+        self.step = step
+        self.headroom = headroom
+        self.max_tokens = ceiling
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def p95(self):
+        ordered = sorted(self._latencies)
+        return ordered[max(0, math.ceil(len(ordered) * 0.95) - 1)] if ordered else None
+
+    def record(self, latency):
+        """Add one answer's latency (seconds); adjusts max_tokens once enough answers have been seen"""
+        with self._lock:
+            self._latencies.append(latency)
+            if len(self._latencies) < self.min_samples:
+                return
+            p95 = self.p95()
+            if p95 > self.target_p95 and self.max_tokens > self.floor:
+                new = max(self.floor, int(self.max_tokens * (1 - self.step)))
+            elif p95 < self.target_p95 * self.headroom and self.max_tokens < self.ceiling:
+                new = min(self.ceiling, int(self.max_tokens * (1 + self.step)) + 1)
+            else:
+                return
+            old, self.max_tokens = self.max_tokens, new
+            # 조정 뒤의 지연 시간만 보고 다음 판단을 하도록 창을 비움
+            self._latencies.clear()
+        entry = {
+            "at": time.time(), "condition": self.condition_id, "persona": self.persona,
+            "p95": round(p95, 3), "target_p95": self.target_p95, "from": old, "to": new,
+        }
+        with _lock:
+            _log.append(entry)
+        logger.info("max_tokens %s/%s: %d -> %d (p95 %.2fs, target %.2fs)",
+                    self.condition_id, self.persona, old, new, p95, self.target_p95)
+
+    def get_stats(self):
+        with self._lock:
+            p95 = self.p95()
+            return {
+                "max_tokens": self.max_tokens, "ceiling": self.ceiling, "floor": self.floor,
+                "target_p95": self.target_p95, "p95": round(p95, 3) if p95 is not None else None,
+                "samples": len(self._latencies),
+            }
+
+
+def _controller(condition_id, persona):
+    """The adaptive controller of a persona, or None if the condition has no adaptive max_tokens"""
+    key = (condition_id, persona)
+    if key in _controllers:
+        return _controllers[key]
+    settings = get_condition(condition_id).get("generation", {})
+    adaptive = settings.get("adaptive", {})
+    ceiling = _for_persona(settings.get("max_tokens"), persona)
+    controller = None
+    if adaptive.get("enabled") and ceiling:
+        controller = MaxTokensController(
+            condition_id, persona, int(ceiling),
+            target_p95=float(adaptive.get("target_p95", DEFAULT_TARGET_P95)),
+            floor=int(adaptive.get("min_max_tokens", DEFAULT_MIN_MAX_TOKENS)),
+            window=int(adaptive.get("window", DEFAULT_WINDOW)),
+            min_samples=int(adaptive.get("min_samples", DEFAULT_MIN_SAMPLES)),
+            step=float(adaptive.get("step", DEFAULT_STEP)),
+            headroom=float(adaptive.get("headroom", DEFAULT_HEADROOM)),
+        )
+    with _lock:
+        return _controllers.setdefault(key, controller)
+
+
+def get_generation_params(condition_id, persona):
+    """Request parameters (max_tokens, temperature, stop) of a persona in a condition; unset ones are left out"""
+    settings = get_condition(condition_id).get("generation", {})
+    params = {}
+    for name in ("max_tokens", "temperature", "stop"):
+        value = _for_persona(settings.get(name), persona)
+        if value is not None and value != []:
+            params[name] = value
+    controller = _controller(condition_id, persona)
+    if controller is not None:
+        params["max_tokens"] = controller.max_tokens
+    return params
+
+
+def record_latency(condition_id, persona, latency):
+    """Feed a finished answer's latency (seconds from request to last token) to the adaptive controller"""
+    controller = _controller(condition_id, persona)
+    if controller is not None:
+        controller.record(latency)
+
+
+def get_generation_stats():
+    """Return the current max_tokens and p95 per adaptive persona plus the recent adjustments"""
+    with _lock:
+        controllers = {f"{cid}/{persona}": c for (cid, persona), c in _controllers.items() if c is not None}
+        adjustments = list(_log)
+    return {
+        "controllers": {key: c.get_stats() for key, c in controllers.items()},
+        "adjustments": adjustments,
+    }
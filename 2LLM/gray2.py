@@ -1,11 +1,21 @@
 import os
 import streamlit as st
-from openai import OpenAI
+from condition_config import get_sentence_budget
+from generation_params import get_generation_params
+from history_window import fit_history
+from llm_client import get_shared_client
+from prefix_cache import record_cached_tokens
+from response_cache import get_canned_turn
+from speculation import speculate
+from stream_mux import assistant_message, cancelled_messages, chat_job, stream_concurrently
 from dotenv import load_dotenv
 import json
 import glob
 import datetime  # For time measurement
 
+# prompts/debate/conditions.json의 조건 id
+CONDITION_ID = "gray2"
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -86,7 +96,7 @@ def update_session_time():
     st.session_state.interaction_count += 1
 
 def get_openai_client():
-    """Create and return an OpenAI client configured with environment variables"""
+    """Return the shared OpenAI client configured with environment variables"""
     token = os.getenv("GITHUB_TOKEN")
     endpoint = os.getenv("GITHUB_ENDPOINT", "https://models.github.ai/inference")
     
@@ -94,10 +104,29 @@ def get_openai_client():
         st.error("GitHub token not found in environment variables. Please check your .env file.")
         st.stop()
         
-    return OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
+    # 프로세스 전체에서 공유하는 클라이언트 (keep-alive 연결 재사용)
+    return get_shared_client(endpoint, token)
+
+def speculate_next_turn():
+    """Pre-generate answers for the likely next prompts while the participant reads (once per turn)"""
+    speculation = st.session_state.get("speculation")
+    if speculation is not None and speculation.turn == st.session_state.current_turn:
+        return
+    client = get_openai_client()
+    model_name = os.getenv("GITHUB_MODEL", "openai/gpt-4o")
+
+    def build_requests(prompt):
+        # 다음 턴의 요청과 똑같이 구성 (질문이 기록에 추가된 뒤 generate_debate_responses가 호출됨)
+        history = [msg for msg in st.session_state.messages if msg["role"] != "system" and "type" not in msg]
+        history.append({"role": "user", "content": prompt})
+        return {
+            "pro": {"messages": fit_history(st.session_state.system_message_pro, history, prompt)[0], "model": model_name,
+                    **get_generation_params(CONDITION_ID, "pro")},
+            "con": {"messages": fit_history(st.session_state.system_message_con, history, prompt)[0], "model": model_name,
+                    **get_generation_params(CONDITION_ID, "con")},
+        }
+
+    st.session_state.speculation = speculate(CONDITION_ID, st.session_state.current_turn, client, build_requests)
 
 def generate_debate_responses(prompt):
     """Generate two separate responses - one pro, one con"""
@@ -114,88 +143,60 @@ def generate_debate_responses(prompt):
             history.append(msg)
     
     # Generate pro messages
-    pro_messages = [{"role": "system", "content": st.session_state.system_message_pro}] + history + [{"role": "user", "content": prompt}]
+    # 토큰 예산을 넘는 오래된 턴은 빼거나 요약 (시스템 프롬프트와 최근 턴은 그대로 유지)
+    pro_messages, pro_window = fit_history(st.session_state.system_message_pro, history, prompt)
     
     # Generate con messages
-    con_messages = [{"role": "system", "content": st.session_state.system_message_con}] + history + [{"role": "user", "content": prompt}]
+    con_messages, con_window = fit_history(st.session_state.system_message_con, history, prompt)
     
     try:
         # Display response in chat format
         status_placeholder = st.empty()
         status_placeholder.markdown("Generating response...", unsafe_allow_html=True)
         
-        # Generate pro response
-        full_pro_response = ""
-        usage_pro = None
-        
-        pro_response = client.chat.completions.create(
-            messages=pro_messages,
-            model=model_name,
-            stream=True,
-            stream_options={'include_usage': True}
-        )
-        
-        # Add pro response
+        # 찬성/반대 요청을 동시에 보내고 두 스트림을 이 스레드에서 렌더링
+        # 턴 지연 시간이 (찬성 + 반대)가 아니라 max(찬성, 반대)가 됨
         pro_placeholder = st.empty()
-        
-        # Stream pro response
-        for chunk in pro_response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_pro_response += content_chunk
-                pro_placeholder.markdown(
-                    f"<div class='pro-name'>Purpli</div><div class='pro-bubble'>{full_pro_response}▌</div>",
-                    unsafe_allow_html=True
-                )
-                
-            if chunk.usage:
-                usage_pro = chunk.usage
-        
-        # Update final pro response (remove cursor)
-        pro_placeholder.markdown(
-            f"<div class='pro-name'>Purpli</div><div class='pro-bubble'>{full_pro_response}</div>",
-            unsafe_allow_html=True
-        )
-        
-        # Generate con response
-        full_con_response = ""
-        usage_con = None
-        
-        con_response = client.chat.completions.create(
-            messages=con_messages,
-            model=model_name,
-            stream=True,
-            stream_options={'include_usage': True}
-        )
-        
-        # Add con response
         con_placeholder = st.empty()
         
-        # Stream con response
-        for chunk in con_response:
-            if chunk.choices and chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_con_response += content_chunk
-                con_placeholder.markdown(
-                    f"<div class='con-name'>Yellowy</div><div class='con-bubble'>{full_con_response}▌</div>",
-                    unsafe_allow_html=True
-                )
-                
-            if chunk.usage:
-                usage_con = chunk.usage
-        
-        # Update final con response (remove cursor)
-        con_placeholder.markdown(
-            f"<div class='con-name'>Yellowy</div><div class='con-bubble'>{full_con_response}</div>",
-            unsafe_allow_html=True
-        )
+        results = stream_concurrently([
+            chat_job(
+                "pro", pro_placeholder,
+                "<div class='pro-name'>Purpli</div><div class='pro-bubble'>{}</div>",
+                client, messages=pro_messages, model=model_name,
+                sentence_budget=get_sentence_budget(CONDITION_ID, "pro"),
+                similarity_scope=(CONDITION_ID, st.session_state.current_turn),
+                speculation=st.session_state.get("speculation"),
+                fallback_condition=CONDITION_ID,
+                generation_condition=CONDITION_ID
+            ),
+            chat_job(
+                "con", con_placeholder,
+                "<div class='con-name'>Yellowy</div><div class='con-bubble'>{}</div>",
+                client, messages=con_messages, model=model_name,
+                sentence_budget=get_sentence_budget(CONDITION_ID, "con"),
+                similarity_scope=(CONDITION_ID, st.session_state.current_turn),
+                speculation=st.session_state.get("speculation"),
+                fallback_condition=CONDITION_ID,
+                generation_condition=CONDITION_ID
+            ),
+        ], on_cancel=lambda partial: st.session_state.messages.extend(cancelled_messages(partial)),
+           on_queue=lambda position: status_placeholder.markdown(
+               f"Many participants are chatting right now. Waiting in line (position {position})..." if position else "Generating response...",
+               unsafe_allow_html=True
+           ))
+        
+        full_pro_response = results["pro"]["content"]
+        usage_pro = results["pro"]["usage"]
+        full_con_response = results["con"]["content"]
+        usage_con = results["con"]["usage"]
         
         # Remove status display
         status_placeholder.empty()
         
         # Add responses to session state
-        st.session_state.messages.append({"role": "assistant", "content": full_pro_response, "type": "pro"})
-        st.session_state.messages.append({"role": "assistant", "content": full_con_response, "type": "con"})
+        st.session_state.messages.append(assistant_message("pro", results["pro"]))
+        st.session_state.messages.append(assistant_message("con", results["con"]))
         
         # Save usage statistics
         if usage_pro and usage_con:
@@ -206,7 +207,11 @@ def generate_debate_responses(prompt):
             st.session_state.usage_stats.append({
                 "prompt_tokens": usage_pro_dict.get("prompt_tokens", 0) + usage_con_dict.get("prompt_tokens", 0),
                 "completion_tokens": usage_pro_dict.get("completion_tokens", 0) + usage_con_dict.get("completion_tokens", 0),
-                "total_tokens": usage_pro_dict.get("total_tokens", 0) + usage_con_dict.get("total_tokens", 0)
+                "total_tokens": usage_pro_dict.get("total_tokens", 0) + usage_con_dict.get("total_tokens", 0),
+                "history_tokens_saved": pro_window["tokens_saved"] + con_window["tokens_saved"],
+                "endpoints": {"pro": results["pro"]["endpoint"], "con": results["con"]["endpoint"]},
+                # 프롬프트 접두사 캐시에서 처리된 토큰 수 (프로바이더가 알려준 경우)
+                "cached_tokens": record_cached_tokens(CONDITION_ID, usage_pro, usage_con)
             })
         
         # If process display is activated
@@ -546,16 +551,20 @@ def show_chat_page():
                             key="conversation_starter"
                         ):
                             st.session_state.conversation_started = True
-                            st.session_state.current_turn = 1
                             user_prompt = "Explain about 'Pet cloning'"
                             st.session_state.messages.append({"role": "user", "content": user_prompt})
                             
-                            # 고정된 첫 응답
-                            purpli_response = "Cloning a deceased pet involves using biotechnology to create a new animal that is genetically identical to the original. For many people, pets are like family, so the idea of meeting them again in any form can be deeply comforting. With today's advanced technology, cloning has become a realistic option. Some also believe it's worth preserving the genes of special animals—like service dogs or police dogs—through cloning."
-                            yellowy_response = "Cloning from a deceased pet involves complex steps—DNA must be extracted from preserved tissue, then an embryo is formed and implanted into a surrogate. Even if the cloned pet looks the same and shares the same genes, it won't have the same memories or personality, and the sense of loss may still remain. There are many abandoned animals waiting to be adopted, and providing care for them may be a more meaningful choice than cloning."
-                            
-                            st.session_state.messages.append({"role": "assistant", "content": purpli_response, "type": "pro"})
-                            st.session_state.messages.append({"role": "assistant", "content": yellowy_response, "type": "con"})
+                            # 고정된 첫 응답 (prompts/debate/conditions.json의 canned_turns)
+                            canned = get_canned_turn(CONDITION_ID, user_prompt)
+                            if canned:
+                                st.session_state.current_turn = 1
+                                purpli_response = canned["pro"]
+                                yellowy_response = canned["con"]
+                                st.session_state.messages.append({"role": "assistant", "content": purpli_response, "type": "pro"})
+                                st.session_state.messages.append({"role": "assistant", "content": yellowy_response, "type": "con"})
+                            else:
+                                # 설정된 첫 응답이 없으면 API로 생성
+                                generate_debate_responses(user_prompt)
                             
                             st.rerun()
                 i += 1
@@ -601,6 +610,9 @@ def show_chat_page():
 
     # Chat input (Only show if conversation not finished)
     if st.session_state.conversation_started and st.session_state.current_turn < st.session_state.max_turns:
+        # 참가자가 답변을 읽는 동안 다음 질문 후보의 답을 미리 생성 (조건에서 speculation을 켠 경우만)
+        speculate_next_turn()
+        
         if prompt := st.chat_input("Enter a topic you want to discuss..."):
             # Display user message without chatbot icon
             st.markdown(
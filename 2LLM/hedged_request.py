@@ -0,0 +1,304 @@
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from rate_limiter import estimate_request_tokens, try_acquire_permit
+
+# 첫 토큰이 최근 p95 TTFT 안에 안 오면 같은 요청을 한 번 더 보내서 먼저 오는 쪽을 사용
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1") != "0"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "3.0"))  # 표본이 모이기 전 사용하는 기준(초)
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "15.0"))
+HEDGE_MIN_SAMPLES = 20
+# 첫 토큰을 기다리는 시도(주 요청/헤지/재시도)를 실행하는 스레드 수 상한
+# (제공자가 느려져도 스레드와 연결 수가 요청마다 늘어나지 않도록, 가득 차면 시도는 차례를 기다림)
+HEDGE_ATTEMPT_WORKERS = int(os.getenv("HEDGE_ATTEMPT_WORKERS", "64"))
+
+# 재시도 예산: 요청마다 RETRY_BUDGET_RATIO만큼 쌓이고 재시도/헤지 한 번에 1씩 씀
+# (장애 중에 재시도가 요청 수를 몇 배로 불리지 않도록 전체 요청의 일정 비율로 제한)
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "20"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8.0"))
+
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,  # APITimeoutError 포함
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+_executor = ThreadPoolExecutor(max_workers=HEDGE_ATTEMPT_WORKERS, thread_name_prefix="llm-attempt")
+_lock = threading.Lock()
+_budget = RETRY_BUDGET_MAX / 4
+_ttft_samples = deque(maxlen=500)  # 이긴 시도의 첫 토큰 시간 (시도 시작 기준)
+_latency_samples = deque(maxlen=500)  # 요청 시작부터 첫 토큰까지 (헤지/재시도 포함)
+_attempt_log = deque(maxlen=1000)
+_stats = {
+    "requests": 0, "attempts": 0, "hedges": 0, "hedge_wins": 0, "retries": 0,
+    "budget_exhausted": 0, "hedges_rate_limited": 0, "failures": 0, "saved_ms": 0.0,
+}
+
+
+def _deposit():
+    global _budget
+    with _lock:
+        _stats["requests"] += 1
+        _budget = min(RETRY_BUDGET_MAX, _budget + RETRY_BUDGET_RATIO)
+
+
+def _withdraw():
+    """Take one token from the retry budget; False if it is exhausted"""
+    global _budget
+    with _lock:
+        if _budget >= 1:
+            _budget -= 1
+            return True
+        _stats["budget_exhausted"] += 1
+        return False
+
+
+def _percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def hedge_delay():
+    """Seconds to wait for the first token before firing a hedge request"""
+    with _lock:
+        samples = list(_ttft_samples)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, _percentile(samples, HEDGE_PERCENTILE)))
+
+
+def expected_first_token():
+    """Typical seconds from request start to the first token (median, or HEDGE_DEFAULT_DELAY before enough samples)"""
+    with _lock:
+        samples = list(_latency_samples)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return _percentile(samples, 0.5)
+
+
+def backoff_delay(retry):
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** retry))
+
+
+def _is_retryable(error):
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class HedgedStream:
+    """Chat completion stream that won the race; iterates like the original stream"""
+
+    def __init__(self, stream, iterator, first_chunk, attempts, permit=None):
+        self._stream = stream
+        self._iterator = iterator
+        self._first = first_chunk
+        self._permit = permit  # 헤지가 이긴 경우 그 헤지의 요청 한도 허가 (스트림이 끝나면 반환)
+        self.attempts = attempts
+        # 라우터를 거친 경우 실제로 응답한 엔드포인트 이름
+        endpoint = getattr(stream, "endpoint", None)
+        self.endpoint = endpoint.name if endpoint is not None else None
+
+    def __iter__(self):
+        try:
+            if self._first is not None:
+                first, self._first = self._first, None
+                yield first
+            yield from self._iterator
+        finally:
+            self._release()
+
+    def _release(self):
+        if self._permit is not None:
+            self._permit.release()
+
+    def close(self):
+        self._stream.close()
+        self._release()
+
+
+def _run_attempt(create, record, events, race, permit=None):
+    """Pool worker: open one stream and wait for its first chunk"""
+    try:
+        if race["winner"] is not None:
+            # 풀에서 차례를 기다리는 사이 다른 시도가 이겼거나 요청이 끝남
+            record["outcome"] = "skipped"
+            if permit is not None:
+                permit.release()
+            return
+        stream = create()
+        endpoint = getattr(stream, "endpoint", None)
+        if endpoint is not None:
+            record["endpoint"] = endpoint.name
+        iterator = iter(stream)
+        first = next(iterator, None)
+    except Exception as e:
+        record["ttft"] = time.monotonic() - record["_start"]
+        record["outcome"] = "error"
+        record["error"] = type(e).__name__
+        if permit is not None:
+            permit.release()
+        events.put(("error", record, e))
+        return
+
+    record["ttft"] = time.monotonic() - record["_start"]
+    with race["lock"]:
+        won = race["winner"] is None
+        if won:
+            race["winner"] = record
+            race["winner_at"] = time.monotonic()
+    if won:
+        record["outcome"] = "won"
+        events.put(("first", record, (stream, iterator, first, permit)))
+        return
+
+    # 이미 다른 시도가 이겼으면 이 스트림은 바로 닫아서 과금을 멈춤
+    stream.close()
+    if permit is not None:
+        permit.release()
+    record["outcome"] = "lost"
+    if race["winner_at"] is not None:
+        saved = record["_start"] + record["ttft"] - race["winner_at"]
+        with _lock:
+            _stats["saved_ms"] += max(0.0, saved) * 1000
+
+
+def open_stream(create, label=None, request=None, limiter=None):
+    """Open a streamed chat completion with hedging and budgeted, jittered retries.
+
+    create() must return a new stream each time it is called. Returns a HedgedStream
+    whose first chunk has already arrived. The caller's rate-limiter permit covers the
+    primary attempt and its retries; a hedge runs only if the limiter admits it for
+    `request` (its messages and max_tokens) right away. `limiter` is the RateLimiter that
+    admitted the primary call when it is not the process-wide one (e.g. a batch run's).
+    """
+    _deposit()
+    started = time.monotonic()
+    events = queue.Queue()
+    race = {"lock": threading.Lock(), "winner": None, "winner_at": None}
+    attempts = []
+
+    def launch(kind, permit=None):
+        record = {"label": label, "kind": kind, "offset": time.monotonic() - started,
+                  "_start": time.monotonic(), "ttft": None, "outcome": "pending"}
+        attempts.append(record)
+        with _lock:
+            _stats["attempts"] += 1
+        _executor.submit(_run_attempt, create, record, events, race, permit)
+
+    def hedge_permit():
+        # 헤지도 요청 한 건이므로 한도에 여유가 있을 때만 보냄 (기다리지 않음)
+        if request is None:
+            return None
+        if limiter is not None:
+            permit = limiter.try_acquire(estimate_request_tokens(request["messages"], request.get("max_tokens")))
+        else:
+            permit = try_acquire_permit(request["messages"], request.get("max_tokens"))
+        if permit is None:
+            with _lock:
+                _stats["hedges_rate_limited"] += 1
+        return permit
+
+    launch("primary")
+    pending = 1
+    retries = 0
+    hedged = not HEDGE_ENABLED
+    deadline = time.monotonic() + hedge_delay()
+    try:
+        while True:
+            timeout = None if hedged else max(0.0, deadline - time.monotonic())
+            try:
+                kind, record, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                hedged = True
+                permit = hedge_permit()
+                if (request is None or permit is not None) and _withdraw():
+                    with _lock:
+                        _stats["hedges"] += 1
+                    launch("hedge", permit)
+                    pending += 1
+                elif permit is not None:
+                    permit.release()
+                continue
+
+            if kind == "first":
+                with _lock:
+                    _ttft_samples.append(record["ttft"])
+                    _latency_samples.append(race["winner_at"] - started)
+                    if record["kind"] == "hedge":
+                        _stats["hedge_wins"] += 1
+                stream, iterator, first, permit = payload
+                return HedgedStream(stream, iterator, first, attempts, permit)
+
+            pending -= 1
+            if pending:
+                continue  # 다른 시도가 아직 진행 중
+            if not _is_retryable(payload) or retries >= MAX_RETRIES or not _withdraw():
+                with _lock:
+                    _stats["failures"] += 1
+                raise payload
+            time.sleep(backoff_delay(retries))
+            retries += 1
+            with _lock:
+                _stats["retries"] += 1
+            launch("retry")
+            pending += 1
+            hedged = not HEDGE_ENABLED
+            deadline = time.monotonic() + hedge_delay()
+    finally:
+        # 실패/중단으로 빠져나가는 경우 늦게 도착하는 스트림도 닫히도록 표시
+        with race["lock"]:
+            if race["winner"] is None:
+                race["winner"] = "abandoned"
+        with _lock:
+            _attempt_log.extend(attempts)
+
+
+def call_with_retries(create):
+    """Non-streaming call with the same budgeted, jittered retries (no hedging)"""
+    _deposit()
+    retries = 0
+    while True:
+        try:
+            return create()
+        except Exception as e:
+            if not _is_retryable(e) or retries >= MAX_RETRIES or not _withdraw():
+                with _lock:
+                    _stats["failures"] += 1
+                raise
+            time.sleep(backoff_delay(retries))
+            retries += 1
+            with _lock:
+                _stats["retries"] += 1
+
+
+def get_hedge_stats():
+    """Return hedge / retry counts and first-token latency percentiles"""
+    with _lock:
+        stats = dict(_stats, retry_budget=round(_budget, 2))
+        latencies = list(_latency_samples)
+    stats["hedge_delay"] = round(hedge_delay(), 3)
+    stats["saved_ms"] = round(stats["saved_ms"])
+    # 헤지 비용 = 추가로 보낸 요청 수, 이득 = 진 시도보다 먼저 받은 시간(saved_ms)
+    stats["extra_attempts"] = stats["attempts"] - stats["requests"]
+    for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        stats[f"first_token_{name}_ms"] = round(_percentile(latencies, q) * 1000) if latencies else None
+    return stats
+
+
+def get_attempt_log(limit=100):
+    """Return the most recent per-attempt timing records"""
+    with _lock:
+        records = list(_attempt_log)[-limit:]
+    return [{k: v for k, v in record.items() if not k.startswith("_")} for record in records]
@@ -0,0 +1,103 @@
+import os
+import re
+import threading
+
+from prefix_cache import canonical_prompt
+from token_accounting import estimate_tokens, message_tokens
+
+# 요청 하나에 보낼 프롬프트 토큰 예산 (시스템 프롬프트 + 대화 기록 + 현재 질문)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# 예산과 상관없이 항상 그대로 보내는 최근 메시지 수
+HISTORY_KEEP_LAST = int(os.getenv("HISTORY_KEEP_LAST", "4"))
+# 잘라낸 오래된 턴을 요약해서 넣을 때 쓰는 토큰 수 (0이면 요약 없이 버림)
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "200"))
+
+_REQUEST_OVERHEAD = 2
+_SUMMARY_LINE_CHARS = 160
+_FIRST_SENTENCE_RE = re.compile(r"^(.+?[.!?。！？])(\s|$)", re.DOTALL)
+
+# 프로세스 전체 누적 통계
+_stats = {"requests": 0, "windowed": 0, "tokens_full": 0, "tokens_sent": 0, "tokens_saved": 0, "messages_dropped": 0}
+_stats_lock = threading.Lock()
+
+
+def summarize_dropped(messages, max_tokens=HISTORY_SUMMARY_TOKENS):
+    """Short extractive note (first sentence of each message) standing in for the dropped turns"""
+    lines = []
+    for msg in messages:
+        text = " ".join((msg.get("content") or "").split())
+        match = _FIRST_SENTENCE_RE.match(text)
+        if match:
+            text = match.group(1)
+        if len(text) > _SUMMARY_LINE_CHARS:
+            text = text[:_SUMMARY_LINE_CHARS].rstrip() + "…"
+        speaker = "User" if msg["role"] == "user" else "Assistant"
+        lines.append(f"- {speaker}: {text}")
+
+    header = "Summary of earlier turns in this conversation (older messages were omitted):"
+    # 요약이 예산을 넘으면 가장 오래된 줄부터 뺌
+    while lines and estimate_tokens(header + "\n" + "\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    if not lines:
+        return None
+    return header + "\n" + "\n".join(lines)
+
+
+def fit_history(system_prompt, history, prompt, budget=None, keep_last=None):
+    """Build [system, (summary), history..., user prompt] within the token budget.
+
+    The oldest history messages are dropped first; the current prompt and the last keep_last
+    messages are always sent verbatim. The system prompt is sent in its canonical form so the
+    provider's prompt-prefix cache can hit across sessions. Returns (messages, info) where info
+    has tokens_full / tokens_sent / tokens_saved / dropped.
+    """
+    budget = HISTORY_TOKEN_BUDGET if budget is None else budget
+    keep_last = HISTORY_KEEP_LAST if keep_last is None else keep_last
+
+    system = {"role": "system", "content": canonical_prompt(system_prompt)}
+    current = {"role": "user", "content": prompt}
+    fixed = message_tokens(system) + message_tokens(current) + _REQUEST_OVERHEAD
+    counts = [message_tokens(msg) for msg in history]
+    kept = sum(counts)
+    full = fixed + kept
+
+    start = 0
+    protected = max(0, len(history) - keep_last)
+    if budget and full > budget:
+        # 요약을 넣을 자리를 남겨 두고 오래된 메시지부터 뺌
+        limit = budget - HISTORY_SUMMARY_TOKENS
+        while start < protected and fixed + kept > limit:
+            kept -= counts[start]
+            start += 1
+        # 창이 어시스턴트 답변으로 시작하지 않도록 맞춤
+        while start < protected and history[start]["role"] != "user":
+            kept -= counts[start]
+            start += 1
+
+    messages = [system]
+    summary_tokens = 0
+    if start and HISTORY_SUMMARY_TOKENS:
+        summary = summarize_dropped(history[:start])
+        if summary:
+            note = {"role": "system", "content": summary}
+            summary_tokens = message_tokens(note)
+            messages.append(note)
+    messages.extend(history[start:])
+    messages.append(current)
+
+    sent = fixed + kept + summary_tokens
+    info = {"tokens_full": full, "tokens_sent": sent, "tokens_saved": max(0, full - sent), "dropped": start}
+    with _stats_lock:
+        _stats["requests"] += 1
+        _stats["windowed"] += 1 if start else 0
+        _stats["tokens_full"] += full
+        _stats["tokens_sent"] += sent
+        _stats["tokens_saved"] += info["tokens_saved"]
+        _stats["messages_dropped"] += start
+    return messages, info
+
+
+def get_window_stats():
+    """Return process-wide prompt token totals, including how many tokens the window saved"""
+    with _stats_lock:
+        return dict(_stats)
@@ -1,17 +1,40 @@
 import os
 import streamlit as st
-from openai import OpenAI
+from condition_config import get_sentence_budget
+from endpoint_router import get_router
+from generation_params import get_generation_params, record_latency
+from hedged_request import call_with_retries
+from history_window import fit_history
+from llm_client import get_shared_client
+from llm_sidecar import open_llm_stream
+from participant_claim import NOT_REGISTERED, TAKEN, claim_participant, is_valid_participant_id
+from prefix_cache import record_cached_tokens
+from response_cache import get_canned_turn
+from section_parser import SectionParser, parse_sections
+from sentence_budget import SentenceBudget, record_completion
+from rate_limiter import acquire_permit, usage_tokens
+from stream_mux import SCRIPT_INTERRUPTS, cancelled_messages, record_cancelled
+from stream_render import StreamRenderer
+from token_accounting import estimated_usage
 from dotenv import load_dotenv
 import json
 import glob
 import datetime  # For time measurement
 import time  # Add this import for time.sleep()
 import uuid
-from supabase import create_client, Client
+from supabase import Client
+from supabase_client import get_supabase
+from write_behind import get_write_behind, save_problem_message
+
+# prompts/debate/conditions.json의 조건 id
+CONDITION_ID = "kor2_t"
 
 # Load environment variables from .env file
 load_dotenv()
 
+# 한 번의 요청을 스트리밍으로 받아 두 말풍선에 나눠 표시 (0이면 기존 비스트리밍 방식)
+SINGLE_CALL_STREAMING = os.getenv("SINGLE_CALL_STREAMING", "1") != "0"
+
 # Page configuration
 st.set_page_config(
     page_title="Debate Chatbot",
@@ -37,13 +60,14 @@ if "system_message" not in st.session_state:
 각 캐릭터는 하나의 문단으로 자연스럽게 말하고, 반드시 정확히 4개의 문장을 사용해야 합니다.  
 말투는 친근하게 해주세요. 
 문장 수를 넘기거나 줄이지 말고, 이름을 본문에 포함시키지 마세요.  
+각 캐릭터의 답 앞에는 아래 형식처럼 [[PURPLI]], [[YELLOWY]] 구분자만 단독으로 한 줄에 써주세요.
 
 
 형식:
-Purpli  
+[[PURPLI]]
 죽은 반려동물을 복제하는 건 생명공학 기술로 원래 동물과 유전적으로 똑같은 새로운 동물을 만드는 거야. 많은 사람들에게 반려동물은 가족 같은 존재니까, 어떤 형태로든 다시 만날 수 있다는 생각 자체가 큰 위로가 될 수 있어. 요즘 기술이 많이 발달해서 복제도 현실적으로 가능한 선택지가 됐고. 또 어떤 사람들은 특별한 동물들, 예를 들어 안내견이나 경찰견 같은 아이들의 유전자를 복제를 통해 보존할 가치가 있다고 생각하기도 해.
 
-Yellowy  
+[[YELLOWY]]
 죽은 반려동물 복제는 꽤 복잡한 과정을 거쳐야 해. 보존된 조직에서 DNA를 추출하고, 배아를 만들어서 대리모에게 이식하는 과정이 필요하거든. 복제된 반려동물이 똑같이 생기고 같은 유전자를 가져도, 예전의 기억이나 성격은 똑같지 않을 거고, 상실감은 여전히 남을 수 있어. 그리고 입양을 기다리는 유기동물들이 정말 많은데, 복제보다는 그런 아이들을 돌보는 게 더 의미 있는 선택일 수도 있어."""
 
 if "usage_stats" not in st.session_state:
@@ -95,7 +119,10 @@ if "token_usage" not in st.session_state:
 # Supabase 클라이언트 초기화
 supabase_url = st.secrets["SUPABASE_URL"]
 supabase_key = st.secrets["SUPABASE_KEY"]
-supabase: Client = create_client(supabase_url, supabase_key)
+# 프로세스 전체에서 공유하는 클라이언트 (rerun마다 새로 만들지 않고 keep-alive 연결 재사용)
+supabase: Client = get_supabase(supabase_url, supabase_key)
+# 세션 데이터는 저널에 남긴 뒤 백그라운드에서 Supabase에 씀 (제출 버튼이 DB 응답을 기다리지 않음)
+write_behind = get_write_behind(supabase_url, supabase_key)
 
 # Usage time tracking function
 def update_session_time():
@@ -119,7 +146,7 @@ def update_session_time():
     st.session_state.interaction_count += 1
 
 def get_openai_client():
-    """Create and return an OpenAI client configured with environment variables"""
+    """Return the shared OpenAI client configured with environment variables"""
     token = os.getenv("GITHUB_TOKEN")
     endpoint = os.getenv("GITHUB_ENDPOINT", "https://models.github.ai/inference")
     
@@ -127,10 +154,8 @@ def get_openai_client():
         st.error("GitHub token not found in environment variables. Please check your .env file.")
         st.stop()
         
-    return OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
+    # 프로세스 전체에서 공유하는 클라이언트 (keep-alive 연결 재사용)
+    return get_shared_client(endpoint, token)
 
 # generate_debate_responses 함수 수정 (약 130-215줄 근처)
 def generate_debate_responses(prompt):
@@ -148,67 +173,138 @@ def generate_debate_responses(prompt):
             history.append(msg)
     
     # Prepare messages with the unified system prompt
-    messages = [{"role": "system", "content": st.session_state.system_message}] + history + [{"role": "user", "content": prompt}]
+    # 토큰 예산을 넘는 오래된 턴은 빼거나 요약 (시스템 프롬프트와 최근 턴은 그대로 유지)
+    messages, window = fit_history(st.session_state.system_message, history, prompt)
     
     try:
         # Display response in chat format
         status_placeholder = st.empty()
         status_placeholder.markdown("응답 생성 중...", unsafe_allow_html=True)
         
-        # Generate response with single API call (non-streaming first to debug)
-        response = client.chat.completions.create(
-            messages=messages,
-            model=model_name
-        )
-        
-        # Get the full response text
-        full_response = response.choices[0].message.content
-        
-        # Parse the response to extract Purpli and Yellowy parts
-        if "Purpli" in full_response and "Yellowy" in full_response:
-            # Split response by Yellowy
-            parts = full_response.split("Yellowy")
-            full_pro_response = parts[0].replace("Purpli", "").strip()
-            full_con_response = parts[1].strip()
-            
-            # Display responses
-            st.markdown(
-                f"<div class='pro-name'>Purpli</div><div class='pro-bubble'>{full_pro_response}</div>",
-                unsafe_allow_html=True
-            )
-            
-            st.markdown(
-                f"<div class='con-name'>Yellowy</div><div class='con-bubble'>{full_con_response}</div>",
-                unsafe_allow_html=True
-            )
-            
-            # Add responses to session state
-            st.session_state.messages.append({"role": "assistant", "content": full_pro_response, "type": "pro"})
-            st.session_state.messages.append({"role": "assistant", "content": full_con_response, "type": "con"})
-            
-            # Save usage statistics if available
-            if hasattr(response, 'usage'):
-                usage_dict = response.usage.model_dump() if hasattr(response.usage, 'model_dump') else response.usage.dict()
-                
-                st.session_state.usage_stats.append({
-                    "prompt_tokens": usage_dict.get("prompt_tokens", 0),
-                    "completion_tokens": usage_dict.get("completion_tokens", 0),
-                    "total_tokens": usage_dict.get("total_tokens", 0)
-                })
-            
-            # 턴 수 증가
-            st.session_state.current_turn += 1
+        # 두 말풍선 렌더러 (델타를 모아서 일정 간격으로만 다시 그림)
+        renderers = {
+            "pro": StreamRenderer(st.empty(), "<div class='pro-name'>Purpli</div><div class='pro-bubble'>{}</div>"),
+            "con": StreamRenderer(st.empty(), "<div class='con-name'>Yellowy</div><div class='con-bubble'>{}</div>"),
+        }
+        usage = None
+        # 조건별 생성 파라미터 (두 캐릭터를 한 번에 생성하므로 "dual" 설정, max_tokens는 지연 시간에 따라 조정될 수 있음)
+        generation = get_generation_params(CONDITION_ID, "dual")
+        
+        # 요청 한도를 넘으면 순서대로 기다림 (대기 순번을 상태 표시 자리에 표시)
+        permit = acquire_permit(messages, on_wait=lambda position: status_placeholder.markdown(
+            f"대기 중... (대기 순번 {position})" if position else "응답 생성 중...", unsafe_allow_html=True
+        ), max_tokens=generation.get("max_tokens"))
+        started = time.monotonic()
+        try:
+            if SINGLE_CALL_STREAMING:
+                # 한 번의 스트리밍 요청으로 받으면서 구분자 기준으로 두 말풍선에 바로 나눠 표시
+                # 엔드포인트는 라우터가 고르고, 첫 토큰이 늦으면 헤지 요청 / 연결 오류는 재시도 예산 안에서 재시도
+                request = {"messages": messages, "model": model_name, **generation, "stream": True, "stream_options": {'include_usage': True}}
+                response = open_llm_stream(client, request, "dual")
+                endpoint = response.endpoint
             
-            # Remove status display
-            status_placeholder.empty()
+                parser = SectionParser()
+                # 캐릭터별 문장 수 예산 (노랑이가 예산에 도달하면 스트림을 바로 닫음)
+                budgets = {
+                    section: SentenceBudget(limit)
+                    for section in ("pro", "con")
+                    if (limit := get_sentence_budget(CONDITION_ID, section))
+                }
+                try:
+                    for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            pieces = parser.feed(chunk.choices[0].delta.content)
+                            if pieces and not (renderers["pro"].text or renderers["con"].text):
+                                status_placeholder.empty()
+                            for section, text in pieces:
+                                if section in budgets:
+                                    text = budgets[section].feed(text)
+                                if text:
+                                    renderers[section].update(text)
+                            if "con" in budgets and budgets["con"].reached:
+                                response.close()
+                                break
+                    
+                        if chunk.usage:
+                            usage = chunk.usage
+                except SCRIPT_INTERRUPTS:
+                    # rerun/세션 종료로 중단되면 연결을 끊고 부분 응답을 cancelled 표시와 함께 기록
+                    response.close()
+                    partial = {"pro": renderers["pro"].text, "con": renderers["con"].text}
+                    record_cancelled([text for text in partial.values() if text])
+                    st.session_state.messages.extend(cancelled_messages(partial))
+                    raise
+                except BaseException:
+                    # 제공자 오류 등은 취소로 세지 않고 연결만 끊음
+                    response.close()
+                    raise
             
-            return True
-        else:
+                sections, ok = parser.finish()
+                if budgets:
+                    # 예산에 걸린 캐릭터는 잘린 본문을 그대로 사용
+                    for name, budget in budgets.items():
+                        if budget.reached:
+                            sections[name] = budget.text.strip()
+                    for name, budget in budgets.items():
+                        record_completion(name, budget.text, budget.reached)
+                    if usage is None:
+                        usage = estimated_usage(messages, sections["pro"] + "\n" + sections["con"])
+            else:
+                # 비스트리밍 모드: 전체 응답을 받은 뒤 한 번에 나눔
+                response, endpoint = call_with_retries(lambda: get_router().create(
+                    client, {"messages": messages, "model": model_name, **generation}, "dual"
+                ))
+                usage = getattr(response, 'usage', None)
+                full_response = response.choices[0].message.content
+                sections, ok = parse_sections(full_response)
+        finally:
+            # 미리 차감한 추정 토큰을 실제 usage로 정산
+            permit.release(usage_tokens(usage))
+        
+        # 요청부터 마지막 토큰까지 걸린 시간으로 max_tokens를 조정
+        record_latency(CONDITION_ID, "dual", time.monotonic() - started)
+        
+        # Remove status display
+        status_placeholder.empty()
+        
+        if not ok:
             # Handle malformed response
+            renderers["pro"].placeholder.empty()
+            renderers["con"].placeholder.empty()
             st.error("응답 형식이 올바르지 않습니다. 두 캐릭터의 응답을 찾을 수 없습니다.")
-            st.write("원본 응답:", full_response)
-            status_placeholder.empty()
+            st.write("원본 응답:", (sections["pro"] + "\n\n" + sections["con"]).strip())
             return False
+        
+        full_pro_response = sections["pro"]
+        full_con_response = sections["con"]
+        
+        # Display final responses (remove cursor)
+        renderers["pro"].finish(full_pro_response)
+        renderers["con"].finish(full_con_response)
+        
+        # Add responses to session state
+        # (이 턴에 실제로 쓴 생성 파라미터도 함께 기록해서 분석할 때 참가자별로 확인)
+        st.session_state.messages.append({"role": "assistant", "content": full_pro_response, "type": "pro", "generation": generation})
+        st.session_state.messages.append({"role": "assistant", "content": full_con_response, "type": "con", "generation": generation})
+        
+        # Save usage statistics if available
+        if usage:
+            usage_dict = usage.model_dump() if hasattr(usage, 'model_dump') else usage.dict()
+            
+            st.session_state.usage_stats.append({
+                "prompt_tokens": usage_dict.get("prompt_tokens", 0),
+                "completion_tokens": usage_dict.get("completion_tokens", 0),
+                "total_tokens": usage_dict.get("total_tokens", 0),
+                "history_tokens_saved": window["tokens_saved"],
+                "endpoint": endpoint,
+                # 프롬프트 접두사 캐시에서 처리된 토큰 수 (프로바이더가 알려준 경우)
+                "cached_tokens": record_cached_tokens(CONDITION_ID, usage)
+            })
+        
+        # 턴 수 증가
+        st.session_state.current_turn += 1
+        
+        return True
             
     except Exception as e:
         st.error(f"응답 생성 중 오류 발생: {str(e)}")
@@ -388,10 +484,14 @@ def save_to_supabase(score=None):
             total_prompt = sum(u["prompt_tokens"] for u in st.session_state.usage_stats)
             total_completion = sum(u["completion_tokens"] for u in st.session_state.usage_stats)
             total_tokens = sum(u["total_tokens"] for u in st.session_state.usage_stats)
+            # 캐시 토큰을 알려준 턴만 합산 (하나도 없으면 0이 아니라 NULL로 저장해서 적중률 계산에서 빠지도록)
+            reported_cached = [u["cached_tokens"] for u in st.session_state.usage_stats if u.get("cached_tokens") is not None]
+            total_cached = sum(reported_cached) if reported_cached else None
         else:
             total_prompt = 0
             total_completion = 0
             total_tokens = 0
+            total_cached = None
         
         # 저장할 데이터 준비 (테이블 구조에 맞게 조정)
         data = {
@@ -404,20 +504,22 @@ def save_to_supabase(score=None):
             "total_tokens": total_tokens,
             "prompt_tokens": total_prompt,
             "completion_tokens": total_completion,
+            "cached_tokens": total_cached,
+            "condition": CONDITION_ID,  # 조건별 캐시 적중률 리포트용
             "score": score,
             "messages": st.session_state.messages
         }
         
         # Supabase에 데이터 저장 (LLM2 테이블에 저장)
-        result = supabase.table("LLM2").insert(data).execute()
-        
-        # 저장 성공 여부 확인
-        if result.data:
-            return True
-        return False
+        # (로컬 스풀에 기록되면 바로 반환, 삽입은 백그라운드에서 재시도와 함께 처리)
+        write_behind.enqueue("LLM2", data)
+        # 로컬 스풀에는 저장됨. DB 기록이 계속 실패하고 있으면 대기 중인 행 수와 마지막 오류를 완료 페이지에 표시
+        st.session_state.save_problem = save_problem_message(write_behind.delivery_status())
+        return True
     
     except Exception as e:
         st.error(f"데이터 저장 중 오류 발생: {str(e)}")
+        st.session_state.save_problem = f"데이터 저장 중 오류 발생: {str(e)}"
         return False
 
 # 참가자 ID 검증 함수 수정 (약 495줄 근처)
@@ -433,29 +535,16 @@ def validate_participant_id(participant_id):
         if participant_id == "j719":
             return True, "관리자 접속 확인 완료"
         
-        # 형식 검사: a, b, c, d로 시작하고 뒤에 3자리 숫자 (001~100)
-        import re
-        if not re.match(r'^[a-d][0-9]{3}$', participant_id):
-            return False, "유효하지 않은 참가자 번호 형식입니다. a, b, c, d + 3자리 숫자 형식이어야 합니다. (예: a001)"
-        
-        # 숫자 부분이 001~100 범위인지 확인
-        num_part = int(participant_id[1:])
-        if num_part < 1 or num_part > 100:
-            return False, "유효하지 않은 참가자 번호입니다. 1~100 범위의 숫자만 허용됩니다."
-        
-        # Supabase에서 해당 ID 조회
-        result = supabase.table("participants").select("*").eq("id", participant_id).execute()
+        # 형식 검사: a, b, c, d로 시작하고 뒤에 001~100
+        if not is_valid_participant_id(participant_id):
+            return False, "유효하지 않은 참가자 번호 형식입니다. a, b, c, d + 001~100 형식이어야 합니다. (예: a001)"
         
-        # participants 테이블에 해당 ID가 없으면
-        if not result.data:
+        # 한 번의 왕복으로 ID 점유 (같은 번호를 동시에 입력해도 한 명만 통과)
+        status = claim_participant(supabase, participant_id)
+        if status == NOT_REGISTERED:
             return False, "등록되지 않은 참가자 번호입니다."
-        
-        # ID가 이미 사용되었는지 확인
-        if result.data[0].get("used", False):
+        if status == TAKEN:
             return False, "이미 사용된 참가자 번호입니다."
-        
-        # 유효한 ID가 있으면 사용 상태 업데이트
-        supabase.table("participants").update({"used": True, "used_at": datetime.datetime.now().isoformat()}).eq("id", participant_id).execute()
         return True, "참가자 확인 완료"
     
     except Exception as e:
@@ -629,16 +718,20 @@ def show_chat_page():
                             st.session_state.interaction_start = datetime.datetime.now()
                             
                             st.session_state.conversation_started = True
-                            st.session_state.current_turn = 1
                             user_prompt = "퍼플아, 노랑아, 죽은 반려동물의 복제에 대해 알려줄래?"
                             st.session_state.messages.append({"role": "user", "content": user_prompt})
                             
-                            # 고정된 첫 응답 (한국어)
-                            purpli_response = "반려동물 복제는 생명공학 기술을 활용해 반려동물과 유전적으로 동일한 새로운 개체를 만들어내는 과정이야. 솔직히 반려동물은 가족 같은 존재라서, 어떤 형태로든 다시 만날 수 있다면 얼마나 좋을까 싶어. 요즘은 기술도 좋아졌으니까, 복제도 충분히 가능한 시대잖아. 특히 경찰견이나 안내견처럼 특별한 능력을 가진 동물의 유전자라면 복제할 필요도 있다고 생각해."
-                            yellowy_response = "생명을 복제한다는 것 자체가 단순한 과정으로 이루어지진 않아. 추출된 DNA를 바탕으로 수정란을 형성한 뒤 대리모를 통해 새끼를 출산하게 돼. 게다가 복제를 해서 외모나 유전자가 같아도 기억이나 성격까지 똑같을 순 없고, 결국 그리움은 남을 것 같아. 지금도 입양 기다리는 유기동물이 많은데, 복제보단 그런 아이들을 보살피는게 더 좋은 방향이라고 생각해."
-                            
-                            st.session_state.messages.append({"role": "assistant", "content": purpli_response, "type": "pro"})
-                            st.session_state.messages.append({"role": "assistant", "content": yellowy_response, "type": "con"})
+                            # 고정된 첫 응답 (prompts/debate/conditions.json의 canned_turns)
+                            canned = get_canned_turn(CONDITION_ID, user_prompt)
+                            if canned:
+                                st.session_state.current_turn = 1
+                                purpli_response = canned["pro"]
+                                yellowy_response = canned["con"]
+                                st.session_state.messages.append({"role": "assistant", "content": purpli_response, "type": "pro"})
+                                st.session_state.messages.append({"role": "assistant", "content": yellowy_response, "type": "con"})
+                            else:
+                                # 설정된 첫 응답이 없으면 API로 생성
+                                generate_debate_responses(user_prompt)
                             
                             st.rerun()
                 i += 1
@@ -728,9 +821,6 @@ def show_survey_page():
             else:
                 st.warning("피드백이 저장되었지만, 데이터베이스 저장에 문제가 있었습니다.")
             
-            # 일정 시간 후 완료 페이지로 이동
-            time.sleep(2)
-            
             # 완료 페이지로 이동
             st.session_state.app_state = "complete"
             st.rerun()
@@ -746,6 +836,9 @@ def show_complete_page():
     
     with col2:
         st.markdown("### 실험이 완료되었습니다.")
+        # 제출 직후의 저장 경고는 rerun으로 사라지므로 여기서 다시 보여줌
+        if st.session_state.get("save_problem"):
+            st.warning(st.session_state.save_problem)
         st.markdown("구글폼에서 설문을 완료해주세요. 참여해주셔서 감사합니다.")
         
         # 다시 시작 버튼 (선택적)
@@ -0,0 +1,77 @@
+import os
+import threading
+
+import httpx
+from openai import OpenAI
+
+# Streamlit은 스크립트를 매 rerun마다 다시 실행하지만 import된 모듈은 프로세스에 남아 있으므로
+# 여기에 만든 클라이언트는 모든 세션과 rerun에서 공유된다.
+_clients = {}
+_clients_lock = threading.Lock()
+_stats = {"clients_created": 0, "client_requests": 0}
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def get_pool_config():
+    """Return the connection pool limits and timeouts (overridable with environment variables)"""
+    return {
+        "max_connections": _env_int("OPENAI_POOL_MAX_CONNECTIONS", 100),
+        "max_keepalive_connections": _env_int("OPENAI_POOL_MAX_KEEPALIVE", 40),
+        "keepalive_expiry": _env_float("OPENAI_POOL_KEEPALIVE_EXPIRY", 60.0),
+        "connect_timeout": _env_float("OPENAI_CONNECT_TIMEOUT", 5.0),
+        "read_timeout": _env_float("OPENAI_READ_TIMEOUT", 60.0),
+        # 재시도는 hedged_request가 전체 재시도 예산 안에서 처리 (SDK 자체 재시도는 기본으로 끔)
+        "max_retries": _env_int("OPENAI_MAX_RETRIES", 0),
+    }
+
+
+def _build_http_client(config):
+    limits = httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive_connections"],
+        keepalive_expiry=config["keepalive_expiry"],
+    )
+    timeout = httpx.Timeout(config["read_timeout"], connect=config["connect_timeout"])
+    return httpx.Client(limits=limits, timeout=timeout)
+
+
+def get_shared_client(base_url, api_key):
+    """Return the process-wide OpenAI client for this endpoint, creating it on first use"""
+    key = (base_url, api_key)
+    with _clients_lock:
+        _stats["client_requests"] += 1
+        client = _clients.get(key)
+        if client is None:
+            config = get_pool_config()
+            client = OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                max_retries=config["max_retries"],
+                http_client=_build_http_client(config),
+            )
+            _clients[key] = client
+            _stats["clients_created"] += 1
+        return client
+
+
+def get_client_stats():
+    """Return how many clients were built versus how many times one was requested"""
+    with _clients_lock:
+        return dict(_stats, clients_alive=len(_clients))
+
+
+def close_shared_clients():
+    """Close every pooled client (used by benchmarks and at interpreter shutdown)"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
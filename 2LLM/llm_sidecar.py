@@ -0,0 +1,386 @@
+"""Optional sidecar process that owns the LLM clients and streams deltas back to the apps.
+
+Without LLM_SIDECAR_ADDRESS every app calls the provider from its own threads (open_llm_stream
+falls through to hedged_request.open_stream). With it, the apps send each request to this process
+over a local socket and read the chunks back, so LLM concurrency is sized here and not by the
+number of Streamlit sessions. A generation keeps running when its app process goes away; the
+chunks stay buffered for LLM_SIDECAR_RESULT_TTL seconds and can be re-attached by job id.
+
+    LLM_SIDECAR_ADDRESS=127.0.0.1:8765 LLM_SIDECAR_AUTHKEY=secret GITHUB_TOKEN=... python 2LLM/llm_sidecar.py
+
+The sidecar only listens on loopback or a Unix socket, refuses to run without an authkey, and
+holds its own keys for the endpoints the apps use (the apps' secrets.toml and GITHUB_* variables).
+Apps send the request body and their client's base URL, never credentials; a request for an
+endpoint the sidecar has no key for, or one it does not answer in time, runs in the app instead.
+"""
+import logging
+import os
+import threading
+import tomllib
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+from openai.types.chat import ChatCompletionChunk
+
+from endpoint_router import get_router
+from hedged_request import open_stream
+from llm_client import get_shared_client
+
+# "host:port" 또는 유닉스 소켓 경로 (비어 있으면 사이드카를 쓰지 않고 앱 안에서 호출)
+LLM_SIDECAR_ADDRESS = os.getenv("LLM_SIDECAR_ADDRESS", "")
+# 연결 인증 키 (필수: 인증 없이 받은 메시지는 pickle로 풀리므로 키가 없으면 서버도 앱도 연결하지 않음)
+LLM_SIDECAR_AUTHKEY = os.getenv("LLM_SIDECAR_AUTHKEY", "")
+# 루프백이 아닌 주소에서 받으려면 명시적으로 켜야 함
+LLM_SIDECAR_ALLOW_REMOTE = os.getenv("LLM_SIDECAR_ALLOW_REMOTE", "0") == "1"
+# 사이드카가 직접 쓰는 제공자 설정 (앱이 보내는 키는 받지 않음, 앱과 같은 설정에서 읽음)
+LLM_SIDECAR_BASE_URL = os.getenv("LLM_SIDECAR_BASE_URL", "")
+LLM_SIDECAR_API_KEY = os.getenv("LLM_SIDECAR_API_KEY", "")
+# app.py / app2.py 등이 st.secrets로 읽는 파일 (OPENAI_API_BASE, OPENAI_API_KEY)
+LLM_SIDECAR_SECRETS = os.getenv("LLM_SIDECAR_SECRETS", os.path.join(".streamlit", "secrets.toml"))
+# 사이드카의 응답(시작/다음 청크)을 기다리는 최대 시간(초), 넘으면 앱 안에서 호출
+LLM_SIDECAR_TIMEOUT = float(os.getenv("LLM_SIDECAR_TIMEOUT", "60"))
+LLM_SIDECAR_WORKERS = int(os.getenv("LLM_SIDECAR_WORKERS", "64"))
+# 앱이 연결을 잃은 뒤에도 결과를 보관하는 시간(초)
+LLM_SIDECAR_RESULT_TTL = float(os.getenv("LLM_SIDECAR_RESULT_TTL", "120"))
+
+logger = logging.getLogger(__name__)
+
+
+class SidecarError(Exception):
+    """An error raised inside the sidecar, re-raised in the app with the original type name"""
+
+
+class SidecarUnavailable(SidecarError):
+    """The sidecar did not answer in time or has no key for the app's endpoint"""
+
+
+_LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+def _address(value):
+    host, sep, port = value.rpartition(":")
+    if sep and port.isdigit():
+        return (host.strip("[]") or "127.0.0.1", int(port))
+    return value  # 유닉스 소켓 경로
+
+
+def _base_url(value):
+    return str(value).rstrip("/")
+
+
+def provider_credentials():
+    """[(base_url, api_key)] the sidecar serves, read from the same settings the apps use"""
+    credentials = []
+    if LLM_SIDECAR_BASE_URL and LLM_SIDECAR_API_KEY:
+        credentials.append((LLM_SIDECAR_BASE_URL, LLM_SIDECAR_API_KEY))
+    try:
+        with open(LLM_SIDECAR_SECRETS, 'rb') as f:
+            secrets = tomllib.load(f)
+        if secrets.get("OPENAI_API_BASE") and secrets.get("OPENAI_API_KEY"):
+            credentials.append((secrets["OPENAI_API_BASE"], secrets["OPENAI_API_KEY"]))
+    except FileNotFoundError:
+        pass
+    except tomllib.TOMLDecodeError as e:
+        logger.warning("could not read %s: %s", LLM_SIDECAR_SECRETS, e)
+    if os.getenv("GITHUB_TOKEN"):
+        credentials.append((os.getenv("GITHUB_ENDPOINT", "https://models.github.ai/inference"), os.getenv("GITHUB_TOKEN")))
+    return credentials
+
+
+def _authkey():
+    if not LLM_SIDECAR_AUTHKEY:
+        raise SidecarError("LLM_SIDECAR_AUTHKEY is not set; the sidecar will not run or accept connections without it")
+    return LLM_SIDECAR_AUTHKEY.encode()
+
+
+# ---------------------------------------------------------------------------
+# 사이드카 프로세스 쪽
+# ---------------------------------------------------------------------------
+
+class _Job:
+    """One generation running in the sidecar; chunks are buffered so a client can (re)attach at any offset"""
+
+    def __init__(self, job_id, label):
+        self.id = job_id
+        self.label = label
+        self.chunks = []
+        self.endpoint = None
+        self.started = False
+        self.finished = False
+        self.error = None
+        self.cancelled = False
+        self.attached = 0
+        self.finished_at = None
+        self.cond = threading.Condition()
+
+    def run(self, client, request):
+        try:
+            stream = open_stream(
+                lambda: get_router().create_stream(client, request, self.label), label=self.label, request=request
+            )
+            with self.cond:
+                self.endpoint = stream.endpoint
+                self.started = True
+                self.cond.notify_all()
+            for chunk in stream:
+                if self.cancelled:
+                    stream.close()
+                    break
+                with self.cond:
+                    self.chunks.append(chunk.model_dump(exclude_unset=True))
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = (type(e).__name__, str(e))
+        finally:
+            with self.cond:
+                self.finished = True
+                self.finished_at = time.monotonic()
+                self.cond.notify_all()
+
+
+class SidecarServer:
+    """Accept app connections and run their streams on a bounded worker pool"""
+
+    def __init__(self, address=LLM_SIDECAR_ADDRESS, workers=LLM_SIDECAR_WORKERS, providers=None):
+        self.authkey = _authkey()
+        self.address = _address(address)
+        if isinstance(self.address, tuple) and self.address[0] not in _LOOPBACK_HOSTS and not LLM_SIDECAR_ALLOW_REMOTE:
+            raise SidecarError(
+                f"refusing to listen on {self.address[0]}; use 127.0.0.1, a Unix socket or LLM_SIDECAR_ALLOW_REMOTE=1"
+            )
+        if providers is None:
+            providers = provider_credentials()
+        if not providers:
+            raise SidecarError(
+                f"no provider credentials: set OPENAI_API_BASE/OPENAI_API_KEY in {LLM_SIDECAR_SECRETS}, "
+                "GITHUB_TOKEN or LLM_SIDECAR_BASE_URL/LLM_SIDECAR_API_KEY"
+            )
+        # 엔드포인트(base URL)마다 사이드카 자신의 키로 만든 클라이언트 (먼저 나온 설정이 우선)
+        self.clients = {}
+        for base_url, api_key in providers:
+            self.clients.setdefault(_base_url(base_url), get_shared_client(base_url, api_key))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sidecar-llm")
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.stats = {"jobs": 0, "cancelled": 0, "detached": 0, "reattached": 0, "errors": 0}
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            logger.info("LLM sidecar listening on %s", self.address)
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:  # 인증 실패 등은 해당 연결만 버림
+                    logger.warning("rejected sidecar connection: %s", e)
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True, name="sidecar-conn").start()
+
+    def _purge(self):
+        now = time.monotonic()
+        with self.lock:
+            for job_id, job in list(self.jobs.items()):
+                if job.finished and not job.attached and now - job.finished_at > LLM_SIDECAR_RESULT_TTL:
+                    del self.jobs[job_id]
+
+    def _handle(self, conn):
+        try:
+            message = conn.recv()
+            op = message.get("op")
+            if op == "stream":
+                client = self.clients.get(message.get("base_url"))
+                if client is None:
+                    # 앱과 다른 엔드포인트나 키로 보내지 않도록 앱이 직접 호출하게 함
+                    conn.send(("error", "EndpointMismatch", f"the sidecar has no key for {message.get('base_url')}"))
+                    return
+                self._purge()
+                job = _Job(message["job_id"], message.get("label"))
+                with self.lock:
+                    self.jobs[job.id] = job
+                    self.stats["jobs"] += 1
+                self.executor.submit(job.run, client, message["request"])
+                self._send_job(conn, job, 0)
+            elif op == "attach":
+                with self.lock:
+                    job = self.jobs.get(message["job_id"])
+                    if job is not None:
+                        self.stats["reattached"] += 1
+                if job is None:
+                    conn.send(("error", "KeyError", f"unknown sidecar job {message['job_id']}"))
+                else:
+                    self._send_job(conn, job, message.get("offset", 0))
+            elif op == "stats":
+                conn.send(("stats", self.get_stats()))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _send_job(self, conn, job, offset):
+        """Forward a job's chunks from offset until it ends, the client cancels or the connection drops"""
+        with job.cond:
+            job.attached += 1
+        try:
+            with job.cond:
+                job.cond.wait_for(lambda: job.started or job.finished)
+            if job.started:
+                conn.send(("start", job.id, job.endpoint))
+            while True:
+                with job.cond:
+                    job.cond.wait_for(lambda: len(job.chunks) > offset or job.finished, timeout=0.5)
+                    chunks = job.chunks[offset:]
+                    finished = job.finished
+                for chunk in chunks:
+                    conn.send(("chunk", chunk))
+                offset += len(chunks)
+                if conn.poll() and conn.recv().get("op") == "cancel":
+                    job.cancelled = True
+                    with self.lock:
+                        self.stats["cancelled"] += 1
+                    return
+                if finished and offset >= len(job.chunks):
+                    if job.error is not None:
+                        with self.lock:
+                            self.stats["errors"] += 1
+                        conn.send(("error",) + job.error)
+                    else:
+                        conn.send(("end",))
+                    return
+        except (EOFError, OSError):
+            # 앱 프로세스가 사라짐: 생성은 계속하고 결과는 TTL 동안 보관 (attach로 이어받을 수 있음)
+            with self.lock:
+                self.stats["detached"] += 1
+        finally:
+            with job.cond:
+                job.attached -= 1
+
+    def get_stats(self):
+        with self.lock:
+            running = sum(1 for job in self.jobs.values() if not job.finished)
+            return dict(self.stats, running=running, buffered=len(self.jobs))
+
+
+# ---------------------------------------------------------------------------
+# 앱 쪽
+# ---------------------------------------------------------------------------
+
+class SidecarStream:
+    """Chat completion stream read from the sidecar; iterates like the OpenAI stream it proxies"""
+
+    def __init__(self, conn, job_id, endpoint):
+        self._conn = conn
+        self.job_id = job_id
+        self.endpoint = endpoint
+        self.received = 0
+
+    def __iter__(self):
+        while True:
+            message = _recv(self._conn)
+            if message[0] == "chunk":
+                self.received += 1
+                yield ChatCompletionChunk.model_validate(message[1])
+            elif message[0] == "end":
+                self._conn.close()
+                return
+            elif message[0] == "error":
+                self._conn.close()
+                raise SidecarError(f"{message[1]}: {message[2]}")
+
+    def close(self):
+        """Stop the generation in the sidecar"""
+        if not self._conn.closed:
+            try:
+                self._conn.send({"op": "cancel"})
+            except OSError:
+                pass
+            self._conn.close()
+
+
+def _recv(conn):
+    """conn.recv() with the LLM_SIDECAR_TIMEOUT deadline, so a hung sidecar cannot block the script thread"""
+    if not conn.poll(LLM_SIDECAR_TIMEOUT):
+        try:
+            conn.send({"op": "cancel"})
+        except OSError:
+            pass
+        conn.close()
+        raise SidecarUnavailable(f"no reply from the sidecar in {LLM_SIDECAR_TIMEOUT:g}s")
+    return conn.recv()
+
+
+def _connect(message):
+    conn = Client(_address(LLM_SIDECAR_ADDRESS), authkey=_authkey())
+    conn.send(message)
+    reply = _recv(conn)
+    if reply[0] == "error":
+        conn.close()
+        error = SidecarUnavailable if reply[1] == "EndpointMismatch" else SidecarError
+        raise error(f"{reply[1]}: {reply[2]}")
+    return conn, reply
+
+
+_unreachable_logged = False
+
+
+def open_llm_stream(client, request, label=None, limiter=None):
+    """Open a routed, hedged chat completion stream, in the sidecar when LLM_SIDECAR_ADDRESS is set.
+
+    Returns after the first chunk has arrived, like hedged_request.open_stream. If the sidecar
+    cannot be reached (or no authkey is set), does not start the stream within LLM_SIDECAR_TIMEOUT
+    or has no key for client's endpoint, the call runs in this process instead. The sidecar uses
+    its own credentials for client.base_url; the key is never sent. With a
+    `limiter` (a caller's own RateLimiter, e.g. batch_runner's) the call always runs in-process,
+    so its hedges are admitted by that limiter rather than the sidecar's.
+    """
+    global _unreachable_logged
+    if limiter is not None:
+        pass  # 사이드카는 호출자의 한도를 모름
+    elif LLM_SIDECAR_ADDRESS and not LLM_SIDECAR_AUTHKEY:
+        if not _unreachable_logged:
+            _unreachable_logged = True
+            logger.warning("LLM_SIDECAR_AUTHKEY is not set, not connecting to the sidecar; calling the provider in-process")
+    elif LLM_SIDECAR_ADDRESS:
+        job_id = uuid.uuid4().hex
+        try:
+            conn, (_, job_id, endpoint) = _connect({
+                "op": "stream", "job_id": job_id, "label": label, "request": request,
+                "base_url": _base_url(client.base_url),
+            })
+            return SidecarStream(conn, job_id, endpoint)
+        except (ConnectionRefusedError, FileNotFoundError) as e:
+            if not _unreachable_logged:
+                _unreachable_logged = True
+                logger.warning("LLM sidecar unreachable (%s), calling the provider in-process", e)
+        except SidecarUnavailable as e:
+            logger.warning("LLM sidecar did not take %s (%s), calling the provider in-process", label, e)
+    return open_stream(lambda: get_router().create_stream(client, request, label), label=label, request=request, limiter=limiter)
+
+
+def attach_stream(job_id, offset=0):
+    """Re-attach to a sidecar job (e.g. after the app restarted) and read its chunks from offset"""
+    conn, (_, job_id, endpoint) = _connect({"op": "attach", "job_id": job_id, "offset": offset})
+    return SidecarStream(conn, job_id, endpoint)
+
+
+def get_sidecar_stats():
+    """Return job / cancel / detach counts from the running sidecar (None when it is not configured)"""
+    if not LLM_SIDECAR_ADDRESS:
+        return None
+    conn = Client(_address(LLM_SIDECAR_ADDRESS), authkey=_authkey())
+    try:
+        conn.send({"op": "stats"})
+        return _recv(conn)[1]
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not LLM_SIDECAR_ADDRESS:
+        raise SystemExit("set LLM_SIDECAR_ADDRESS (127.0.0.1:port or socket path)")
+    try:
+        server = SidecarServer()
+    except SidecarError as e:
+        raise SystemExit(str(e))
+    server.serve_forever()
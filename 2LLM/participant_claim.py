@@ -0,0 +1,84 @@
+"""Atomic participant ID claim in one Supabase round trip.
+
+claim_participant() calls the claim_participant SQL function (claim_participant.sql), which
+claims the ID with a single conditional UPDATE, or with an INSERT ... ON CONFLICT DO NOTHING
+for the apps that register IDs on first use. Two students typing the same ID at once can no
+longer both pass, and a login costs one request instead of a select followed by a write.
+"""
+import datetime
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+CLAIMED = "claimed"
+TAKEN = "taken"
+NOT_REGISTERED = "not_registered"
+
+# a001 ~ d100 (a, b, c, d + 001~100)
+PARTICIPANT_ID_RE = re.compile(r"^[a-d](?:0(?:0[1-9]|[1-9][0-9])|100)$")
+
+logger = logging.getLogger(__name__)
+
+_latencies = deque(maxlen=200)
+_stats = {CLAIMED: 0, TAKEN: 0, NOT_REGISTERED: 0, "legacy": 0}
+_lock = threading.Lock()
+_rpc_missing = False  # 한 번 확인되면 프로세스가 끝날 때까지 예전 방식만 사용
+
+
+def is_valid_participant_id(participant_id):
+    return PARTICIPANT_ID_RE.match(participant_id) is not None
+
+
+def _claim_legacy(client, participant_id, register):
+    # claim_participant 함수가 아직 DB에 없을 때의 예전 방식 (두 번 왕복, 동시 입력은 막지 못함)
+    table = client.table("participants")
+    result = table.select("*").eq("id", participant_id).execute()
+    if register:
+        if result.data:
+            return TAKEN
+        table.insert({"id": participant_id, "created_at": datetime.datetime.now().isoformat()}).execute()
+        return CLAIMED
+    if not result.data:
+        return NOT_REGISTERED
+    if result.data[0].get("used", False):
+        return TAKEN
+    table.update({"used": True, "used_at": datetime.datetime.now().isoformat()}).eq("id", participant_id).execute()
+    return CLAIMED
+
+
+def claim_participant(client, participant_id, register=False):
+    """Mark an ID as used and return CLAIMED, TAKEN or NOT_REGISTERED.
+
+    With register=True an unknown ID is inserted and claimed (the apps without a prepared ID list),
+    so NOT_REGISTERED is never returned.
+    """
+    global _rpc_missing
+    started = time.monotonic()
+    legacy = _rpc_missing
+    if not legacy:
+        try:
+            status = client.rpc("claim_participant", {"p_id": participant_id, "p_register": register}).execute().data
+        except Exception as e:
+            if getattr(e, "code", None) != "PGRST202":  # PGRST202: 함수를 찾을 수 없음
+                raise
+            logger.warning("claim_participant() is not installed, run 2LLM/claim_participant.sql; using select + write")
+            _rpc_missing = legacy = True
+    if legacy:
+        status = _claim_legacy(client, participant_id, register)
+    with _lock:
+        _latencies.append(time.monotonic() - started)
+        _stats[status] += 1
+        _stats["legacy"] += legacy
+    return status
+
+
+def get_claim_stats():
+    """Return claim outcomes and the login round-trip latency (p50/p95)"""
+    with _lock:
+        ordered = sorted(_latencies)
+        stats = dict(_stats)
+    stats["p50_ms"] = round(ordered[len(ordered) // 2] * 1000) if ordered else None
+    stats["p95_ms"] = round(ordered[max(0, int(len(ordered) * 0.95) - 1)] * 1000) if ordered else None
+    return stats
@@ -0,0 +1,66 @@
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+
+# 프로바이더의 프롬프트 접두사 캐시는 앞부분이 바이트 단위로 같아야 적중함
+# 시스템 프롬프트를 항상 같은 형태로 만들어서 세션마다 공백/줄바꿈이 달라지지 않게 함
+_TRAILING_SPACE_RE = re.compile(r"[ \t]+$", re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+_stats = {}  # condition id -> {"calls", "reported", "prompt_tokens", "cached_tokens"}
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=256)
+def canonical_prompt(text):
+    """Byte-stable form of a system prompt: NFC, \\n line ends, no trailing or shared indentation, single blank lines"""
+    text = unicodedata.normalize("NFC", text or "").replace("\r\n", "\n").replace("\r", "\n")
+    text = _TRAILING_SPACE_RE.sub("", text).expandtabs(4)
+    first, _, rest = text.partition("\n")
+    # 첫 줄 뒤의 줄들이 공통으로 들여쓰기된 경우 (코드 안의 삼중 따옴표 문자열) 제거
+    lines = rest.split("\n")
+    indents = [len(line) - len(line.lstrip(" ")) for line in lines if line.strip()]
+    indent = min(indents) if indents else 0
+    if indent:
+        lines = [line[indent:] for line in lines]
+    text = "\n".join([first] + lines) if rest else first
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
+
+
+def cached_tokens(usage):
+    """usage.prompt_tokens_details.cached_tokens, or None when the provider did not report it"""
+    details = getattr(usage, "prompt_tokens_details", None) if usage is not None else None
+    return getattr(details, "cached_tokens", None) if details is not None else None
+
+
+def record_cached_tokens(condition_id, *usages):
+    """Account one turn's usage objects for a condition; returns the turn's cached prompt tokens.
+
+    Returns None when no usage reported cached tokens, so the saved row stays NULL (not 0) and
+    prefix_cache_report leaves it out of the hit ratio.
+    """
+    total = None
+    with _lock:
+        stats = _stats.setdefault(condition_id, {"calls": 0, "reported": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        for usage in usages:
+            if usage is None:
+                continue
+            stats["calls"] += 1
+            cached = cached_tokens(usage)
+            if cached is None:
+                continue  # 로컬 추정 usage 또는 캐시 정보를 주지 않는 프로바이더
+            stats["reported"] += 1
+            stats["prompt_tokens"] += usage.prompt_tokens or 0
+            stats["cached_tokens"] += cached
+            total = (total or 0) + cached
+    return total
+
+
+def get_prefix_cache_stats():
+    """Return cached / prompt tokens and the hit ratio per condition (only calls that reported it)"""
+    with _lock:
+        stats = {cid: dict(s) for cid, s in _stats.items()}
+    for s in stats.values():
+        s["hit_ratio"] = round(s["cached_tokens"] / s["prompt_tokens"], 3) if s["prompt_tokens"] else 0.0
+    return stats
@@ -0,0 +1,77 @@
+"""Report the prompt-prefix cache hit ratio per experiment condition from the saved Supabase rows.
+
+Reads SUPABASE_URL / SUPABASE_KEY from the environment (or .env). Rows saved before the
+condition column existed are grouped under their table name.
+
+    python 2LLM/prefix_cache_report.py --table LLM2 --table LLM2_R
+"""
+import argparse
+import os
+from collections import defaultdict
+
+from dotenv import load_dotenv
+from supabase import create_client
+
+DEFAULT_TABLES = ("LLM1", "LLM1_R", "LLM2", "LLM2_R")
+PAGE_SIZE = 1000
+
+
+def fetch_rows(client, table):
+    """All rows of a table (paged), only the columns the report needs"""
+    rows = []
+    start = 0
+    while True:
+        result = (
+            client.table(table)
+            .select("condition, prompt_tokens, cached_tokens")
+            .range(start, start + PAGE_SIZE - 1)
+            .execute()
+        )
+        rows.extend(result.data)
+        if len(result.data) < PAGE_SIZE:
+            return rows
+        start += PAGE_SIZE
+
+
+def summarize(rows_by_table):
+    """{condition: {"sessions", "reported", "prompt_tokens", "cached_tokens", "hit_ratio"}}"""
+    report = defaultdict(lambda: {"sessions": 0, "reported": 0, "prompt_tokens": 0, "cached_tokens": 0})
+    for table, rows in rows_by_table.items():
+        for row in rows:
+            entry = report[row.get("condition") or table]
+            entry["sessions"] += 1
+            if row.get("cached_tokens") is None:
+                continue  # 캐시 토큰을 기록하기 전에 저장된 행
+            entry["reported"] += 1
+            entry["prompt_tokens"] += row.get("prompt_tokens") or 0
+            entry["cached_tokens"] += row["cached_tokens"]
+    for entry in report.values():
+        entry["hit_ratio"] = entry["cached_tokens"] / entry["prompt_tokens"] if entry["prompt_tokens"] else 0.0
+    return dict(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--table", action="append", help="Supabase table to read (default: %s)" % ", ".join(DEFAULT_TABLES))
+    args = parser.parse_args()
+
+    load_dotenv()
+    url = os.getenv("SUPABASE_URL")
+    key = os.getenv("SUPABASE_KEY")
+    if not url or not key:
+        parser.error("SUPABASE_URL and SUPABASE_KEY must be set")
+    client = create_client(url, key)
+
+    rows_by_table = {table: fetch_rows(client, table) for table in args.table or DEFAULT_TABLES}
+    report = summarize(rows_by_table)
+
+    print(f"{'condition':<12} {'sessions':>8} {'reported':>8} {'prompt':>10} {'cached':>10} {'hit ratio':>9}")
+    for condition, entry in sorted(report.items()):
+        print(
+            f"{condition:<12} {entry['sessions']:>8} {entry['reported']:>8} "
+            f"{entry['prompt_tokens']:>10} {entry['cached_tokens']:>10} {entry['hit_ratio']:>9.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
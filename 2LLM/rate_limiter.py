@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+from collections import deque
+
+from token_accounting import estimate_prompt_tokens
+
+# 모든 세션이 같은 API 키를 쓰므로 프로세스 전체에서 한도를 나눠 씀 (0이면 제한 없음)
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "0"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "0"))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "0"))
+# 요청 전에 미리 차감하는 응답 토큰 수 (max_tokens가 없을 때), 끝난 뒤 실제 usage로 정산
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "400"))
+
+_MAX_WAIT_SLICE = 0.5  # 대기 중 순번을 다시 알려주는 간격(초)
+
+
+def estimate_request_tokens(messages, max_tokens=None):
+    """Tokens to debit before a call: the prompt plus the expected (or maximum) completion"""
+    return estimate_prompt_tokens(messages) + (max_tokens or LLM_EXPECTED_COMPLETION_TOKENS)
+
+
+class Permit:
+    """One admitted request; release it with the real token count once the call is over"""
+
+    def __init__(self, limiter, tokens):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.waited = 0.0
+        self.queue_position = 0
+        self._released = False
+
+    def release(self, actual_tokens=None):
+        if not self._released:
+            self._released = True
+            self.limiter._release(self, actual_tokens)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class RateLimiter:
+    """Token buckets for requests/min and tokens/min plus an in-flight cap, served in FIFO order"""
+
+    def __init__(self, rpm=LLM_RPM_LIMIT, tpm=LLM_TPM_LIMIT, max_in_flight=LLM_MAX_IN_FLIGHT):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_in_flight = max_in_flight
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._in_flight = 0
+        self._refilled = time.monotonic()
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self.stats = {
+            "admitted": 0, "queued": 0, "max_queue": 0, "wait_total": 0.0,
+            "tokens_debited": 0, "tokens_reconciled": 0, "denied": 0,
+        }
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._refilled
+        self._refilled = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens):
+        """Seconds until the head of the queue can be admitted (None = wait for a release)"""
+        if self.max_in_flight and self._in_flight >= self.max_in_flight:
+            return None
+        wait = 0.0
+        if self.rpm and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+        if self.tpm:
+            # 한도보다 큰 요청은 버킷이 가득 찼을 때 들여보냄
+            needed = min(tokens, self.tpm)
+            if self._tokens < needed:
+                wait = max(wait, (needed - self._tokens) * 60 / self.tpm)
+        return wait
+
+    def _admit(self, tokens):
+        # self._cond를 잡은 상태에서 호출
+        if self.rpm:
+            self._requests -= 1
+        if self.tpm:
+            self._tokens -= tokens
+        self._in_flight += 1
+        self.stats["admitted"] += 1
+        self.stats["tokens_debited"] += tokens
+        self._cond.notify_all()
+        return Permit(self, tokens)
+
+    def try_acquire(self, tokens):
+        """Admit a request only if it can start right away and nobody is queued; None otherwise"""
+        with self._cond:
+            self._refill()
+            if self._queue or self._wait_time(tokens) != 0:
+                self.stats["denied"] += 1
+                return None
+            return self._admit(tokens)
+
+    def acquire(self, tokens, on_wait=None):
+        """Block until the request may start; on_wait(position) is called while queued and with 0 once admitted"""
+        ticket = object()
+        started = time.monotonic()
+        last_position = 0
+        with self._cond:
+            self._queue.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    self._refill()
+                    position = self._queue.index(ticket) + 1
+                    wait = self._wait_time(tokens) if position == 1 else None
+                    if wait == 0:
+                        self._queue.popleft()
+                        permit = self._admit(tokens)
+                        permit.waited = time.monotonic() - started
+                        permit.queue_position = last_position
+                        self.stats["wait_total"] += permit.waited
+                        if last_position:
+                            self.stats["queued"] += 1
+                        break
+                    self.stats["max_queue"] = max(self.stats["max_queue"], len(self._queue))
+                    if position == last_position or on_wait is None:
+                        self._cond.wait(min(wait, _MAX_WAIT_SLICE) if wait is not None else _MAX_WAIT_SLICE)
+                        continue
+                # 순번이 바뀌었을 때만 알림 (락 밖에서 호출: 화면 갱신이 느려도 다른 요청을 막지 않음)
+                last_position = position
+                on_wait(position)
+        except BaseException:
+            with self._cond:
+                if ticket in self._queue:
+                    self._queue.remove(ticket)
+                    self._cond.notify_all()
+            raise
+        if last_position and on_wait is not None:
+            on_wait(0)
+        return permit
+
+    def _release(self, permit, actual_tokens):
+        with self._cond:
+            self._in_flight -= 1
+            if actual_tokens is not None and self.tpm:
+                # 미리 차감한 추정치와 실제 사용량의 차이를 정산
+                self._tokens = min(self.tpm, self._tokens + permit.tokens - actual_tokens)
+                self.stats["tokens_reconciled"] += permit.tokens - actual_tokens
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            self._refill()
+            stats = dict(self.stats)
+            stats.update(
+                in_flight=self._in_flight,
+                waiting=len(self._queue),
+                requests_available=round(self._requests, 1) if self.rpm else None,
+                tokens_available=round(self._tokens) if self.tpm else None,
+            )
+        stats["wait_avg"] = round(stats.pop("wait_total") / stats["admitted"], 3) if stats["admitted"] else 0.0
+        return stats
+
+
+_limiter = RateLimiter()
+
+
+def acquire_permit(messages, on_wait=None, max_tokens=None):
+    """Admit one completion call through the process-wide limiter"""
+    return _limiter.acquire(estimate_request_tokens(messages, max_tokens), on_wait)
+
+
+def try_acquire_permit(messages, max_tokens=None):
+    """Admit an optional extra call (a hedge) only if the limiter has room now; None otherwise"""
+    return _limiter.try_acquire(estimate_request_tokens(messages, max_tokens))
+
+
+def usage_tokens(usage):
+    """total_tokens of a usage object, or None when the provider reported none"""
+    return getattr(usage, "total_tokens", None) if usage is not None else None
+
+
+def get_limiter_stats():
+    """Return admitted / queued counts, current queue length and remaining bucket capacity"""
+    return _limiter.get_stats()
@@ -0,0 +1,340 @@
+"""Local append-only spool of the session rows bound for Supabase.
+
+Every row is written here first (SQLite in WAL mode, shared by all app processes on the machine)
+and then shipped to Supabase by write_behind. The shipper's position is a checkpointed offset
+(the last contiguous sequence number confirmed by Supabase); rows confirmed after a row that is
+still failing are remembered so they are not sent again. Rows are deduplicated on their
+client-generated record_id both here and in Supabase. A row Supabase keeps rejecting is copied to
+the quarantine table and the offset moves past it; `replay --quarantined` re-sends those rows.
+
+    python 2LLM/record_spool.py inspect [--show 20]
+    python 2LLM/record_spool.py replay [--from-seq 120 | --quarantined]
+    python 2LLM/record_spool.py compact [--keep-days 7]
+"""
+import argparse
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+RECORD_SPOOL_PATH = os.getenv(
+    "RECORD_SPOOL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "record_spool.sqlite3")
+)
+# FULL: 커밋마다 WAL을 fsync (정전에도 안전) / NORMAL: 더 빠르지만 정전 시 마지막 커밋을 잃을 수 있음
+RECORD_SPOOL_SYNC = os.getenv("RECORD_SPOOL_SYNC", "FULL")
+SHIPPER = "supabase"
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+class RecordSpool:
+    """Append-only SQLite spool with a checkpointed shipping offset and a lease for a single shipper"""
+
+    def __init__(self, path=RECORD_SPOOL_PATH, sync=RECORD_SPOOL_SYNC):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={sync}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, record_id TEXT NOT NULL UNIQUE, table_name TEXT NOT NULL, "
+            "payload TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS offsets ("
+            "shipper TEXT PRIMARY KEY, seq INTEGER NOT NULL, owner TEXT, lease_until REAL NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("INSERT OR IGNORE INTO offsets (shipper, seq) VALUES (?, 0)", (SHIPPER,))
+        # offset 뒤에서 이미 확인된 행 (앞의 행이 아직 실패 중이라 offset을 넘기지 못한 경우)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS confirmed (seq INTEGER PRIMARY KEY)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS metrics (owner TEXT PRIMARY KEY, stats TEXT NOT NULL, at REAL NOT NULL)")
+        # 계속 거부되는 행의 사본 (records의 행은 compact로 지워질 수 있으므로 payload도 따로 보관)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quarantine ("
+            "seq INTEGER PRIMARY KEY, record_id TEXT NOT NULL, table_name TEXT NOT NULL, payload TEXT NOT NULL, "
+            "created_at REAL NOT NULL, error TEXT, attempts INTEGER NOT NULL, quarantined_at REAL NOT NULL)"
+        )
+
+    def append(self, table, row):
+        """Durably store a row (record_id is added if missing); a record_id seen before is ignored"""
+        row = dict(row)
+        row.setdefault("record_id", str(uuid.uuid4()))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO records (record_id, table_name, payload, created_at) VALUES (?, ?, ?, ?)",
+                (row["record_id"], table, json.dumps(row, ensure_ascii=False, default=str), time.time()),
+            )
+        return row["record_id"]
+
+    def offset(self):
+        with self._lock:
+            return self._conn.execute("SELECT seq FROM offsets WHERE shipper = ?", (SHIPPER,)).fetchone()[0]
+
+    def pending(self, limit, after=None):
+        """[(seq, table, row, created_at)] not yet confirmed, oldest first"""
+        after = self.offset() if after is None else after
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, table_name, payload, created_at FROM records "
+                "WHERE seq > ? AND seq NOT IN (SELECT seq FROM confirmed) ORDER BY seq LIMIT ?",
+                (after, limit),
+            ).fetchall()
+        return [(seq, table, json.loads(payload), created_at) for seq, table, payload, created_at in rows]
+
+    def confirm(self, seqs):
+        """Mark rows as confirmed in Supabase and move the offset past the confirmed prefix; returns the offset"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("INSERT OR IGNORE INTO confirmed (seq) VALUES (?)", [(seq,) for seq in seqs])
+                offset = self._conn.execute("SELECT seq FROM offsets WHERE shipper = ?", (SHIPPER,)).fetchone()[0]
+                # 확인되지 않은 첫 행 바로 앞까지 offset을 옮김 (그런 행이 없으면 확인된 마지막 행까지)
+                gap, top = self._conn.execute(
+                    "SELECT (SELECT MIN(seq) FROM records WHERE seq > ?1 AND seq NOT IN (SELECT seq FROM confirmed)), "
+                    "(SELECT MAX(seq) FROM confirmed)",
+                    (offset,),
+                ).fetchone()
+                offset = max(offset, gap - 1 if gap is not None else top or 0)
+                self._conn.execute("UPDATE offsets SET seq = ? WHERE shipper = ?", (offset, SHIPPER))
+                self._conn.execute("DELETE FROM confirmed WHERE seq <= ?", (offset,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return offset
+
+    def rewind(self, seq):
+        """Set the offset back so rows after seq are shipped again (deduplicated by record_id)"""
+        with self._lock:
+            self._conn.execute("UPDATE offsets SET seq = ? WHERE shipper = ?", (seq, SHIPPER))
+            self._conn.execute("DELETE FROM confirmed WHERE seq > ?", (seq,))
+
+    def acquire_lease(self, owner, seconds):
+        """Become (or stay) the only shipper for `seconds`; False while another live owner holds it"""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE offsets SET owner = ?, lease_until = ? WHERE shipper = ? AND (owner = ? OR lease_until < ?)",
+                (owner, now + seconds, SHIPPER, owner, now),
+            )
+            return cursor.rowcount == 1
+
+    def release_lease(self, owner):
+        """Give up the lease now so another shipper can take over without waiting for it to expire"""
+        with self._lock:
+            self._conn.execute("UPDATE offsets SET lease_until = 0 WHERE shipper = ? AND owner = ?", (SHIPPER, owner))
+
+    def lease(self):
+        """(owner, lease_until) of the current shipper lease"""
+        with self._lock:
+            return self._conn.execute("SELECT owner, lease_until FROM offsets WHERE shipper = ?", (SHIPPER,)).fetchone()
+
+    def quarantine(self, failures, attempts):
+        """Keep [((seq, table, row, created_at), error)] aside as rejected rows; a row already there adds attempts"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO quarantine (seq, record_id, table_name, payload, created_at, error, attempts, quarantined_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(seq) DO UPDATE SET error = excluded.error, "
+                "attempts = attempts + excluded.attempts, quarantined_at = excluded.quarantined_at",
+                [
+                    (seq, row["record_id"], table, json.dumps(row, ensure_ascii=False, default=str), created_at,
+                     f"{type(error).__name__}: {error}", attempts, now)
+                    for (seq, table, row, created_at), error in failures
+                ],
+            )
+
+    def quarantined(self, limit, after=0):
+        """[(seq, table, row, created_at)] of quarantined rows after seq, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, table_name, payload, created_at FROM quarantine WHERE seq > ? ORDER BY seq LIMIT ?",
+                (after, limit),
+            ).fetchall()
+        return [(seq, table, json.loads(payload), created_at) for seq, table, payload, created_at in rows]
+
+    def release(self, seqs):
+        """Drop rows from the quarantine once Supabase has confirmed them"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM quarantine WHERE seq = ?", [(seq,) for seq in seqs])
+
+    def quarantine_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM quarantine").fetchone()[0]
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM records WHERE seq > (SELECT seq FROM offsets WHERE shipper = ?) "
+                "AND seq NOT IN (SELECT seq FROM confirmed)",
+                (SHIPPER,),
+            ).fetchone()[0]
+
+    def save_metrics(self, owner, stats):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metrics (owner, stats, at) VALUES (?, ?, ?)",
+                (owner, json.dumps(stats, default=str), time.time()),
+            )
+
+    def compact(self, keep_seconds):
+        """Delete shipped rows older than keep_seconds and reclaim the space; returns rows deleted"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM records WHERE seq <= (SELECT seq FROM offsets WHERE shipper = ?) AND created_at < ?",
+                (SHIPPER, time.time() - keep_seconds),
+            )
+            deleted = cursor.rowcount
+            self._conn.execute("DELETE FROM metrics WHERE at < ?", (time.time() - 86400,))
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.execute("VACUUM")
+        return deleted
+
+    def summary(self):
+        """Counts per table, the shipping offset and lease, and the last metrics of every shipper process"""
+        with self._lock:
+            offset, owner, lease_until = self._conn.execute(
+                "SELECT seq, owner, lease_until FROM offsets WHERE shipper = ?", (SHIPPER,)
+            ).fetchone()
+            tables = self._conn.execute(
+                "SELECT table_name, COUNT(*), SUM(pending), MIN(CASE WHEN pending THEN created_at END) FROM "
+                "(SELECT table_name, created_at, seq > ? AND seq NOT IN (SELECT seq FROM confirmed) AS pending "
+                "FROM records) GROUP BY table_name",
+                (offset,),
+            ).fetchall()
+            last_seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM records").fetchone()[0]
+            metrics = self._conn.execute("SELECT owner, stats, at FROM metrics ORDER BY at DESC").fetchall()
+            quarantined = self._conn.execute("SELECT COUNT(*) FROM quarantine").fetchone()[0]
+        return {
+            "offset": offset, "last_seq": last_seq, "owner": owner, "lease_until": lease_until,
+            "quarantined": quarantined,
+            "tables": {t: {"records": n, "pending": p or 0, "oldest_pending": o} for t, n, p, o in tables},
+            "metrics": [dict(json.loads(stats), owner=o, at=at) for o, stats, at in metrics],
+        }
+
+    def tail(self, count):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, record_id, table_name, created_at, LENGTH(payload), seq IN (SELECT seq FROM confirmed) "
+                "FROM records ORDER BY seq DESC LIMIT ?",
+                (count,),
+            ).fetchall()
+        return list(reversed(rows))
+
+    def quarantine_list(self, count):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT seq, record_id, table_name, attempts, quarantined_at, error FROM quarantine ORDER BY seq LIMIT ?",
+                (count,),
+            ).fetchall()
+
+
+def get_spool(path=RECORD_SPOOL_PATH):
+    """Return the process-wide spool for a file, opening it on first use"""
+    with _spools_lock:
+        spool = _spools.get(path)
+        if spool is None:
+            spool = _spools[path] = RecordSpool(path)
+        return spool
+
+
+def _time(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S") if ts else "-"
+
+
+def inspect(spool, show):
+    s = spool.summary()
+    lease = f"{s['owner']} until {_time(s['lease_until'])}" if s["owner"] else "-"
+    print(f"{spool.path}\noffset {s['offset']} / last seq {s['last_seq']}, shipper lease: {lease}, "
+          f"quarantined: {s['quarantined']}\n")
+    print(f"{'table':<10} {'records':>8} {'pending':>8}  oldest pending")
+    for table, t in sorted(s["tables"].items()):
+        print(f"{table:<10} {t['records']:>8} {t['pending']:>8}  {_time(t['oldest_pending'])}")
+    if s["metrics"]:
+        print(f"\n{'shipper':<24} {'at':<19} {'shipped':>8} {'retries':>7} {'failed':>6} {'p50':>7} {'p95':>7}  last error")
+        for m in s["metrics"]:
+            p50 = f"{m['flush_p50_ms']}ms" if m.get("flush_p50_ms") is not None else "-"
+            p95 = f"{m['flush_p95_ms']}ms" if m.get("flush_p95_ms") is not None else "-"
+            print(f"{m['owner']:<24} {_time(m['at']):<19} {m['flushed']:>8} {m['retries']:>7} {m['failed']:>6} "
+                  f"{p50:>7} {p95:>7}  {m.get('last_error') or ''}")
+    if show:
+        print(f"\n{'seq':>6} {'record_id':<36} {'table':<8} {'created':<19} {'bytes':>7}")
+        for seq, record_id, table, created_at, size, confirmed in spool.tail(show):
+            mark = " (shipped)" if seq <= s["offset"] or confirmed else ""
+            print(f"{seq:>6} {record_id:<36} {table:<8} {_time(created_at):<19} {size:>7}{mark}")
+    if s["quarantined"]:
+        # 거부된 행은 --show와 관계없이 항상 보여줌 (원인을 고친 뒤 replay --quarantined)
+        print(f"\n{'seq':>6} {'record_id':<36} {'table':<8} {'tries':>5} {'quarantined':<19}  error")
+        for seq, record_id, table, attempts, quarantined_at, error in spool.quarantine_list(show or 20):
+            print(f"{seq:>6} {record_id:<36} {table:<8} {attempts:>5} {_time(quarantined_at):<19}  {error}")
+
+
+def replay(spool, client, from_seq=None, quarantined=False):
+    """Ship pending rows (or everything from from_seq, or the quarantined rows) from this process.
+
+    Takes the shipper lease under its own owner name first, so it never runs next to an app's
+    shipper; refuses while another live owner holds the lease.
+    """
+    from write_behind import WRITE_BEHIND_LEASE, ship_pending, ship_quarantined
+
+    owner = f"replay:{socket.gethostname()}:{os.getpid()}"
+    if not spool.acquire_lease(owner, WRITE_BEHIND_LEASE):
+        holder, lease_until = spool.lease()
+        raise SystemExit(f"{holder} is shipping (lease until {_time(lease_until)}); try again when it is idle")
+
+    def keep_lease():
+        return spool.acquire_lease(owner, WRITE_BEHIND_LEASE)
+
+    try:
+        if quarantined:
+            shipped, failing = ship_quarantined(spool, client, keep_lease=keep_lease)
+            print(f"shipped {shipped} quarantined rows, {failing} still rejected")
+            return
+        if from_seq is not None:
+            spool.rewind(from_seq - 1)
+        shipped = ship_pending(spool, client, keep_lease=keep_lease)
+        print(f"shipped {shipped} rows, offset now {spool.offset()}, {spool.depth()} pending")
+    finally:
+        spool.release_lease(owner)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect, replay or compact the local record spool")
+    parser.add_argument("--path", default=RECORD_SPOOL_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    inspect_parser = commands.add_parser("inspect", help="pending rows per table, shipping offset and shipper metrics")
+    inspect_parser.add_argument("--show", type=int, default=0, help="also list the last N records")
+    replay_parser = commands.add_parser("replay", help="ship pending rows to Supabase now")
+    replay_targets = replay_parser.add_mutually_exclusive_group()
+    replay_targets.add_argument("--from-seq", type=int, default=None, help="re-ship every row from this seq on")
+    replay_targets.add_argument("--quarantined", action="store_true", help="re-ship the quarantined (rejected) rows")
+    compact_parser = commands.add_parser("compact", help="drop shipped rows older than --keep-days")
+    compact_parser.add_argument("--keep-days", type=float, default=7.0)
+    args = parser.parse_args()
+
+    spool = RecordSpool(args.path)
+    if args.command == "inspect":
+        inspect(spool, args.show)
+    elif args.command == "replay":
+        from dotenv import load_dotenv
+
+        from supabase_client import get_supabase
+
+        load_dotenv()
+        url = os.getenv("SUPABASE_URL")
+        key = os.getenv("SUPABASE_KEY")
+        if not url or not key:
+            raise SystemExit("SUPABASE_URL and SUPABASE_KEY must be set")
+        replay(spool, get_supabase(url, key), args.from_seq, args.quarantined)
+    else:
+        print(f"deleted {spool.compact(args.keep_days * 86400)} shipped rows")
+
+
+if __name__ == "__main__":
+    main()
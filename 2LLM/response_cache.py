@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from condition_config import load_conditions
+
+# memory: 프로세스 안의 LRU / sqlite: 여러 프로세스가 같이 쓰는 파일
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_PATH = os.getenv(
+    "RESPONSE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "response_cache.sqlite3")
+)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2048"))
+# 기본 유효 시간(초), 0이면 만료 없음 (설정에서 넣은 고정 응답은 항상 만료 없음)
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+
+# temperature 0 요청의 답을 저장했다가 같은 요청에 다시 씀 (0이면 끔)
+RESPONSE_CACHE_COMPLETIONS = os.getenv("RESPONSE_CACHE_COMPLETIONS", "1") != "0"
+
+# 설정 파일의 고정 응답을 저장할 때 쓰는 모델 이름
+CANNED_MODEL = "canned"
+# 응답 내용에 영향을 주지 않는 요청 필드 (키에서 제외)
+_TRANSPORT_FIELDS = ("model", "messages", "stream", "stream_options")
+
+
+def normalize_text(text):
+    """Collapse whitespace so formatting-only differences map to the same key"""
+    return " ".join((text or "").split())
+
+
+def cache_key(model, system_prompt, history, prompt, params=None):
+    """Hash of everything that determines a completion: model, system prompt, history, prompt, sampling params"""
+    payload = {
+        "model": model,
+        "system": normalize_text(system_prompt),
+        "history": [[msg["role"], normalize_text(msg["content"])] for msg in history],
+        "prompt": normalize_text(prompt),
+        "params": params or {},
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """In-process LRU store of (value, expires_at)"""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (value, expires_at) or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, expires_at):
+        """Store an entry; returns how many entries were evicted"""
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while self.max_entries and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """On-disk store shared by every app process on the machine, evicted by last use"""
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, time.time()),
+            )
+            if not self.max_entries:
+                return 0
+            cursor = self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            return cursor.rowcount
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ResponseCache:
+    """Response cache with TTL expiry and hit/miss counters on top of a pluggable backend"""
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def get(self, key):
+        """Return the cached value, or None on a miss or an expired entry"""
+        entry = self.backend.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if not expires_at or expires_at > time.time():
+                self._count("hits")
+                return value
+            self.backend.delete(key)
+            self._count("expired")
+        self._count("misses")
+        return None
+
+    def set(self, key, value, ttl=None):
+        """Store a JSON-serialisable value; ttl=0 means it never expires"""
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else 0
+        evicted = self.backend.set(key, value, expires_at)
+        self._count("sets")
+        if evicted:
+            self._count("evictions", evicted)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        stats["entries"] = len(self.backend)
+        return stats
+
+
+def canned_key(condition_id, prompt):
+    """Cache key of a configured first turn (condition id stands in for the system prompt)"""
+    return cache_key(CANNED_MODEL, condition_id, [], prompt)
+
+
+def completion_key(request, **extra):
+    """Cache key of a deterministic (temperature 0) chat request, or None when its answer may vary.
+
+    extra holds settings applied outside the request that change the shown answer (e.g. a sentence budget).
+    """
+    if not RESPONSE_CACHE_COMPLETIONS or request.get("temperature") != 0:
+        return None
+    messages = request["messages"]
+    has_system = bool(messages) and messages[0]["role"] == "system"
+    system_prompt = messages[0]["content"] if has_system else ""
+    history = messages[1 if has_system else 0:-1]
+    params = {name: value for name, value in request.items() if name not in _TRANSPORT_FIELDS}
+    params.update({name: value for name, value in extra.items() if value is not None})
+    return cache_key(request["model"], system_prompt, history, messages[-1]["content"], params)
+
+
+def seed_canned_turns(cache, condition_ids=None):
+    """Copy the canned_turns of conditions.json into the cache; returns how many turns were stored"""
+    seeded = 0
+    for condition_id, condition in load_conditions().items():
+        if condition_ids and condition_id not in condition_ids:
+            continue
+        for turn in condition.get("canned_turns", []):
+            cache.set(canned_key(condition_id, turn["prompt"]), turn["responses"], ttl=0)
+            seeded += 1
+    return seeded
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Process-wide cache (backend chosen by RESPONSE_CACHE_BACKEND), seeded with the canned turns"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if RESPONSE_CACHE_BACKEND == "sqlite":
+                backend = SQLiteBackend()
+            else:
+                backend = MemoryBackend()
+            _cache = ResponseCache(backend)
+            seed_canned_turns(_cache)
+        return _cache
+
+
+def get_canned_turn(condition_id, prompt):
+    """Configured answers {persona: text} for this prompt in this condition, or None"""
+    return get_response_cache().get(canned_key(condition_id, prompt))
@@ -0,0 +1,113 @@
+import re
+
+# 한 번의 요청으로 두 캐릭터의 답을 받을 때 쓰는 구분자 (반드시 한 줄을 통째로 차지해야 함)
+SECTION_MARKERS = {"pro": "[[PURPLI]]", "con": "[[YELLOWY]]"}
+
+# 구분자 줄로 인정하는 형태: [[PURPLI]], **Purpli**, Purpli:, 퍼플이 등 이름만 있는 한 줄
+_HEADER_NAMES = {
+    "purpli": "pro",
+    "퍼플이": "pro",
+    "yellowy": "con",
+    "노랑이": "con",
+}
+_HEADER_RE = re.compile(r"^[\s\[\]*#:_>\-]*(purpli|yellowy|퍼플이|노랑이)[\s\[\]*#:_\-]*$", re.IGNORECASE)
+# 이 길이를 넘는 미완성 줄은 구분자가 될 수 없으므로 바로 내보냄
+_MAX_HEADER_LEN = 24
+
+
+def _header_section(line):
+    match = _HEADER_RE.match(line)
+    return _HEADER_NAMES[match.group(1).lower()] if match else None
+
+
+def _could_be_header(partial):
+    """True if this unfinished line may still turn into a header line"""
+    stripped = partial.strip()
+    if len(stripped) > _MAX_HEADER_LEN:
+        return False
+    core = re.sub(r"[\s\[\]*#:_>\-]", "", stripped).lower()
+    return any(name.startswith(core) for name in _HEADER_NAMES)
+
+
+class SectionParser:
+    """Incremental state machine that routes streamed text into the Purpli / Yellowy sections.
+
+    Text is routed line by line; a line is a section switch only if the whole line is a
+    header (see SECTION_MARKERS), so the names appearing inside an answer never split it.
+    Text before the first header goes to the first section.
+    """
+
+    def __init__(self, first_section="pro"):
+        self.section = first_section
+        self.sections = {"pro": "", "con": ""}
+        self.headers_seen = []
+        self._pending = ""  # 아직 구분자인지 판단할 수 없는 현재 줄
+
+    def _emit(self, text, out):
+        if not text:
+            return
+        # 구분자 바로 뒤의 빈 줄은 본문에 넣지 않음
+        if not self.sections[self.section]:
+            text = text.lstrip()
+            if not text:
+                return
+        self.sections[self.section] += text
+        out.append((self.section, text))
+
+    def feed(self, delta):
+        """Consume one streamed delta and return the [(section, text)] pieces now safe to show"""
+        out = []
+        self._pending += delta
+        while "\n" in self._pending:
+            line, self._pending = self._pending.split("\n", 1)
+            section = _header_section(line)
+            if section:
+                self.section = section
+                self.headers_seen.append(section)
+            else:
+                self._emit(line + "\n", out)
+        if self._pending and not _could_be_header(self._pending):
+            self._emit(self._pending, out)
+            self._pending = ""
+        return out
+
+    def finish(self):
+        """Flush the last line and return ({"pro": ..., "con": ...}, ok)"""
+        out = []
+        if self._pending:
+            section = _header_section(self._pending)
+            if section:
+                self.section = section
+                self.headers_seen.append(section)
+            else:
+                self._emit(self._pending, out)
+            self._pending = ""
+
+        sections = {name: text.strip() for name, text in self.sections.items()}
+        if sections["pro"] and sections["con"]:
+            return sections, True
+
+        # 구분자가 깨진 경우: 예전 방식처럼 본문 안의 이름으로 한 번 더 나눠 봄
+        fallback = split_sections(sections["pro"] + "\n" + sections["con"])
+        if fallback:
+            return fallback, True
+        return sections, False
+
+
+def split_sections(text):
+    """Legacy split on the literal names; returns None when both parts cannot be found"""
+    match = re.search(r"[\s*_#\[\]]*Yellowy[\s*_#:\[\]]*", text)
+    if not match:
+        return None
+    pro = re.sub(r"^[\s*_#\[\]]*Purpli[\s*_#:\[\]]*", "", text[:match.start()]).strip()
+    con = text[match.end():].strip()
+    if not pro or not con:
+        return None
+    return {"pro": pro, "con": con}
+
+
+def parse_sections(text):
+    """Parse a complete (non-streamed) dual answer; returns ({"pro", "con"}, ok)"""
+    parser = SectionParser()
+    parser.feed(text)
+    return parser.finish()
@@ -0,0 +1,45 @@
+"""Pre-fill the response cache with the canned turns of prompts/debate/conditions.json.
+
+The apps seed their in-memory cache on start; run this to fill the shared SQLite cache
+(RESPONSE_CACHE_BACKEND=sqlite) ahead of a session, or to check what is configured.
+
+    python 2LLM/seed_cache.py --backend sqlite --condition app2 --condition kor2
+"""
+import argparse
+import time
+
+import response_cache
+from condition_config import load_conditions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="sqlite")
+    parser.add_argument("--path", default=response_cache.RESPONSE_CACHE_PATH)
+    parser.add_argument("--condition", action="append", help="condition id to seed (default: all)")
+    args = parser.parse_args()
+
+    if args.backend == "sqlite":
+        backend = response_cache.SQLiteBackend(args.path)
+    else:
+        backend = response_cache.MemoryBackend()
+    cache = response_cache.ResponseCache(backend)
+
+    seeded = response_cache.seed_canned_turns(cache, args.condition)
+    print(f"seeded {seeded} canned turns ({args.backend}, {len(backend)} entries)")
+
+    # 저장된 고정 응답을 다시 읽어서 확인하고 조회 시간을 출력
+    for condition_id, condition in load_conditions().items():
+        if args.condition and condition_id not in args.condition:
+            continue
+        for turn in condition.get("canned_turns", []):
+            start = time.perf_counter()
+            responses = cache.get(response_cache.canned_key(condition_id, turn["prompt"]))
+            elapsed = (time.perf_counter() - start) * 1e6
+            status = "ok" if responses == turn["responses"] else "MISMATCH"
+            print(f"{condition_id:<8} {status:<8} {elapsed:>7.1f}us  {turn['prompt']}")
+    print(cache.get_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import random
+import re
+import threading
+
+from token_accounting import estimate_tokens
+
+_TERMINATORS = ".!?。！？…"
+_CLOSERS = "\"'”’)]」』"
+# 마침표가 붙어도 문장 끝으로 보지 않는 약어
+_ABBREVIATIONS = {
+    "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e",
+    "u.s", "u.k", "no", "approx", "fig", "inc", "ltd", "co", "a.m", "p.m",
+}
+_WORD_BEFORE_DOT_RE = re.compile(r"([A-Za-z.]+)\.$")
+_LIST_NUMBER_RE = re.compile(r"(?:^|\n)\s*\d+\.$")
+
+# 예산에 걸려 일찍 끊은 응답과 끝까지 받은 응답의 프로세스 전체 통계
+_stats = {"natural": 0, "truncated": 0, "shadowed": 0, "tokens_kept": 0, "tokens_avoided": 0}
+# 페르소나별로 예산을 넘겨서 더 생성됐을 토큰 수의 이동 평균 (일부 응답을 끝까지 읽어서 측정)
+_overrun_tokens = {}
+_stats_lock = threading.Lock()
+
+# 끊은 응답 중 이 비율만큼은 화면에는 안 보이게 끝까지 읽어서 실제 초과 길이를 측정
+SHADOW_SAMPLE_RATE = float(os.getenv("SENTENCE_BUDGET_SHADOW_RATE", "0.05"))
+
+
+class SentenceBudget:
+    """Count sentences in a stream and report when the configured number is reached.
+
+    A sentence ends at . ! ? 。 ！ ？ … (plus closing quotes/brackets) followed by whitespace,
+    so decimals (3.14), abbreviations (e.g., Dr.) and numbered list markers (1.) do not count.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self.text = ""
+        self.reached = False
+        self.discarded = ""
+        self._candidate = False  # 직전 문자가 문장 끝일 수 있음 (다음 문자가 공백이면 확정)
+
+    def _is_boundary(self):
+        if self.text[-1] != ".":
+            return True
+        if _LIST_NUMBER_RE.search(self.text):
+            return False
+        match = _WORD_BEFORE_DOT_RE.search(self.text)
+        if match:
+            word = match.group(1).lower()
+            if word in _ABBREVIATIONS or (len(word) == 1 and match.group(1).isupper()):
+                return False
+        return True
+
+    def feed(self, delta):
+        """Consume a delta and return the part of it that belongs inside the budget"""
+        if self.reached:
+            self.discarded += delta
+            return ""
+        start = len(self.text)
+        for i, ch in enumerate(delta):
+            if self._candidate:
+                if ch in _CLOSERS or ch in _TERMINATORS:
+                    self.text += ch
+                    continue
+                self._candidate = False
+                if ch.isspace():
+                    self.count += 1
+                    if self.count >= self.limit:
+                        self.reached = True
+                        self.discarded = delta[i:]
+                        return self.text[start:]
+            self.text += ch
+            if ch in _TERMINATORS and self._is_boundary():
+                self._candidate = True
+        return self.text[start:]
+
+
+def should_shadow():
+    """Whether this truncated stream should still be read to the end to measure the overrun"""
+    return random.random() < SHADOW_SAMPLE_RATE
+
+
+def record_completion(persona, text, truncated, overflow_text=None):
+    """Account one finished answer; returns the estimated completion tokens avoided by truncating it.
+
+    overflow_text is what the model produced past the budget when the stream was shadowed.
+    """
+    tokens = estimate_tokens(text)
+    with _stats_lock:
+        _stats["tokens_kept"] += tokens
+        if not truncated:
+            _stats["natural"] += 1
+            return 0
+        _stats["truncated"] += 1
+        if overflow_text is not None:
+            _stats["shadowed"] += 1
+            overrun = estimate_tokens(overflow_text)
+            previous = _overrun_tokens.get(persona)
+            _overrun_tokens[persona] = overrun if previous is None else 0.8 * previous + 0.2 * overrun
+            return 0
+        avoided = int(_overrun_tokens.get(persona, 0))
+        _stats["tokens_avoided"] += avoided
+        return avoided
+
+
+def get_budget_stats():
+    """Return process-wide truncation counts and the estimated completion tokens avoided"""
+    with _stats_lock:
+        return dict(_stats, overrun_tokens={k: round(v) for k, v in _overrun_tokens.items()})
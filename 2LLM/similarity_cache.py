@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+import zlib
+from collections import deque
+
+from condition_config import get_condition
+
+# MinHash 서명 길이와 LSH 밴드 수 (밴드 하나 = 32 / 8 = 4개 해시)
+NUM_PERM = 32
+NUM_BANDS = 8
+SHINGLE_SIZE = 3
+DEFAULT_THRESHOLD = float(os.getenv("SIMILARITY_CACHE_THRESHOLD", "0.8"))
+# (조건, 페르소나, 턴)마다 기억하는 최대 질문 수 (넘으면 오래된 것부터 버림)
+MAX_ENTRIES_PER_SCOPE = int(os.getenv("SIMILARITY_CACHE_MAX_ENTRIES", "500"))
+
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+# 고정된 계수를 써서 프로세스가 달라도 같은 서명이 나옴
+_PERMUTATIONS = [((i * 0x9E3779B1 + 1) % _PRIME, (i * 0x85EBCA77 + 7) % _PRIME) for i in range(1, NUM_PERM + 1)]
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+_index = {}  # scope -> {"entries": deque, "buckets": {(band, hashes): [entry]}}
+_stats = {}  # condition id -> {"lookups", "hits", "stores"}
+_lock = threading.Lock()
+
+
+def normalize_prompt(text):
+    """Lowercase, drop punctuation and collapse whitespace"""
+    return " ".join(_PUNCT_RE.sub(" ", (text or "").lower()).split())
+
+
+def _shingles(text):
+    text = f" {text} "
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text):
+    """MinHash signature of the character n-grams of a normalized prompt"""
+    hashes = [zlib.crc32(s.encode("utf-8")) for s in _shingles(text)]
+    return tuple(min((a * h + b) % _PRIME & _MASK for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def _bands(signature):
+    rows = NUM_PERM // NUM_BANDS
+    return [(band, signature[band * rows:(band + 1) * rows]) for band in range(NUM_BANDS)]
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of two MinHash signatures"""
+    return sum(x == y for x, y in zip(a, b)) / NUM_PERM
+
+
+def get_similarity_settings(condition_id):
+    """similarity_cache settings of a condition (disabled unless the condition opts in)"""
+    settings = get_condition(condition_id).get("similarity_cache", {})
+    return {
+        "enabled": bool(settings.get("enabled", False)),
+        "threshold": float(settings.get("threshold", DEFAULT_THRESHOLD)),
+    }
+
+
+def _condition_stats(condition_id):
+    return _stats.setdefault(condition_id, {"lookups": 0, "hits": 0, "stores": 0})
+
+
+def lookup(condition_id, persona, turn, prompt):
+    """Cached answer of a near-duplicate prompt at the same persona and turn, or None"""
+    settings = get_similarity_settings(condition_id)
+    if not settings["enabled"]:
+        return None
+    signature = minhash(normalize_prompt(prompt))
+    with _lock:
+        stats = _condition_stats(condition_id)
+        stats["lookups"] += 1
+        scope = _index.get((condition_id, persona, turn))
+        if scope is None:
+            return None
+        best, best_score = None, 0.0
+        for key in _bands(signature):
+            for entry in scope["buckets"].get(key, ()):
+                score = similarity(signature, entry["signature"])
+                if score > best_score:
+                    best, best_score = entry, score
+        if best is None or best_score < settings["threshold"]:
+            return None
+        stats["hits"] += 1
+        return best["answer"]
+
+
+def store(condition_id, persona, turn, prompt, answer):
+    """Remember a generated answer for later near-duplicate prompts"""
+    if not answer or not get_similarity_settings(condition_id)["enabled"]:
+        return
+    entry = {"signature": minhash(normalize_prompt(prompt)), "answer": answer}
+    with _lock:
+        scope = _index.setdefault((condition_id, persona, turn), {"entries": deque(), "buckets": {}})
+        scope["entries"].append(entry)
+        for key in _bands(entry["signature"]):
+            scope["buckets"].setdefault(key, []).append(entry)
+        while len(scope["entries"]) > MAX_ENTRIES_PER_SCOPE:
+            old = scope["entries"].popleft()
+            for key in _bands(old["signature"]):
+                bucket = [e for e in scope["buckets"][key] if e is not old]
+                if bucket:
+                    scope["buckets"][key] = bucket
+                else:
+                    del scope["buckets"][key]
+        _condition_stats(condition_id)["stores"] += 1
+
+
+def get_similarity_stats():
+    """Return lookups / hits / hit rate per condition"""
+    with _lock:
+        stats = {cid: dict(s) for cid, s in _stats.items()}
+    for s in stats.values():
+        s["hit_rate"] = round(s["hits"] / s["lookups"], 3) if s["lookups"] else 0.0
+    return stats
@@ -0,0 +1,352 @@
+"""Speculative pre-generation of the likely next participant prompt while the last answer is being read.
+
+Candidates for (condition, turn) come from the starter buttons (canned_turns prompts), the
+condition's own "candidates" and a frequency table mined from past transcripts
+(prompts/debate/followups.json, written by main() below; until it has been mined only the starter
+buttons and configured candidates are used). The top_k candidates are generated in the background
+with the exact request the next turn would send; when the participant's prompt matches one closely enough
+(MinHash similarity >= threshold) its answers are shown at once, otherwise they are discarded.
+Speculative tokens are counted here and not in the condition's token totals.
+
+    python 2LLM/speculation.py pilot_transcripts.jsonl --table LLM2 --table LLM2_R
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from circuit_breaker import CLOSED, get_breaker
+from condition_config import get_condition, get_sentence_budget
+from hedged_request import expected_first_token
+from llm_sidecar import open_llm_stream
+from rate_limiter import acquire_permit, get_limiter_stats, usage_tokens
+from similarity_cache import minhash, normalize_prompt, similarity
+from stream_mux import read_stream
+from token_accounting import estimated_usage
+
+FOLLOWUPS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "prompts", "debate", "followups.json"
+)
+DEFAULT_TOP_K = 2
+DEFAULT_THRESHOLD = 0.8
+# 예측 생성 전용 워커 수 (실제 턴의 스트리밍 풀과 따로 둠)
+SPECULATION_WORKERS = int(os.getenv("SPECULATION_WORKERS", "4"))
+# 맞힌 예측이 아직 생성 중일 때 기다리는 최대 시간(초), 넘으면 평소처럼 새로 요청
+# (실제로는 새 요청의 첫 토큰 시간 중앙값까지만 기다림: 그보다 오래 기다리면 새로 요청하는 편이 빠름)
+SPECULATION_WAIT = float(os.getenv("SPECULATION_WAIT", "3"))
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="llm-speculate")
+_followups = None
+_stats = {}  # condition id -> {"speculations", "skipped", "generations", "hits", "misses", "generated_tokens", "used_tokens"}
+_stats_lock = threading.Lock()
+
+
+def get_speculation_settings(condition_id):
+    """speculation settings of a condition (disabled unless the condition opts in)"""
+    settings = get_condition(condition_id).get("speculation", {})
+    return {
+        "enabled": bool(settings.get("enabled", False)),
+        "top_k": int(settings.get("top_k", DEFAULT_TOP_K)),
+        "threshold": float(settings.get("threshold", DEFAULT_THRESHOLD)),
+        "candidates": settings.get("candidates", {}),
+    }
+
+
+def load_followups():
+    """Mined follow-up table {condition: {turn: [{"prompt", "count"}]}}, loaded once per process"""
+    global _followups
+    if _followups is None:
+        try:
+            with open(FOLLOWUPS_PATH, 'r', encoding='utf-8') as f:
+                _followups = json.load(f).get("conditions", {})
+        except FileNotFoundError:
+            logger.warning(
+                "%s not found; speculation uses only starter buttons and configured candidates "
+                "until it is mined (python 2LLM/speculation.py ...)", FOLLOWUPS_PATH,
+            )
+            _followups = {}
+        except (OSError, ValueError):
+            _followups = {}
+    return _followups
+
+
+def _condition_stats(condition_id):
+    return _stats.setdefault(condition_id, {
+        "speculations": 0, "skipped": 0, "generations": 0, "hits": 0, "misses": 0,
+        "generated_tokens": 0, "used_tokens": 0,
+    })
+
+
+def predict(condition_id, turn, top_k=None):
+    """Most likely participant prompts at a turn: starter buttons, configured candidates, then mined counts"""
+    settings = get_speculation_settings(condition_id)
+    top_k = settings["top_k"] if top_k is None else top_k
+    ranked = []
+    if turn == 0:
+        ranked += [canned["prompt"] for canned in get_condition(condition_id).get("canned_turns", [])]
+    ranked += settings["candidates"].get(str(turn), [])
+    mined = load_followups().get(condition_id, {}).get(str(turn), [])
+    ranked += [entry["prompt"] for entry in sorted(mined, key=lambda entry: -entry["count"])]
+    candidates, seen = [], set()
+    for prompt in ranked:
+        key = normalize_prompt(prompt)
+        if key and key not in seen:
+            seen.add(key)
+            candidates.append(prompt)
+    return candidates[:top_k]
+
+
+def _generate(client, request, persona, sentence_budget, cancel):
+    """Worker thread: run one speculative completion; returns {"content", "usage", "complete"} or None"""
+    if cancel.is_set():
+        return None
+    permit = acquire_permit(request["messages"], max_tokens=request.get("max_tokens"))
+    usage = None
+    parts = []
+    try:
+        stream = open_llm_stream(client, request, f"speculate-{persona}")
+        # 예측 답변은 문장 예산 통계에 넣지 않음 (버려지는 답변이 잘림 비율/초과 토큰을 왜곡하지 않도록)
+        usage = read_stream(
+            stream, parts.append, persona, request["messages"], sentence_budget, cancel.is_set, record=False
+        )
+    finally:
+        permit.release(usage_tokens(usage))
+    if usage is None:
+        # 취소됐거나 프로바이더가 usage를 안 보냄 -> 받은 만큼 추정
+        usage = estimated_usage(request["messages"], "".join(parts))
+    return {"content": "".join(parts), "usage": usage, "complete": not cancel.is_set()}
+
+
+class Speculation:
+    """Pre-generated answers for one session's next turn"""
+
+    def __init__(self, condition_id, turn, threshold=DEFAULT_THRESHOLD):
+        self.condition_id = condition_id
+        self.turn = turn
+        self.threshold = threshold
+        self.entries = []  # {"prompt", "signature", "cancel": Event, "futures": {persona: Future}}
+        self._match = None  # (프롬프트, 맞힌 항목) - 찬성/반대가 같은 판정을 쓰도록 한 번만 계산
+        self._deadline = None  # 맞힌 항목을 기다리는 마감 시각 (페르소나마다 따로 기다리지 않도록 한 번만 정함)
+
+    def add(self, client, prompt, requests):
+        cancel = threading.Event()
+        futures = {}
+        for persona, request in requests.items():
+            future = _executor.submit(
+                _generate, client, request, persona,
+                get_sentence_budget(self.condition_id, persona), cancel,
+            )
+            future.add_done_callback(self._record_generation)
+            futures[persona] = future
+        self.entries.append({
+            "prompt": prompt, "signature": minhash(normalize_prompt(prompt)), "cancel": cancel, "futures": futures,
+        })
+
+    def _record_generation(self, future):
+        # 중간에 멈춘 예측도 이미 쓴 토큰은 예측 비용으로 기록
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            return
+        with _stats_lock:
+            stats = _condition_stats(self.condition_id)
+            stats["generations"] += 1
+            stats["generated_tokens"] += future.result()["usage"].total_tokens
+
+    def _matching_entry(self, prompt):
+        if self._match is None or self._match[0] != prompt:
+            signature = minhash(normalize_prompt(prompt))
+            best, best_score = None, 0.0
+            for entry in self.entries:
+                score = similarity(signature, entry["signature"])
+                if score > best_score:
+                    best, best_score = entry, score
+            if best_score < self.threshold:
+                best = None
+            # 다음 턴이 시작됐으니 아직 돌고 있는 나머지 예측은 멈춤 (맞힌 항목만 끝까지 받음)
+            for entry in self.entries:
+                if entry is not best:
+                    self._stop(entry)
+            with _stats_lock:
+                _condition_stats(self.condition_id)["hits" if best else "misses"] += 1
+            self._match = (prompt, best)
+            self._deadline = time.monotonic() + min(SPECULATION_WAIT, expected_first_token())
+        return self._match[1]
+
+    def take(self, persona, prompt):
+        """Pre-generated {"content", "usage"} of a persona for a matching prompt, or None.
+
+        Waits for an unfinished generation at most about one first-token latency of a live request.
+        """
+        if not self.entries:
+            return None
+        entry = self._matching_entry(prompt)
+        future = entry["futures"].get(persona) if entry else None
+        if future is None:
+            return None
+        try:
+            result = future.result(timeout=max(0.0, self._deadline - time.monotonic()))
+        except TimeoutError:
+            self._stop(entry)
+            return None
+        except Exception:
+            return None  # 예측 생성이 실패하면 평소처럼 새로 요청
+        if result is None or not result["complete"]:
+            return None
+        with _stats_lock:
+            _condition_stats(self.condition_id)["used_tokens"] += result["usage"].total_tokens
+        return result
+
+    @staticmethod
+    def _stop(entry):
+        entry["cancel"].set()
+        for future in entry["futures"].values():
+            future.cancel()
+
+    def discard(self):
+        """Stop every generation still running (e.g. the conversation ended)"""
+        for entry in self.entries:
+            self._stop(entry)
+
+
+def speculate(condition_id, turn, client, build_requests):
+    """Start pre-generating answers for the likely prompts of the next turn.
+
+    build_requests(prompt) must return {persona: request kwargs} exactly as the next turn would
+    send them, so it is called here (the script thread). Nothing is generated unless the condition
+    enables speculation, the circuit is closed and no real request is waiting for the rate limiter.
+    """
+    settings = get_speculation_settings(condition_id)
+    speculation = Speculation(condition_id, turn, settings["threshold"])
+    if not settings["enabled"]:
+        return speculation
+    if get_breaker().state != CLOSED or get_limiter_stats()["waiting"]:
+        with _stats_lock:
+            _condition_stats(condition_id)["skipped"] += 1
+        return speculation
+    for prompt in predict(condition_id, turn, settings["top_k"]):
+        requests = build_requests(prompt)
+        for request in requests.values():
+            request.setdefault("stream", True)
+            request.setdefault("stream_options", {"include_usage": True})
+        speculation.add(client, prompt, requests)
+    if speculation.entries:
+        with _stats_lock:
+            _condition_stats(condition_id)["speculations"] += 1
+    return speculation
+
+
+def get_speculation_stats():
+    """Return hit rate and speculative spend per condition (wasted = generated but never shown)"""
+    with _stats_lock:
+        stats = {cid: dict(s) for cid, s in _stats.items()}
+    for s in stats.values():
+        taken = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / taken, 3) if taken else 0.0
+        s["wasted_tokens"] = s["generated_tokens"] - s["used_tokens"]
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# 지난 대화에서 다음 질문 빈도표 만들기
+# ---------------------------------------------------------------------------
+
+def mine_followups(conversations, min_count=2, per_turn=10):
+    """{condition: {turn: [{"prompt", "count"}]}} from (condition, messages) pairs.
+
+    The turn of a user message is the number of user messages before it, as in the apps'
+    current_turn. Prompts are counted by their normalized text; the most common wording is kept.
+    """
+    counts = defaultdict(Counter)
+    wordings = defaultdict(Counter)
+    for condition_id, messages in conversations:
+        turn = 0
+        for message in messages or []:
+            if message.get("role") != "user":
+                continue
+            key = normalize_prompt(message.get("content"))
+            if key:
+                counts[(condition_id, turn)][key] += 1
+                wordings[key][message["content"].strip()] += 1
+            turn += 1
+    table = defaultdict(dict)
+    for (condition_id, turn), counter in sorted(counts.items()):
+        common = [(key, n) for key, n in counter.most_common(per_turn) if n >= min_count]
+        if common:
+            table[condition_id][str(turn)] = [
+                {"prompt": wordings[key].most_common(1)[0][0], "count": n} for key, n in common
+            ]
+    return dict(table)
+
+
+def _read_jsonl(path):
+    """(condition, messages) of each record of an exported table or a batch_runner output file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            messages = record.get("messages") or record.get("transcript")
+            if isinstance(messages, str):
+                messages = json.loads(messages)
+            if record.get("condition"):
+                yield record["condition"], messages
+
+
+def _read_table(client, table, page_size=1000):
+    start = 0
+    while True:
+        rows = client.table(table).select("condition, messages").range(start, start + page_size - 1).execute().data
+        for row in rows:
+            if row.get("condition"):  # condition 열이 생기기 전에 저장된 행은 조건을 알 수 없어 제외
+                yield row["condition"], row.get("messages")
+        if len(rows) < page_size:
+            return
+        start += page_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mine the follow-up prompt table used for speculative pre-generation")
+    parser.add_argument("files", nargs="*", help="JSONL transcripts (batch_runner output or exported rows)")
+    parser.add_argument("--table", action="append", default=[], help="Supabase table to read (e.g. LLM2)")
+    parser.add_argument("--min-count", type=int, default=2, help="drop prompts seen fewer times")
+    parser.add_argument("--per-turn", type=int, default=10, help="prompts kept per condition and turn")
+    parser.add_argument("--output", default=FOLLOWUPS_PATH)
+    args = parser.parse_args()
+    if not args.files and not args.table:
+        parser.error("give JSONL files and/or --table")
+
+    conversations = []
+    for path in args.files:
+        conversations.extend(_read_jsonl(path))
+    if args.table:
+        from dotenv import load_dotenv
+        from supabase import create_client
+
+        load_dotenv()
+        url = os.getenv("SUPABASE_URL")
+        key = os.getenv("SUPABASE_KEY")
+        if not url or not key:
+            parser.error("SUPABASE_URL and SUPABASE_KEY must be set")
+        client = create_client(url, key)
+        for table in args.table:
+            conversations.extend(_read_table(client, table))
+
+    table = mine_followups(conversations, args.min_count, args.per_turn)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({
+            "description": "Follow-up prompts per condition and turn, mined by 2LLM/speculation.py for speculative pre-generation.",
+            "conversations": len(conversations),
+            "conditions": table,
+        }, indent=2, ensure_ascii=False) + "\n")
+    print(f"{len(conversations)} conversations -> "
+          f"{sum(len(turns) for turns in table.values())} (condition, turn) entries in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
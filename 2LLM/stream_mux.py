@@ -0,0 +1,406 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import similarity_cache
+from circuit_breaker import CIRCUIT_ENABLED, get_breaker
+from fallback_bank import has_fallback, pick_fallback
+from generation_params import get_generation_params, record_latency
+from llm_sidecar import open_llm_stream
+from rate_limiter import acquire_permit, usage_tokens
+from response_cache import completion_key, get_response_cache
+from sentence_budget import SentenceBudget, record_completion, should_shadow
+from stream_render import StreamRenderer
+from token_accounting import estimate_tokens, estimated_usage
+
+try:
+    from streamlit.runtime.scriptrunner_utils.exceptions import RerunException, StopException
+except ImportError:  # streamlit 1.37 이하
+    try:
+        from streamlit.runtime.scriptrunner.exceptions import RerunException, StopException
+    except ImportError:  # streamlit 없이 import된 경우 (batch_runner, 벤치마크)
+        RerunException = StopException = None
+
+# 스크립트 실행이 rerun/세션 종료로 중단될 때 Streamlit이 던지는 예외 (제공자 오류나 버그는 여기에 들지 않음)
+SCRIPT_INTERRUPTS = tuple(e for e in (StopException, RerunException) if e is not None)
+
+# 표시 방식
+SIDE_BY_SIDE = "side_by_side"  # 두 말풍선이 동시에 실시간으로 채워짐
+SEQUENTIAL = "sequential"      # 기존처럼 첫 번째가 끝나는 순간 두 번째 말풍선이 나타남
+
+DEFAULT_DISPLAY = os.getenv("DEBATE_DISPLAY_POLICY", SEQUENTIAL)
+
+# 모든 세션이 공유하는 스트리밍 워커 풀 (세션 수와 무관하게 스레드 수가 제한됨)
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LLM_STREAM_WORKERS", "32")),
+    thread_name_prefix="llm-stream",
+)
+_stats = {"submitted": 0, "running": 0, "failed": 0, "cancelled_streams": 0, "cancelled_tokens": 0}
+_stats_lock = threading.Lock()
+
+
+def chat_job(stream_id, placeholder, template, client, sentence_budget=None, similarity_scope=None,
+             fallback_condition=None, speculation=None, generation_condition=None, **request):
+    """Describe one streamed chat completion to run through stream_concurrently().
+
+    similarity_scope=(condition_id, turn) lets a near-duplicate prompt answered before at the
+    same turn reuse that answer (only for conditions that enable similarity_cache).
+    fallback_condition names the condition whose fallback bank answers while the circuit
+    breaker is open or the model misses its latency SLA.
+    speculation (from speculation.speculate) serves an answer pre-generated for a matching
+    predicted prompt instead of calling the model.
+    generation_condition adds the condition's max_tokens / temperature / stop for this persona
+    (explicit keyword arguments win) and feeds the answer latency to its adaptive max_tokens.
+    A deterministic request (temperature 0) is answered from the response cache when the same
+    request was completed before.
+    """
+    if generation_condition:
+        for name, value in get_generation_params(generation_condition, stream_id).items():
+            request.setdefault(name, value)
+    request.setdefault("stream", True)
+    request.setdefault("stream_options", {"include_usage": True})
+    prompt = request["messages"][-1]["content"]
+    cached = None
+    key = completion_key(request, sentence_budget=sentence_budget)
+    speculated = speculation.take(stream_id, prompt) if speculation is not None else None
+    if speculated is not None:
+        cached = speculated["content"]
+    elif key is not None:
+        # 같은 요청(temperature 0)에 이미 답한 적이 있으면 그 답을 그대로 씀
+        cached = get_response_cache().get(key)
+    if cached is None and speculated is None and similarity_scope:
+        condition_id, turn = similarity_scope
+        cached = similarity_cache.lookup(condition_id, stream_id, turn, prompt)
+    return {
+        "id": stream_id,
+        # 엔드포인트는 라우터가 고르고, 첫 토큰이 늦으면 헤지 요청 / 연결 오류는 재시도 예산 안에서 재시도
+        # (LLM_SIDECAR_ADDRESS가 있으면 사이드카 프로세스에서 실행)
+        "create": lambda: open_llm_stream(client, request, stream_id),
+        "messages": request["messages"],
+        "sentence_budget": sentence_budget,
+        "placeholder": placeholder,
+        "template": template,
+        "similarity_scope": similarity_scope,
+        "completion_key": key,
+        "max_tokens": request.get("max_tokens"),
+        # 이 턴에 실제로 쓴 생성 파라미터 (대화 기록에 남겨서 분석할 때 참가자별로 확인)
+        "generation": {name: request[name] for name in ("max_tokens", "temperature", "stop") if name in request},
+        "generation_condition": generation_condition,
+        "prompt": prompt,
+        "cached": cached,
+        # 미리 생성한 답은 실제로 쓴 토큰이 있으므로 usage도 함께 넘김
+        "cached_usage": speculated["usage"] if speculated is not None else None,
+        "speculated": speculated is not None,
+        "fallback": None,
+        "has_fallback": CIRCUIT_ENABLED and bool(fallback_condition) and has_fallback(fallback_condition, stream_id),
+        "fallback_condition": fallback_condition,
+        "abandon": threading.Event(),
+    }
+
+
+def read_stream(stream, on_delta, persona, messages, sentence_budget=None, cancelled=None, record=True):
+    """Read a chat completion stream, passing each text delta to on_delta.
+
+    With a sentence budget the upstream stream is closed as soon as that many sentences
+    have arrived (usage is then estimated locally). The stream is also closed when
+    cancelled() turns true or the reader is interrupted (e.g. by a Streamlit rerun).
+    record=False keeps the answer out of the sentence-budget statistics (speculative reads).
+    Returns the usage object (None if cancelled).
+    """
+    budget = SentenceBudget(sentence_budget) if sentence_budget else None
+    usage = None
+    overflow = None  # 예산 이후에도 끝까지 읽는(shadow) 경우 넘친 텍스트
+    try:
+        for chunk in stream:
+            if cancelled is not None and cancelled():
+                # 화면 쪽이 중단됨: 남은 생성(과금)을 막기 위해 바로 연결을 끊음
+                stream.close()
+                return None
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                if budget is None:
+                    on_delta(delta)
+                elif overflow is not None:
+                    overflow += delta
+                else:
+                    kept = budget.feed(delta)
+                    if kept:
+                        on_delta(kept)
+                    if budget.reached:
+                        if record and should_shadow():
+                            overflow = budget.discarded
+                            continue
+                        # 정해진 문장 수에 도달하면 바로 연결을 끊어서 남은 토큰 생성을 막음
+                        stream.close()
+                        break
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+    except BaseException:
+        # 읽는 도중 rerun/세션 종료/오류로 빠져나가도 업스트림 연결은 끊음
+        stream.close()
+        raise
+
+    if budget is not None:
+        truncated = budget.reached
+        if record:
+            record_completion(persona, budget.text, truncated, overflow)
+        if usage is None and truncated:
+            usage = estimated_usage(messages, budget.text)
+    return usage
+
+
+def record_cancelled(texts):
+    """Account streams cut off by a rerun or a closed session; returns the tokens they had produced"""
+    tokens = sum(estimate_tokens(text) for text in texts)
+    with _stats_lock:
+        _stats["cancelled_streams"] += len(texts)
+        _stats["cancelled_tokens"] += tokens
+    return tokens
+
+
+def assistant_message(stream_id, result):
+    """Chat history entry for a finished stream (fallback and pre-generated answers are flagged for analysts)"""
+    message = {"role": "assistant", "content": result["content"], "type": stream_id}
+    if result.get("fallback"):
+        message["fallback"] = True
+    if result.get("speculated"):
+        message["speculated"] = True
+    if result.get("generation"):
+        message["generation"] = result["generation"]
+    return message
+
+
+def fallback_turns(messages):
+    """[{"turn", "type"}] of the answers in a chat history that were served from the fallback bank"""
+    turns = []
+    turn = 0
+    for message in messages:
+        if message["role"] == "user":
+            turn += 1
+        elif message.get("fallback"):
+            turns.append({"turn": turn, "type": message.get("type")})
+    return turns
+
+
+def cancelled_messages(partial):
+    """Chat history entries for a turn that was interrupted mid-stream (flagged so analysts can exclude them)"""
+    return [
+        {"role": "assistant", "content": text, "type": stream_id, "cancelled": True}
+        for stream_id, text in partial.items() if text
+    ]
+
+
+def _pump(job, events, cancel):
+    """Worker thread: read one upstream stream and forward its deltas to the script thread"""
+    stream_id = job["id"]
+    with _stats_lock:
+        _stats["running"] += 1
+    usage = None
+    breaker = get_breaker()
+    started = time.monotonic()
+    try:
+        try:
+            stream = job["create"]()
+        except Exception:
+            if not job["abandon"].is_set():
+                breaker.record(error=True)
+            raise
+        # 첫 토큰까지 걸린 시간 (SLA를 넘겨 이미 대체 답변으로 바뀐 작업은 스크립트 쪽에서 기록함)
+        if not job["abandon"].is_set():
+            breaker.record(latency=time.monotonic() - started)
+        job["endpoint"] = stream.endpoint
+        usage = read_stream(
+            stream,
+            lambda delta: events.put(("delta", stream_id, delta)),
+            stream_id,
+            job["messages"],
+            job.get("sentence_budget"),
+            lambda: cancel.is_set() or job["abandon"].is_set(),
+        )
+        if job["generation_condition"] and not (cancel.is_set() or job["abandon"].is_set()):
+            # 요청부터 마지막 토큰까지 걸린 시간으로 max_tokens를 조정
+            record_latency(job["generation_condition"], stream_id, time.monotonic() - started)
+        events.put(("done", stream_id, usage))
+    except Exception as e:
+        # 예외는 스크립트 스레드로 넘겨서 그쪽에서 다시 발생시킴
+        with _stats_lock:
+            _stats["failed"] += 1
+        events.put(("error", stream_id, e))
+    finally:
+        # 요청 전에 차감한 추정 토큰을 실제 usage로 정산
+        job["permit"].release(usage_tokens(usage))
+        with _stats_lock:
+            _stats["running"] -= 1
+
+
+def get_mux_stats():
+    """Return worker pool usage (queued = submitted jobs still waiting for a free worker)"""
+    with _stats_lock:
+        stats = dict(_stats, max_workers=_executor._max_workers)
+    stats["queued"] = _executor._work_queue.qsize()
+    return stats
+
+
+def stream_concurrently(jobs, display=None, on_cancel=None, on_queue=None):
+    """Start every job at once and render all streams from the calling (script) thread.
+
+    Worker threads never touch Streamlit; only this function calls placeholder.markdown,
+    so it must be called from the script thread.
+    Returns {id: {"content", "usage", "cached", "speculated", "fallback", "endpoint", "generation"}}.
+
+    If the script is interrupted while streaming (rerun, st.stop, closed session), the
+    workers close their upstream streams, on_cancel({id: partial text}) is called and the
+    interruption is re-raised.
+
+    Requests are admitted through the process-wide rate limiter first; while they wait,
+    on_queue(position) is called from this thread (and on_queue(0) once admitted).
+
+    Jobs with a fallback bank are answered from it (flagged "fallback") while the circuit
+    breaker is open, when no first token arrives within the latency SLA, or when the call fails.
+    """
+    display = display or DEFAULT_DISPLAY
+    events = queue.Queue()
+    order = [job["id"] for job in jobs]
+    # 말풍선마다 렌더러 하나 (델타를 모아서 일정 간격으로만 다시 그림)
+    renderers = {job["id"]: StreamRenderer(job["placeholder"], job["template"]) for job in jobs}
+    usage = {stream_id: None for stream_id in order}
+    done = set()
+    failed = set()
+    active = 0  # SEQUENTIAL에서 현재 화면에 스트리밍 중인 작업의 위치
+
+    def visible(stream_id):
+        return display == SIDE_BY_SIDE or order[active] == stream_id
+
+    by_id = {job["id"]: job for job in jobs}
+    breaker = get_breaker()
+
+    def serve_fallback(job):
+        # 모델 대신 대체 답변을 표시 (이 작업의 워커가 보내는 이벤트는 이후 무시)
+        job["abandon"].set()
+        job["fallback"] = pick_fallback(job["fallback_condition"], job["id"], job["prompt"])
+        events.put(("fallback", job["id"], job["fallback"]))
+
+    live = [job for job in jobs if job["cached"] is None]
+    for job in jobs:
+        if job["cached"] is not None:
+            # 비슷한 질문에 이미 답한 적이 있으면 요청 없이 그 답을 바로 표시
+            events.put(("delta", job["id"], job["cached"]))
+            events.put(("done", job["id"], job["cached_usage"]))
+    # 회로가 열려 있으면 (모델 오류/지연이 많음) 대체 답변이 있는 작업은 요청을 보내지 않음
+    if any(job["has_fallback"] for job in live) and not breaker.allow():
+        for job in live:
+            if job["has_fallback"]:
+                serve_fallback(job)
+        live = [job for job in live if job["fallback"] is None]
+    # 첫 토큰이 SLA 안에 안 오면 대체 답변으로 바꿀 작업 -> 기한
+    deadlines = {}
+    cancel = threading.Event()
+    futures = []
+    error = None
+    finished = False
+    try:
+        # 요청 한도를 넘으면 여기서 순서대로 기다림 (대기 순번은 on_queue로 화면에 표시)
+        # 허가를 받은 작업은 바로 시작해야 동시 실행 한도가 1이어도 다음 작업이 진행됨
+        for job in live:
+            job["permit"] = acquire_permit(job["messages"], on_queue, job["max_tokens"])
+            with _stats_lock:
+                _stats["submitted"] += 1
+            if job["has_fallback"]:
+                deadlines[job["id"]] = time.monotonic() + breaker.latency_sla
+            futures.append(_executor.submit(_pump, job, events, cancel))
+
+        while len(done) < len(order):
+            timeout = max(0.0, min(deadlines.values()) - time.monotonic()) if deadlines else None
+            try:
+                kind, stream_id, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                for stream_id, deadline in list(deadlines.items()):
+                    if deadline <= time.monotonic():
+                        del deadlines[stream_id]
+                        breaker.record(latency=breaker.latency_sla + (time.monotonic() - deadline))
+                        serve_fallback(by_id[stream_id])
+                continue
+            job = by_id[stream_id]
+            if job["fallback"] is not None and kind != "fallback":
+                continue  # 대체 답변으로 바뀐 작업의 늦게 도착한 이벤트
+            deadlines.pop(stream_id, None)
+            if kind == "error" and job["has_fallback"] and not renderers[stream_id].text:
+                # 첫 토큰 전에 실패하면 오류 대신 대체 답변
+                serve_fallback(job)
+                continue
+            if kind == "fallback":
+                # 대체 답변은 한 번에 표시하고 바로 완료 처리
+                kind = "done"
+                if visible(stream_id):
+                    renderers[stream_id].update(payload)
+                else:
+                    renderers[stream_id].hold(payload)
+                payload = None
+            if kind == "error":
+                error = error or payload
+                done.add(stream_id)
+                failed.add(stream_id)
+            elif kind == "delta":
+                if visible(stream_id):
+                    renderers[stream_id].update(payload)
+                else:
+                    renderers[stream_id].hold(payload)
+            else:
+                usage[stream_id] = payload
+                done.add(stream_id)
+                if visible(stream_id):
+                    renderers[stream_id].finish()
+
+            # SEQUENTIAL: 앞선 말풍선이 끝나면 다음 말풍선에 그동안 쌓인 내용을 바로 표시
+            while display != SIDE_BY_SIDE and active < len(order) - 1 and order[active] in done:
+                active += 1
+                next_id = order[active]
+                if next_id in failed:
+                    continue
+                if next_id in done:
+                    renderers[next_id].finish()
+                else:
+                    renderers[next_id].flush()
+        finished = True
+    except SCRIPT_INTERRUPTS:
+        # rerun/세션 종료로 중단됨: 워커가 다음 청크에서 연결을 끊도록 알리고 기다리지 않음
+        cancel.set()
+        record_cancelled([renderers[stream_id].text for stream_id in order if stream_id not in done])
+        if on_cancel is not None:
+            on_cancel({stream_id: renderers[stream_id].text for stream_id in order})
+        raise
+    except BaseException:
+        # 그 밖의 오류는 취소로 세지 않고 워커만 멈춤
+        cancel.set()
+        raise
+    finally:
+        if finished:
+            # 워커가 모두 끝날 때까지 기다린 뒤 반환 (스레드가 세션 밖으로 새지 않도록)
+            # 대체 답변으로 바뀐 작업은 멈춘 요청일 수 있으므로 기다리지 않음 (첫 토큰이 오면 스스로 끊음)
+            for job, future in zip(live, futures):
+                if job["fallback"] is None:
+                    future.result()
+
+    if error is not None:
+        raise error
+    for job in live:
+        if job["completion_key"] and job["fallback"] is None and renderers[job["id"]].text:
+            get_response_cache().set(job["completion_key"], renderers[job["id"]].text)
+        if job["similarity_scope"] and job["fallback"] is None:
+            condition_id, turn = job["similarity_scope"]
+            similarity_cache.store(condition_id, job["id"], turn, job["prompt"], renderers[job["id"]].text)
+    return {
+        job["id"]: {
+            "content": renderers[job["id"]].text,
+            "usage": usage[job["id"]],
+            "cached": job["cached"] is not None,
+            "speculated": job["speculated"],
+            "fallback": job["fallback"] is not None,
+            "endpoint": job.get("endpoint"),
+            # 모델이 생성하지 않은 답(유사 질문 캐시, 대체 답변)에는 생성 파라미터를 남기지 않음
+            "generation": job["generation"] if (job["cached"] is None or job["speculated"]) and job["fallback"] is None else {},
+        }
+        for job in jobs
+    }
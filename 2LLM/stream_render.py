@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+CURSOR = "▌"
+
+# 토큰마다 다시 그리지 않고 이 시간/글자 수만큼 모아서 한 번에 그림 (0이면 해당 조건 사용 안 함)
+RENDER_INTERVAL = float(os.getenv("STREAM_RENDER_INTERVAL_MS", "50")) / 1000
+RENDER_MAX_PENDING_CHARS = int(os.getenv("STREAM_RENDER_MAX_PENDING_CHARS", "0"))
+
+# 프로세스 전체 누적 통계
+_stats = {"renders": 0, "deltas": 0, "bytes_sent": 0, "bytes_naive": 0}
+_stats_lock = threading.Lock()
+
+
+class StreamRenderer:
+    """Coalesce streamed deltas into a few placeholder.markdown calls.
+
+    Every markdown call re-sends the whole bubble, so rendering once per token costs
+    O(n^2) bytes. The renderer only re-renders when RENDER_INTERVAL has passed (or
+    RENDER_MAX_PENDING_CHARS have piled up) and always renders the final text in finish().
+    """
+
+    def __init__(self, placeholder, template="{}", unsafe_allow_html=True,
+                 interval=RENDER_INTERVAL, max_pending_chars=RENDER_MAX_PENDING_CHARS):
+        self.placeholder = placeholder
+        self.template = template
+        self.unsafe_allow_html = unsafe_allow_html
+        self.interval = interval
+        self.max_pending_chars = max_pending_chars
+        self.text = ""
+        self.stats = {"renders": 0, "deltas": 0, "bytes_sent": 0, "bytes_naive": 0}
+        self._pending_chars = 0
+        self._last_render = 0.0
+        self._text_bytes = 0
+        # 템플릿 자체 크기 (토큰마다 그렸다면 매번 보냈을 바이트 계산용)
+        self._overhead_bytes = len(template.format(CURSOR).encode())
+
+    def _render(self, cursor):
+        html = self.template.format(self.text + cursor)
+        self.placeholder.markdown(html, unsafe_allow_html=self.unsafe_allow_html)
+        self.stats["renders"] += 1
+        self.stats["bytes_sent"] += len(html.encode())
+        self._pending_chars = 0
+        self._last_render = time.monotonic()
+
+    def hold(self, delta):
+        """Accumulate text without rendering (e.g. a bubble that is not revealed yet)"""
+        self.text += delta
+        self._text_bytes += len(delta.encode())
+        self._pending_chars += len(delta)
+
+    def update(self, delta):
+        """Append a delta and re-render only if the time or character budget is used up"""
+        self.hold(delta)
+        self.stats["deltas"] += 1
+        self.stats["bytes_naive"] += self._overhead_bytes + self._text_bytes
+
+        due = self.interval and time.monotonic() - self._last_render >= self.interval
+        full = self.max_pending_chars and self._pending_chars >= self.max_pending_chars
+        if due or full or not (self.interval or self.max_pending_chars):
+            self._render(CURSOR)
+
+    def flush(self):
+        """Render the current text right away (with the typing cursor)"""
+        self._render(CURSOR)
+
+    def finish(self, text=None):
+        """Render the final text without the cursor and add this stream to the process totals"""
+        if text is not None:
+            self.text = text
+        self._render("")
+        with _stats_lock:
+            for key, value in self.stats.items():
+                _stats[key] += value
+        return self.text
+
+    @property
+    def bytes_saved(self):
+        return max(0, self.stats["bytes_naive"] - self.stats["bytes_sent"])
+
+
+def get_render_stats():
+    """Return process-wide render totals, including how many bytes coalescing saved"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["bytes_saved"] = max(0, stats["bytes_naive"] - stats["bytes_sent"])
+    return stats
@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+
+import httpx
+from supabase import ClientOptions, create_client
+
+# llm_client와 같은 방식: 모듈은 rerun 사이에도 프로세스에 남으므로 여기 만든 클라이언트를 모든 세션이 공유
+_clients = {}
+_clients_lock = threading.Lock()
+_stats = {"clients_created": 0, "client_requests": 0, "health_checks": 0, "health_failures": 0}
+_last_health = None
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def get_pool_config():
+    """Return the Supabase connection pool limits and timeouts (overridable with environment variables)"""
+    return {
+        "max_connections": _env_int("SUPABASE_POOL_MAX_CONNECTIONS", 20),
+        "max_keepalive_connections": _env_int("SUPABASE_POOL_MAX_KEEPALIVE", 10),
+        "keepalive_expiry": _env_float("SUPABASE_POOL_KEEPALIVE_EXPIRY", 60.0),
+        "connect_timeout": _env_float("SUPABASE_CONNECT_TIMEOUT", 5.0),
+        "read_timeout": _env_float("SUPABASE_READ_TIMEOUT", 30.0),
+    }
+
+
+def _build_http_client(config):
+    limits = httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive_connections"],
+        keepalive_expiry=config["keepalive_expiry"],
+    )
+    timeout = httpx.Timeout(config["read_timeout"], connect=config["connect_timeout"])
+    return httpx.Client(limits=limits, timeout=timeout, follow_redirects=True)
+
+
+def _build_client(url, key, http_client):
+    # 앱은 로그인 세션을 쓰지 않음: 공유 클라이언트에 사용자 세션이 남거나 갱신 타이머가 돌지 않도록 끔
+    options = {"auto_refresh_token": False, "persist_session": False}
+    try:
+        return create_client(url, key, options=ClientOptions(httpx_client=http_client, **options))
+    except TypeError:
+        # httpx_client 옵션이 없는 예전 supabase 버전: 클라이언트 하나를 공유하는 것만으로도 연결이 재사용됨
+        return create_client(url, key, options=ClientOptions(**options))
+
+
+def get_supabase(url, key):
+    """Return the process-wide Supabase client for this project, creating it on first use"""
+    cache_key = (url, key)
+    with _clients_lock:
+        _stats["client_requests"] += 1
+        entry = _clients.get(cache_key)
+        if entry is None:
+            http_client = _build_http_client(get_pool_config())
+            entry = (_build_client(url, key, http_client), http_client)
+            _clients[cache_key] = entry
+            _stats["clients_created"] += 1
+        return entry[0]
+
+
+def check_supabase_health(url, key, timeout=3.0):
+    """Probe the project's REST endpoint over the shared pool; returns {"ok", "status", "latency_ms", "error"}"""
+    global _last_health
+    get_supabase(url, key)
+    with _clients_lock:
+        http_client = _clients[(url, key)][1]
+    started = time.monotonic()
+    status, error = None, None
+    try:
+        response = http_client.get(
+            url.rstrip("/") + "/rest/v1/",
+            headers={"apikey": key, "Authorization": f"Bearer {key}"},
+            timeout=timeout,
+        )
+        status = response.status_code
+        ok = status < 500
+    except httpx.HTTPError as e:
+        ok, error = False, f"{type(e).__name__}: {e}"
+    result = {"ok": ok, "status": status, "latency_ms": round((time.monotonic() - started) * 1000), "error": error}
+    with _clients_lock:
+        _stats["health_checks"] += 1
+        _stats["health_failures"] += not ok
+        _last_health = dict(result, at=time.time())
+    return result
+
+
+def get_supabase_stats():
+    """Return how many clients were built versus requested, plus the last health probe"""
+    with _clients_lock:
+        return dict(_stats, clients_alive=len(_clients), last_health=_last_health)
+
+
+def close_supabase_clients():
+    """Close every pooled client (used by benchmarks and at interpreter shutdown)"""
+    with _clients_lock:
+        for _, http_client in _clients.values():
+            http_client.close()
+        _clients.clear()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if not os.getenv("SUPABASE_URL") or not os.getenv("SUPABASE_KEY"):
+        raise SystemExit("SUPABASE_URL and SUPABASE_KEY must be set")
+    health = check_supabase_health(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+    print(health)
+    raise SystemExit(0 if health["ok"] else 1)
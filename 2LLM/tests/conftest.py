@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 앱 모듈은 2LLM/ 안에서 평평하게 import됨 (streamlit run 2LLM/app.py와 같은 방식)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,32 @@
+import pytest
+
+import endpoint_router
+from llm_client import get_shared_client
+
+
+@pytest.fixture
+def fresh_router(monkeypatch):
+    monkeypatch.setattr(endpoint_router, "_router", None)
+    monkeypatch.setattr(endpoint_router, "LLM_ENDPOINTS_FILE", "")
+
+
+def test_router_is_built_on_first_use(fresh_router, monkeypatch):
+    monkeypatch.setattr(
+        endpoint_router, "LLM_ENDPOINTS",
+        '[{"name": "a", "base_url": "http://127.0.0.1:1/v1", "api_key": "k", "model": "m"}]',
+    )
+    router = endpoint_router.get_router()
+    assert [e.name for e in router.endpoints] == ["a"]
+    assert endpoint_router.get_router() is router
+
+
+@pytest.mark.parametrize("raw", ['[{"name": "a"', '[{"name": "a", "base_url": "http://127.0.0.1:1/v1"}]'])
+def test_malformed_endpoints_fall_back_to_the_default(fresh_router, monkeypatch, caplog, raw):
+    monkeypatch.setattr(endpoint_router, "LLM_ENDPOINTS", raw)
+    router = endpoint_router.get_router()
+    assert router.endpoints == []
+    assert "LLM_ENDPOINTS" in caplog.text
+    client = get_shared_client("http://127.0.0.1:1/v1", "k")
+    endpoint = router.pick(client, {"model": "m"})
+    assert endpoint.client is client and endpoint.model == "m"
+    router.finish(endpoint)
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+import hedged_request
+import rate_limiter
+
+
+class FakeStream:
+    def __init__(self, delay, chunks=("a", "b")):
+        self.delay = delay
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        time.sleep(self.delay)
+        yield from self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+def make_create(delays):
+    streams = []
+
+    def create():
+        stream = FakeStream(delays[len(streams)])
+        streams.append(stream)
+        return stream
+
+    return create, streams
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    limiter = rate_limiter.RateLimiter(rpm=0, tpm=0, max_in_flight=1)
+    monkeypatch.setattr(rate_limiter, "_limiter", limiter)
+    monkeypatch.setattr(hedged_request, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(hedged_request, "hedge_delay", lambda: 0.05)
+    monkeypatch.setattr(hedged_request, "_budget", hedged_request.RETRY_BUDGET_MAX)
+    return limiter
+
+
+REQUEST = {"messages": [{"role": "user", "content": "hi"}], "max_tokens": 16}
+
+
+def test_hedge_wins_and_its_permit_is_returned(limiter):
+    create, streams = make_create([0.5, 0.0])
+    stream = hedged_request.open_stream(create, request=REQUEST)
+    assert list(stream) == ["a", "b"]
+    assert [a["kind"] for a in stream.attempts] == ["primary", "hedge"]
+    assert limiter.get_stats()["in_flight"] == 0
+    time.sleep(0.6)
+    assert streams[0].closed  # 진 주 요청은 첫 토큰이 오자마자 닫힘
+
+
+def test_hedge_is_skipped_when_the_limiter_is_full(limiter):
+    permit = limiter.acquire(10)  # 호출한 쪽이 들고 있는 주 요청의 허가
+    before = hedged_request.get_hedge_stats()["hedges_rate_limited"]
+    create, streams = make_create([0.2])
+    stream = hedged_request.open_stream(create, request=REQUEST)
+    assert list(stream) == ["a", "b"]
+    assert len(streams) == 1
+    assert hedged_request.get_hedge_stats()["hedges_rate_limited"] == before + 1
+    permit.release()
+
+
+def test_attempts_run_on_the_bounded_pool(limiter):
+    before = threading.active_count()
+    for _ in range(20):
+        list(hedged_request.open_stream(lambda: FakeStream(0.0), request=REQUEST))
+    assert threading.active_count() - before <= hedged_request.HEDGE_ATTEMPT_WORKERS
+
+
+def test_hedge_uses_the_callers_limiter(limiter):
+    batch = rate_limiter.RateLimiter(rpm=0, tpm=0, max_in_flight=1)
+    permit = batch.acquire(10)  # 배치 한도는 가득 참, 프로세스 전체 한도는 비어 있음
+    create, streams = make_create([0.2])
+    stream = hedged_request.open_stream(create, request=REQUEST, limiter=batch)
+    assert list(stream) == ["a", "b"]
+    assert len(streams) == 1
+    assert batch.get_stats()["denied"] == 1 and limiter.get_stats()["in_flight"] == 0
+    permit.release()
@@ -0,0 +1,159 @@
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import pytest
+from openai.types.chat import ChatCompletionChunk
+
+import llm_sidecar
+from llm_client import get_shared_client
+
+SIDECAR_BASE_URL = "http://127.0.0.1:1/v1"
+
+
+def make_chunk(text):
+    return ChatCompletionChunk.model_validate({
+        "id": "c", "object": "chat.completion.chunk", "created": 0, "model": "m",
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}],
+    })
+
+
+class FakeStream:
+    endpoint = None
+
+    def __init__(self, texts):
+        self.texts = texts
+
+    def __iter__(self):
+        for text in self.texts:
+            yield make_chunk(text)
+
+    def close(self):
+        pass
+
+
+class FakeRouter:
+    def __init__(self):
+        self.calls = []
+
+    def create_stream(self, client, request, label=None):
+        self.calls.append((client, request))
+        return FakeStream(["안녕", "하세요"])
+
+
+@pytest.fixture
+def router(monkeypatch):
+    router = FakeRouter()
+    monkeypatch.setattr(llm_sidecar, "get_router", lambda: router)
+    monkeypatch.setattr(llm_sidecar, "open_stream", lambda create, label=None, request=None, limiter=None: create())
+    return router
+
+
+@pytest.fixture
+def sidecar(tmp_path, monkeypatch, router):
+    address = str(tmp_path / "sidecar.sock")
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_ADDRESS", address)
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_AUTHKEY", "test-key")
+    server = llm_sidecar.SidecarServer(address, workers=2, providers=[(SIDECAR_BASE_URL, "sidecar-key")])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while not (tmp_path / "sidecar.sock").exists():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return server
+
+
+def test_server_refuses_to_start_without_authkey(monkeypatch):
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_AUTHKEY", "")
+    with pytest.raises(llm_sidecar.SidecarError):
+        llm_sidecar.SidecarServer("127.0.0.1:0", providers=[(SIDECAR_BASE_URL, "k")])
+
+
+def test_server_refuses_non_loopback_address(monkeypatch):
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_AUTHKEY", "test-key")
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_ALLOW_REMOTE", False)
+    with pytest.raises(llm_sidecar.SidecarError):
+        llm_sidecar.SidecarServer("0.0.0.0:8765", providers=[(SIDECAR_BASE_URL, "k")])
+
+
+def test_app_does_not_connect_without_authkey(monkeypatch, router):
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_ADDRESS", "127.0.0.1:1")
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_AUTHKEY", "")
+    monkeypatch.setattr(llm_sidecar, "Client", lambda *a, **k: pytest.fail("connected without an authkey"))
+    stream = llm_sidecar.open_llm_stream("app-client", {"model": "m", "messages": []})
+    assert [chunk.choices[0].delta.content for chunk in stream] == ["안녕", "하세요"]
+    assert router.calls[0][0] == "app-client"
+
+
+def test_stream_uses_sidecar_credentials(sidecar, router, monkeypatch):
+    sent = []
+    real_client = llm_sidecar.Client
+
+    def recording_client(*args, **kwargs):
+        conn = real_client(*args, **kwargs)
+        send = conn.send
+        conn.send = lambda message: (sent.append(message), send(message))[1]
+        return conn
+
+    monkeypatch.setattr(llm_sidecar, "Client", recording_client)
+    request = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    stream = llm_sidecar.open_llm_stream(get_shared_client(SIDECAR_BASE_URL + "/", "app-key"), request)
+    assert isinstance(stream, llm_sidecar.SidecarStream)
+    assert [chunk.choices[0].delta.content for chunk in stream] == ["안녕", "하세요"]
+    assert set(sent[0]) == {"op", "job_id", "label", "request", "base_url"}
+    assert "app-key" not in repr(sent[0])
+    client, received = router.calls[0]
+    assert client is sidecar.clients[SIDECAR_BASE_URL] and client.api_key == "sidecar-key"
+    assert received == request
+
+
+def test_other_endpoint_runs_in_the_app(sidecar, router):
+    app_client = get_shared_client("http://127.0.0.1:2/v1", "app-key")
+    stream = llm_sidecar.open_llm_stream(app_client, {"model": "m", "messages": []})
+    assert not isinstance(stream, llm_sidecar.SidecarStream)
+    assert [chunk.choices[0].delta.content for chunk in stream] == ["안녕", "하세요"]
+    assert router.calls[0][0] is app_client
+    assert llm_sidecar.get_sidecar_stats()["jobs"] == 0
+
+
+def test_hung_sidecar_falls_back_in_process(tmp_path, monkeypatch, router):
+    address = str(tmp_path / "hung.sock")
+    listener = Listener(address, authkey=b"test-key")
+    accepted = []
+
+    def accept_and_hang():
+        conn = listener.accept()
+        accepted.append(conn)
+        conn.recv()  # 요청은 받지만 답하지 않음
+
+    threading.Thread(target=accept_and_hang, daemon=True).start()
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_ADDRESS", address)
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_AUTHKEY", "test-key")
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_TIMEOUT", 0.2)
+    app_client = get_shared_client(SIDECAR_BASE_URL, "app-key")
+    started = time.monotonic()
+    stream = llm_sidecar.open_llm_stream(app_client, {"model": "m", "messages": []})
+    assert time.monotonic() - started < 2
+    assert [chunk.choices[0].delta.content for chunk in stream] == ["안녕", "하세요"]
+    assert router.calls[0][0] is app_client
+    listener.close()
+
+
+def test_wrong_authkey_is_rejected(sidecar):
+    with pytest.raises(AuthenticationError):
+        Client(llm_sidecar._address(llm_sidecar.LLM_SIDECAR_ADDRESS), authkey=b"wrong")
+    # 잘못된 연결을 버린 뒤에도 서버는 계속 동작
+    assert llm_sidecar.get_sidecar_stats()["jobs"] == 0
+
+
+def test_provider_credentials_follow_the_apps_settings(tmp_path, monkeypatch):
+    secrets = tmp_path / "secrets.toml"
+    secrets.write_text('OPENAI_API_BASE = "https://example.test/v1"\nOPENAI_API_KEY = "secret-key"\n', encoding="utf-8")
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_SECRETS", str(secrets))
+    monkeypatch.setattr(llm_sidecar, "LLM_SIDECAR_BASE_URL", "")
+    monkeypatch.setenv("GITHUB_TOKEN", "gh-token")
+    monkeypatch.delenv("GITHUB_ENDPOINT", raising=False)
+    assert llm_sidecar.provider_credentials() == [
+        ("https://example.test/v1", "secret-key"), ("https://models.github.ai/inference", "gh-token"),
+    ]
@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+
+import prefix_cache
+
+
+def usage(prompt_tokens, cached=None):
+    details = SimpleNamespace(cached_tokens=cached) if cached is not None else None
+    return SimpleNamespace(prompt_tokens=prompt_tokens, prompt_tokens_details=details)
+
+
+def test_unreported_cached_tokens_stay_none(monkeypatch):
+    monkeypatch.setattr(prefix_cache, "_stats", {})
+    assert prefix_cache.record_cached_tokens("app2", usage(100), None) is None
+    assert prefix_cache.record_cached_tokens("app2", usage(100), usage(200, cached=0)) == 0
+    assert prefix_cache.record_cached_tokens("app2", usage(300, cached=128), usage(100)) == 128
+    stats = prefix_cache.get_prefix_cache_stats()["app2"]
+    # 캐시 정보를 준 호출만 적중률 분모에 들어감
+    assert (stats["calls"], stats["reported"], stats["prompt_tokens"], stats["cached_tokens"]) == (5, 2, 500, 128)
@@ -0,0 +1,39 @@
+import pytest
+
+import response_cache
+import stream_mux
+
+MESSAGES = [
+    {"role": "system", "content": "You are Purpli."},
+    {"role": "user", "content": "AI가 일자리를 없앨까요?"},
+]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = response_cache.ResponseCache(response_cache.MemoryBackend())
+    monkeypatch.setattr(response_cache, "_cache", cache)
+    return cache
+
+
+def test_only_deterministic_requests_have_a_key():
+    request = {"model": "m", "messages": MESSAGES, "temperature": 0, "stream": True}
+    key = response_cache.completion_key(request)
+    assert key is not None
+    # 전송 방식과 공백 차이는 키에 영향 없음
+    spaced = [dict(MESSAGES[0]), {"role": "user", "content": "AI가  일자리를 없앨까요? "}]
+    assert response_cache.completion_key({"model": "m", "messages": spaced, "temperature": 0}) == key
+    assert response_cache.completion_key(dict(request, max_tokens=64)) != key
+    assert response_cache.completion_key(request, sentence_budget=2) != key
+    assert response_cache.completion_key(dict(request, temperature=0.7)) is None
+    assert response_cache.completion_key({"model": "m", "messages": MESSAGES}) is None
+
+
+def test_chat_job_reuses_a_stored_deterministic_answer(cache):
+    job = stream_mux.chat_job("pro", None, "{}", None, messages=MESSAGES, model="m", temperature=0)
+    assert job["cached"] is None and job["completion_key"]
+    cache.set(job["completion_key"], "이전 답변")
+    again = stream_mux.chat_job("pro", None, "{}", None, messages=MESSAGES, model="m", temperature=0)
+    assert again["cached"] == "이전 답변"
+    varied = stream_mux.chat_job("pro", None, "{}", None, messages=MESSAGES, model="m", temperature=0.7)
+    assert varied["cached"] is None and varied["completion_key"] is None
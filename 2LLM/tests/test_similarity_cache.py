@@ -0,0 +1,60 @@
+import pytest
+
+import similarity_cache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(similarity_cache, "_index", {})
+    monkeypatch.setattr(similarity_cache, "_stats", {})
+    monkeypatch.setattr(
+        similarity_cache, "get_similarity_settings", lambda condition_id: {"enabled": True, "threshold": 0.8}
+    )
+    return similarity_cache
+
+
+def test_normalize_prompt():
+    assert similarity_cache.normalize_prompt("  AI가 일자리를   없앨까요?! ") == "ai가 일자리를 없앨까요"
+    assert similarity_cache.normalize_prompt(None) == ""
+
+
+def test_similarity_of_signatures():
+    sig = similarity_cache.minhash
+    assert sig("ai가 일자리를 없앨까요") == sig("ai가 일자리를 없앨까요")
+    assert similarity_cache.similarity(sig("ai가 일자리를 없앨까요"), sig("ai가 일자리를 없앨까요")) == 1.0
+    near = similarity_cache.similarity(sig("ai가 일자리를 없앨까요"), sig("ai가 일자리를 없앨까"))
+    far = similarity_cache.similarity(sig("ai가 일자리를 없앨까요"), sig("원자력 발전은 안전한가"))
+    assert near > far
+    assert far < 0.3
+
+
+def test_near_duplicate_hits_within_scope(cache):
+    cache.store("app2", "pro", 1, "AI가 일자리를 없앨까요?", "찬성 답변")
+    assert cache.lookup("app2", "pro", 1, "ai가 일자리를 없앨까요") == "찬성 답변"
+    # 페르소나와 턴이 다르면 같은 질문이라도 쓰지 않음
+    assert cache.lookup("app2", "con", 1, "AI가 일자리를 없앨까요?") is None
+    assert cache.lookup("app2", "pro", 2, "AI가 일자리를 없앨까요?") is None
+    assert cache.lookup("app2", "pro", 1, "원자력 발전은 안전한가?") is None
+    stats = cache.get_similarity_stats()["app2"]
+    assert (stats["lookups"], stats["hits"], stats["stores"]) == (4, 1, 1)
+
+
+def test_oldest_entries_are_evicted(cache, monkeypatch):
+    monkeypatch.setattr(similarity_cache, "MAX_ENTRIES_PER_SCOPE", 2)
+    prompts = ["AI가 일자리를 없앨까요?", "원자력 발전은 안전한가?", "기본소득이 필요한가?"]
+    for i, prompt in enumerate(prompts):
+        cache.store("app2", "pro", 1, prompt, f"answer {i}")
+    assert cache.lookup("app2", "pro", 1, prompts[0]) is None
+    assert cache.lookup("app2", "pro", 1, prompts[2]) == "answer 2"
+    scope = similarity_cache._index[("app2", "pro", 1)]
+    assert all(entry in scope["entries"] for bucket in scope["buckets"].values() for entry in bucket)
+
+
+def test_disabled_condition_stores_nothing(monkeypatch):
+    monkeypatch.setattr(similarity_cache, "_index", {})
+    monkeypatch.setattr(
+        similarity_cache, "get_similarity_settings", lambda condition_id: {"enabled": False, "threshold": 0.8}
+    )
+    similarity_cache.store("app2", "pro", 1, "AI가 일자리를 없앨까요?", "찬성 답변")
+    assert similarity_cache._index == {}
+    assert similarity_cache.lookup("app2", "pro", 1, "AI가 일자리를 없앨까요?") is None
@@ -0,0 +1,55 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import speculation
+import stream_mux
+
+
+def test_take_gives_up_after_expected_first_token(monkeypatch):
+    monkeypatch.setattr(speculation, "expected_first_token", lambda: 0.05)
+    spec = speculation.Speculation("test-condition", 1)
+    pending = Future()
+    spec.entries.append({
+        "prompt": "찬성 측 근거는?", "signature": speculation.minhash(speculation.normalize_prompt("찬성 측 근거는?")),
+        "cancel": threading.Event(), "futures": {"pro": pending, "con": Future()},
+    })
+    started = time.monotonic()
+    assert spec.take("pro", "찬성 측 근거는?") is None
+    assert spec.take("con", "찬성 측 근거는?") is None
+    # 두 페르소나가 같은 마감 시각을 나눠 씀
+    assert time.monotonic() - started < 0.5
+    assert spec.entries[0]["cancel"].is_set()
+
+
+def test_speculative_read_is_kept_out_of_budget_stats(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(stream_mux, "record_completion", lambda *args: recorded.append(args))
+
+    class Chunk:
+        def __init__(self, text):
+            self.choices = [type("Choice", (), {"delta": type("Delta", (), {"content": text})()})()]
+            self.usage = None
+
+    class Stream:
+        def __iter__(self):
+            return iter([Chunk("첫 문장입니다. "), Chunk("둘째 문장입니다. ")])
+
+        def close(self):
+            pass
+
+    parts = []
+    stream_mux.read_stream(Stream(), parts.append, "pro", [], sentence_budget=1, record=False)
+    assert parts and not recorded
+    stream_mux.read_stream(Stream(), parts.append, "pro", [], sentence_budget=1)
+    assert len(recorded) == 1
+
+
+def test_discard_stops_running_candidates():
+    spec = speculation.Speculation("test-condition", 1)
+    futures = {"pro": Future(), "con": Future()}
+    cancel = threading.Event()
+    spec.entries.append({"prompt": "p", "signature": (), "cancel": cancel, "futures": futures})
+    spec.discard()
+    assert cancel.is_set()
+    assert all(future.cancelled() for future in futures.values())
@@ -0,0 +1,198 @@
+import time
+
+import httpx
+import pytest
+
+pytest.importorskip("supabase")
+
+import write_behind
+from record_spool import RecordSpool, replay
+
+
+class RejectedRow(Exception):
+    """Stands in for a PostgREST APIError (a row the database refuses)"""
+
+    code = "22P02"
+
+
+class Unavailable(Exception):
+    """Stands in for an APIError built from a non-JSON 5xx response (code is the HTTP status)"""
+
+    code = 503
+
+
+class FakeQuery:
+    def __init__(self, client, table, rows):
+        self.client = client
+        self.table = table
+        self.rows = rows if isinstance(rows, list) else [rows]
+
+    def execute(self):
+        self.client.requests.append((self.table, len(self.rows)))
+        if self.client.down:
+            raise httpx.ConnectError("service unavailable")
+        if self.client.flaky and any(row.get("flaky") for row in self.rows):
+            raise Unavailable("bad gateway")
+        if not self.client.accept_bad and any(row.get("bad") for row in self.rows):
+            raise RejectedRow("invalid input syntax")
+        for row in self.rows:
+            self.client.saved.setdefault(row["record_id"], row)
+
+
+class FakeTable:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def upsert(self, rows, **kwargs):
+        return FakeQuery(self.client, self.name, rows)
+
+
+class FakeClient:
+    """Minimal Supabase client: upserts dedupe on record_id, rows with "bad" are rejected"""
+
+    def __init__(self, down=False):
+        self.down = down
+        self.accept_bad = False
+        self.flaky = True
+        self.saved = {}
+        self.requests = []
+
+    def table(self, name):
+        return FakeTable(self, name)
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return RecordSpool(str(tmp_path / "spool.sqlite3"), sync="NORMAL")
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_BACKOFF", 0.001)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_MAX_BACKOFF", 0.01)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_WINDOW_MS", 10)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_POLL", 0.02)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_MAX_ATTEMPTS", 3)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_enqueued_rows_are_shipped_once(spool):
+    client = FakeClient()
+    queue = write_behind.WriteBehindQueue(client, spool, workers=2)
+    ids = [queue.enqueue("LLM2", {"user_id": f"a{i:03d}"}) for i in range(5)]
+    wait_for(lambda: spool.depth() == 0)
+    assert set(client.saved) == set(ids)
+    assert queue.delivery_status() is None
+
+
+def test_delivery_status_reports_a_failing_shipper(spool):
+    client = FakeClient(down=True)
+    queue = write_behind.WriteBehindQueue(client, spool, workers=2)
+    queue.enqueue("LLM2", {"user_id": "a001"})
+    wait_for(lambda: queue.delivery_status() is not None)
+    status = queue.delivery_status()
+    assert status["depth"] == 1 and "service unavailable" in status["last_error"]
+    assert "1건" in write_behind.save_problem_message(status)
+
+    client.down = False
+    wait_for(lambda: queue.delivery_status() is None)
+    assert spool.depth() == 0
+
+
+def entries(*rows):
+    return [(seq, table, dict(row, record_id=f"r{seq}"), 0.0) for seq, (table, row) in enumerate(rows, 1)]
+
+
+def test_ship_batch_maps_errors_to_rows():
+    client = FakeClient()
+    counts = []
+    batch = entries(("LLM2", {}), ("LLM2", {"bad": True}), ("LLM2", {}), ("LLM1", {}))
+    with write_behind.ThreadPoolExecutor(max_workers=2) as executor:
+        errors = write_behind._ship_batch(executor, client, batch, lambda *c: counts.append(c))
+    assert [type(e).__name__ if e else None for e in errors] == [None, "RejectedRow", None, None]
+    # LLM2는 묶음 1번 + 한 행씩 3번, LLM1은 한 행뿐이라 처음부터 따로
+    assert counts == [(1, 4, 1)]
+    assert set(client.saved) == {"r1", "r3", "r4"}
+
+
+def test_ship_batch_keeps_transport_errors_for_the_whole_group():
+    client = FakeClient(down=True)
+    counts = []
+    with write_behind.ThreadPoolExecutor(max_workers=2) as executor:
+        errors = write_behind._ship_batch(executor, client, entries(("LLM2", {}), ("LLM2", {})), lambda *c: counts.append(c))
+    assert all(isinstance(e, httpx.ConnectError) for e in errors)
+    assert counts == [(1, 0, 0)]  # 연결 오류는 한 행씩 다시 보내지 않음
+
+
+def test_rows_after_a_failing_row_are_not_resent(spool):
+    client = FakeClient()
+    for i in range(4):
+        spool.append("LLM2", {"user_id": f"a{i:03d}", "flaky": i == 0})
+    with pytest.raises(Unavailable):
+        write_behind.ship_pending(spool, client)
+    assert spool.offset() == 0 and spool.depth() == 1
+    assert spool.quarantine_count() == 0  # 5xx는 격리하지 않고 나중에 다시 보냄
+
+    client.requests.clear()
+    client.flaky = False
+    assert write_behind.ship_pending(spool, client) == 1
+    assert client.requests == [("LLM2", 1)]
+    assert spool.offset() == 4 and spool.depth() == 0
+
+
+def test_rejected_row_is_quarantined_and_does_not_stall(spool):
+    client = FakeClient()
+    for i in range(5):
+        spool.append("LLM2", {"user_id": f"a{i:03d}", "bad": i == 1})
+    assert write_behind.ship_pending(spool, client) == 4
+    assert spool.offset() == 5 and spool.depth() == 0
+    assert spool.quarantine_count() == 1
+    sent = len(client.requests)
+    assert write_behind.ship_pending(spool, client) == 0
+    assert len(client.requests) == sent
+
+    # 원인을 고친 뒤 격리된 행만 다시 보냄
+    client.accept_bad = True
+    replay(spool, client, quarantined=True)
+    assert spool.quarantine_count() == 0
+    assert len(client.saved) == 5
+
+
+def test_outage_is_retried_not_quarantined(spool):
+    client = FakeClient(down=True)
+    spool.append("LLM2", {"user_id": "a001"})
+    with pytest.raises(httpx.ConnectError):
+        write_behind.ship_pending(spool, client)
+    assert spool.offset() == 0 and spool.quarantine_count() == 0
+
+
+def test_lease_handover(spool):
+    assert spool.acquire_lease("host:1", 0.05)
+    assert not spool.acquire_lease("host:2", 15)
+    time.sleep(0.06)
+    assert spool.acquire_lease("host:2", 15)
+    spool.release_lease("host:2")
+    assert spool.acquire_lease("host:1", 15)
+
+
+def test_replay_waits_for_the_app_shipper(spool):
+    client = FakeClient()
+    spool.append("LLM2", {"user_id": "a001"})
+    write_behind.ship_pending(spool, client)
+    assert spool.acquire_lease("host:1", 15)
+    with pytest.raises(SystemExit):
+        replay(spool, client, from_seq=1)
+    assert spool.offset() == 1  # 다른 프로세스가 배송 중일 때는 offset을 되돌리지 않음
+
+    spool.release_lease("host:1")
+    replay(spool, client, from_seq=1)
+    assert spool.offset() == 1 and len(client.saved) == 1
+    owner, lease_until = spool.lease()
+    assert owner.startswith("replay:") and lease_until == 0
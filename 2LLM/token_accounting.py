@@ -0,0 +1,105 @@
+import os
+import re
+import threading
+from functools import lru_cache
+
+from openai.types import CompletionUsage
+
+try:
+    import tiktoken
+except ImportError:  # 토크나이저가 없으면 글자 수 기반 추정으로 대신함
+    tiktoken = None
+
+# 로컬 BPE 토크나이저 인코딩 (gpt-4o 계열 = o200k_base)
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+
+_CJK_RE = re.compile(r"[ᄀ-ᇿ぀-ヿ㄰-㆏一-鿿가-힯]")
+_MESSAGE_OVERHEAD = 4  # 메시지마다 붙는 role 등 포맷 토큰
+_REQUEST_OVERHEAD = 2
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+_stats = {}  # condition id -> {"turns", "reported", "estimated", "prompt_tokens", "completion_tokens", "total_tokens"}
+_stats_lock = threading.Lock()
+
+
+def _get_encoding():
+    """tiktoken encoding, loaded once (None if tiktoken or its data file is unavailable)"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed and tiktoken is not None:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except Exception:
+                    _encoding_failed = True
+    return _encoding
+
+
+def heuristic_tokens(text):
+    """Rough token estimate: ~4 characters per token for Latin text, ~1 token per CJK/Hangul character"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@lru_cache(maxsize=4096)
+def estimate_tokens(text):
+    """Token count of a text with the local BPE tokenizer (heuristic if it is unavailable), memoized"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return heuristic_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message):
+    """Token count of one chat message (memoized on its content, so replayed history is counted once)"""
+    return estimate_tokens(message.get("content") or "") + _MESSAGE_OVERHEAD
+
+
+def estimate_prompt_tokens(messages):
+    """Prompt size of a chat request (content plus a few tokens of framing per message)"""
+    return sum(message_tokens(m) for m in messages) + _REQUEST_OVERHEAD
+
+
+def estimated_usage(messages, completion):
+    """Usage object for a stream that was closed before the provider sent its usage chunk"""
+    prompt_tokens = estimate_prompt_tokens(messages)
+    completion_tokens = estimate_tokens(completion)
+    return CompletionUsage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+def account_usage(condition_id, usage, messages, completion):
+    """Provider-reported usage if there is one, else a local estimate; adds it to the condition's totals"""
+    reported = usage is not None
+    if not reported:
+        usage = estimated_usage(messages, completion)
+    with _stats_lock:
+        stats = _stats.setdefault(condition_id, {
+            "turns": 0, "reported": 0, "estimated": 0,
+            "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+        })
+        stats["turns"] += 1
+        stats["reported" if reported else "estimated"] += 1
+        stats["prompt_tokens"] += usage.prompt_tokens
+        stats["completion_tokens"] += usage.completion_tokens
+        stats["total_tokens"] += usage.total_tokens
+    return usage
+
+
+def get_token_stats():
+    """Return token totals per condition (reported = from the provider, estimated = local tokenizer)"""
+    with _stats_lock:
+        stats = {cid: dict(s) for cid, s in _stats.items()}
+    for s in stats.values():
+        s["tokenizer"] = TOKENIZER_ENCODING if _get_encoding() is not None else "heuristic"
+    return stats
@@ -1,10 +1,15 @@
 import os
 import streamlit as st
-from openai import OpenAI
+from history_window import fit_history
+from llm_client import get_shared_client
+from prefix_cache import record_cached_tokens
+from stream_mux import SIDE_BY_SIDE, assistant_message, cancelled_messages, chat_job, stream_concurrently
 from dotenv import load_dotenv
 import json
 import glob
-import threading
+
+# prompts/debate/conditions.json의 조건 id
+CONDITION_ID = "tworow"
 
 # Load environment variables from .env file
 load_dotenv()
@@ -33,7 +38,7 @@ if "show_process" not in st.session_state:
     st.session_state.show_process = False
 
 def get_openai_client():
-    """Create and return an OpenAI client configured with environment variables"""
+    """Return the shared OpenAI client configured with environment variables"""
     token = os.getenv("GITHUB_TOKEN")
     endpoint = os.getenv("GITHUB_ENDPOINT", "https://models.github.ai/inference")
     
@@ -41,10 +46,8 @@ def get_openai_client():
         st.error("GitHub token not found in environment variables. Please check your .env file.")
         st.stop()
         
-    return OpenAI(
-        base_url=endpoint,
-        api_key=token,
-    )
+    # 프로세스 전체에서 공유하는 클라이언트 (keep-alive 연결 재사용)
+    return get_shared_client(endpoint, token)
 
 def generate_debate_responses(prompt):
     """Generate two separate responses - one pro, one con simultaneously"""
@@ -58,10 +61,11 @@ def generate_debate_responses(prompt):
             history.append(msg)
     
     # 찬성 메시지 생성
-    pro_messages = [{"role": "system", "content": st.session_state.system_message_pro}] + history + [{"role": "user", "content": prompt}]
+    # 토큰 예산을 넘는 오래된 턴은 빼거나 요약 (시스템 프롬프트와 최근 턴은 그대로 유지)
+    pro_messages, pro_window = fit_history(st.session_state.system_message_pro, history, prompt)
     
     # 반대 메시지 생성
-    con_messages = [{"role": "system", "content": st.session_state.system_message_con}] + history + [{"role": "user", "content": prompt}]
+    con_messages, con_window = fit_history(st.session_state.system_message_con, history, prompt)
     
     try:
         # 2열 레이아웃 생성 (더 넓은 간격으로 조정)
@@ -77,96 +81,32 @@ def generate_debate_responses(prompt):
             st.markdown("<h4 style='text-align: center;'>반대 의견</h4>", unsafe_allow_html=True)
             con_placeholder = st.empty()
         
-        # 결과를 저장할 변수
-        full_pro_response = ""
-        full_con_response = ""
-        usage_pro = None
-        usage_con = None
-        
-        # 스레드 완료 플래그
-        pro_completed = threading.Event()
-        con_completed = threading.Event()
-        
-        # 찬성 응답 생성 함수
-        def generate_pro_response():
-            nonlocal full_pro_response, usage_pro
-            
-            pro_response = client.chat.completions.create(
-                messages=pro_messages,
-                model=model_name,
-                stream=True,
-                stream_options={'include_usage': True}
-            )
-            
-            # 찬성 응답 스트리밍
-            for chunk in pro_response:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content_chunk = chunk.choices[0].delta.content
-                    full_pro_response += content_chunk
-                    pro_placeholder.markdown(
-                        f"<div style='background-color: #90EE90; padding: 10px; border-radius: 5px;'>{full_pro_response}▌</div>",
-                        unsafe_allow_html=True
-                    )
-                        
-                if chunk.usage:
-                    usage_pro = chunk.usage
-            
-            # 최종 찬성 응답 업데이트 (커서 제거)
-            pro_placeholder.markdown(
-                f"<div style='background-color: #90EE90; padding: 10px; border-radius: 5px;'>{full_pro_response}</div>",
-                unsafe_allow_html=True
-            )
-            
-            # 완료 표시
-            pro_completed.set()
-        
-        # 반대 응답 생성 함수
-        def generate_con_response():
-            nonlocal full_con_response, usage_con
-            
-            con_response = client.chat.completions.create(
-                messages=con_messages,
-                model=model_name,
-                stream=True,
-                stream_options={'include_usage': True}
-            )
-            
-            # 반대 응답 스트리밍
-            for chunk in con_response:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content_chunk = chunk.choices[0].delta.content
-                    full_con_response += content_chunk
-                    con_placeholder.markdown(
-                        f"<div style='background-color: #FFB6C1; padding: 10px; border-radius: 5px;'>{full_con_response}▌</div>",
-                        unsafe_allow_html=True
-                    )
-                        
-                if chunk.usage:
-                    usage_con = chunk.usage
-            
-            # 최종 반대 응답 업데이트 (커서 제거)
-            con_placeholder.markdown(
-                f"<div style='background-color: #FFB6C1; padding: 10px; border-radius: 5px;'>{full_con_response}</div>",
-                unsafe_allow_html=True
-            )
-            
-            # 완료 표시
-            con_completed.set()
-        
-        # 두 스레드 생성 및 시작
-        pro_thread = threading.Thread(target=generate_pro_response)
-        con_thread = threading.Thread(target=generate_con_response)
-        
-        pro_thread.start()
-        con_thread.start()
+        # 워커 스레드는 (stream_id, delta)만 큐에 넣고, 두 칼럼은 이 스크립트 스레드에서 렌더링
+        # (워커에는 ScriptRunContext가 없으므로 placeholder를 직접 건드리면 안 됨)
+        results = stream_concurrently([
+            chat_job(
+                "pro", pro_placeholder,
+                "<div style='background-color: #90EE90; padding: 10px; border-radius: 5px;'>{}</div>",
+                client, messages=pro_messages, model=model_name, fallback_condition=CONDITION_ID,
+                generation_condition=CONDITION_ID
+            ),
+            chat_job(
+                "con", con_placeholder,
+                "<div style='background-color: #FFB6C1; padding: 10px; border-radius: 5px;'>{}</div>",
+                client, messages=con_messages, model=model_name, fallback_condition=CONDITION_ID,
+                generation_condition=CONDITION_ID
+            ),
+        ], display=SIDE_BY_SIDE, on_cancel=lambda partial: st.session_state.messages.extend(cancelled_messages(partial)),
+           on_queue=lambda position: pro_placeholder.markdown(f"대기 중... (대기 순번 {position})" if position else ""))
         
-        # 두 스레드가 모두 완료될 때까지 대기
-        pro_completed.wait()
-        con_completed.wait()
+        full_pro_response = results["pro"]["content"]
+        usage_pro = results["pro"]["usage"]
+        full_con_response = results["con"]["content"]
+        usage_con = results["con"]["usage"]
         
         # 응답을 세션 상태에 추가
-        st.session_state.messages.append({"role": "assistant", "content": full_pro_response, "type": "pro"})
-        st.session_state.messages.append({"role": "assistant", "content": full_con_response, "type": "con"})
+        st.session_state.messages.append(assistant_message("pro", results["pro"]))
+        st.session_state.messages.append(assistant_message("con", results["con"]))
         
         # 사용량 통계 저장
         if usage_pro and usage_con:
@@ -177,7 +117,11 @@ def generate_debate_responses(prompt):
             st.session_state.usage_stats.append({
                 "prompt_tokens": usage_pro_dict.get("prompt_tokens", 0) + usage_con_dict.get("prompt_tokens", 0),
                 "completion_tokens": usage_pro_dict.get("completion_tokens", 0) + usage_con_dict.get("completion_tokens", 0),
-                "total_tokens": usage_pro_dict.get("total_tokens", 0) + usage_con_dict.get("total_tokens", 0)
+                "total_tokens": usage_pro_dict.get("total_tokens", 0) + usage_con_dict.get("total_tokens", 0),
+                "history_tokens_saved": pro_window["tokens_saved"] + con_window["tokens_saved"],
+                "endpoints": {"pro": results["pro"]["endpoint"], "con": results["con"]["endpoint"]},
+                # 프롬프트 접두사 캐시에서 처리된 토큰 수 (프로바이더가 알려준 경우)
+                "cached_tokens": record_cached_tokens(CONDITION_ID, usage_pro, usage_con)
             })
         
         # 프로세스 표시 활성화된 경우
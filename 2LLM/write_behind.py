@@ -0,0 +1,299 @@
+"""Write-behind shipping of the session rows saved to Supabase.
+
+enqueue() appends the row to the local record spool (record_spool.py) and returns; a shipper
+thread sends spooled rows to Supabase oldest first, with retries, and marks every confirmed row
+in the spool, which moves its offset past the confirmed prefix. Each row carries a client-generated record_id and is written
+with an upsert that ignores duplicates, so a retry or a replay never inserts a row twice.
+Rows that arrive together (e.g. a whole class submitting at once) are coalesced per table into
+one bulk upsert, falling back to single-row upserts to find the row a failed bulk call choked on.
+Every app process runs a shipper but only the one holding the spool's lease ships, so rows
+left behind by a process that died are picked up by the next one. A row Supabase still rejects
+after WRITE_BEHIND_MAX_ATTEMPTS is quarantined in the spool so it cannot hold back the rows after it.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from record_spool import get_spool
+from supabase_client import get_supabase
+
+# 한 묶음 안에서 동시에 Supabase에 쓰는 요청 수
+WRITE_BEHIND_WORKERS = int(os.getenv("WRITE_BEHIND_WORKERS", "4"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "50"))  # 한 번에 읽는 행 수 (이만큼 모이면 기다리지 않고 보냄)
+WRITE_BEHIND_WINDOW_MS = float(os.getenv("WRITE_BEHIND_WINDOW_MS", "200"))  # 첫 행이 들어온 뒤 더 모으는 시간
+WRITE_BEHIND_BULK = os.getenv("WRITE_BEHIND_BULK", "1") == "1"  # 0이면 행마다 따로 보냄
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "6"))  # 한 묶음에서 실패한 행을 다시 보내는 횟수
+WRITE_BEHIND_BACKOFF = float(os.getenv("WRITE_BEHIND_BACKOFF", "0.5"))  # 첫 재시도 대기(초), 매번 두 배
+WRITE_BEHIND_MAX_BACKOFF = float(os.getenv("WRITE_BEHIND_MAX_BACKOFF", "30"))
+WRITE_BEHIND_LEASE = float(os.getenv("WRITE_BEHIND_LEASE", "15"))  # 배송 중인 프로세스가 죽으면 이 시간 뒤 다른 프로세스가 넘겨받음
+WRITE_BEHIND_POLL = float(os.getenv("WRITE_BEHIND_POLL", "1.0"))  # 다른 프로세스가 스풀에 넣은 행을 확인하는 간격(초)
+
+# 행 자체가 아니라 연결/서버 상태 때문에 실패한 PostgREST 오류 코드 (격리하지 않고 나중에 다시 보냄)
+# 08 연결, 40 트랜잭션 롤백, 53 자원 부족, 57 작업자 개입(문 시간 초과 등), 58 시스템 오류, PGRST0xx DB 연결
+_TRANSIENT_CODES = ("08", "40", "53", "57", "58", "PGRST0")
+
+logger = logging.getLogger(__name__)
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def _insert(client, table, row):
+    # record_id가 이미 있으면 아무것도 하지 않음 (재시도/재생이 중복 행을 만들지 않음)
+    client.table(table).upsert(row, on_conflict="record_id", ignore_duplicates=True).execute()
+
+
+def _insert_many(client, table, rows):
+    # 빠진 열은 null이 아니라 열의 기본값으로 (앱마다 보내는 열이 조금씩 다름)
+    client.table(table).upsert(rows, on_conflict="record_id", ignore_duplicates=True, default_to_null=False).execute()
+
+
+def _ship_batch(executor, client, entries, on_requests=None):
+    """Write spooled entries with one bulk upsert per table; returns each entry's error (None when confirmed)"""
+    groups = {}
+    for entry in entries:
+        groups.setdefault(entry[1], []).append(entry)
+    errors = {}
+    singles = []
+    bulk = {}
+    for table, group in groups.items():
+        if WRITE_BEHIND_BULK and len(group) > 1:
+            bulk[table] = executor.submit(_insert_many, client, table, [row for _, _, row, _ in group])
+        else:
+            singles.extend(group)
+    fallbacks = 0
+    for table, future in bulk.items():
+        error = future.exception()
+        if error is None or isinstance(error, httpx.TransportError):
+            # 연결 문제면 한 행씩 보내도 똑같이 실패하므로 묶음 전체를 나중에 다시 보냄
+            errors.update({entry[0]: error for entry in groups[table]})
+        else:
+            # 어떤 행이 거부됐는지 모르므로 한 행씩 다시 보내서 나머지는 저장함
+            singles.extend(groups[table])
+            fallbacks += 1
+    futures = [(entry, executor.submit(_insert, client, entry[1], entry[2])) for entry in singles]
+    for entry, future in futures:
+        errors[entry[0]] = future.exception()
+    if on_requests is not None:
+        on_requests(len(bulk), len(singles), fallbacks)
+    return [errors[entry[0]] for entry in entries]
+
+
+def _is_rejection(error):
+    """Whether Supabase refused the row itself (bad value, missing column...), so resending it cannot help"""
+    code = getattr(error, "code", None)
+    # HTTP 상태만 있는 오류(JSON이 아닌 5xx 응답)나 코드 없는 오류는 일시적인 문제로 봄
+    return isinstance(code, str) and not code.startswith(_TRANSIENT_CODES)
+
+
+def ship_pending(spool, client, executor=None, on_result=None, keep_lease=None, on_requests=None):
+    """Send the spooled rows after the offset to Supabase, oldest first; returns how many were confirmed.
+
+    Rows of a batch are written with one bulk upsert per table and only the failed ones are retried,
+    with backoff, up to WRITE_BEHIND_MAX_ATTEMPTS times. Confirmed rows are marked in the spool right
+    away, so rows after one that is still failing are not sent again. Rows that are still rejected
+    then are quarantined in the spool and the offset moves past them too.
+    Raises the last error when other failures (connection, server) remain, and stops when keep_lease()
+    returns False.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=WRITE_BEHIND_WORKERS, thread_name_prefix="write-behind")
+    shipped = 0
+    try:
+        while keep_lease is None or keep_lease():
+            remaining = spool.pending(WRITE_BEHIND_BATCH)
+            if not remaining:
+                break
+            for attempt in range(WRITE_BEHIND_MAX_ATTEMPTS):
+                if attempt:
+                    time.sleep(WRITE_BEHIND_BACKOFF * 2 ** (attempt - 1))
+                    if keep_lease is not None and not keep_lease():
+                        return shipped
+                failed, confirmed = [], []
+                for entry, row_error in zip(remaining, _ship_batch(executor, client, remaining, on_requests)):
+                    if on_result is not None:
+                        on_result(entry[3], row_error)
+                    if row_error is None:
+                        confirmed.append(entry[0])
+                    else:
+                        failed.append((entry, row_error))
+                # 실패한 행 뒤에서 성공한 행도 바로 기록 (다음 주기에 묶음 전체를 다시 보내지 않도록)
+                spool.confirm(confirmed)
+                shipped += len(confirmed)
+                remaining = [entry for entry, _ in failed]
+                if not remaining:
+                    break
+            if remaining:
+                # 매번 거부된 행은 격리하고 offset을 넘김 (한 행 때문에 뒤의 행 배송이 영원히 멈추지 않도록)
+                rejected = [(entry, error) for entry, error in failed if _is_rejection(error)]
+                if rejected:
+                    spool.quarantine(rejected, WRITE_BEHIND_MAX_ATTEMPTS)
+                    spool.confirm([entry[0] for entry, _ in rejected])
+                    logger.warning(
+                        "quarantined %d rejected rows (seq %s): %s", len(rejected),
+                        ", ".join(str(entry[0]) for entry, _ in rejected), rejected[-1][1],
+                    )
+                retry = [error for _, error in failed if not _is_rejection(error)]
+                if retry:
+                    raise retry[-1]
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return shipped
+
+
+def ship_quarantined(spool, client, executor=None, keep_lease=None):
+    """Send the quarantined rows again (once the cause is fixed); returns (confirmed, still rejected)"""
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=WRITE_BEHIND_WORKERS, thread_name_prefix="write-behind")
+    shipped = failing = 0
+    after = 0
+    try:
+        while keep_lease is None or keep_lease():
+            entries = spool.quarantined(WRITE_BEHIND_BATCH, after)
+            if not entries:
+                break
+            after = entries[-1][0]
+            errors = _ship_batch(executor, client, entries)
+            spool.release([entry[0] for entry, error in zip(entries, errors) if error is None])
+            failures = [(entry, error) for entry, error in zip(entries, errors) if error is not None]
+            spool.quarantine(failures, 1)
+            shipped += len(entries) - len(failures)
+            failing += len(failures)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return shipped, failing
+
+
+class WriteBehindQueue:
+    """Spool-backed queue drained into Supabase by one shipper thread with a bounded pool of writers"""
+
+    def __init__(self, client, spool=None, workers=WRITE_BEHIND_WORKERS):
+        self.client = client
+        self.spool = spool or get_spool()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="write-behind")
+        self._wake = threading.Event()
+        self._latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0, "flushed": 0, "retries": 0, "failed": 0, "last_error": None, "failing_since": None,
+            "bulk_requests": 0, "row_requests": 0, "bulk_fallbacks": 0,
+        }
+        threading.Thread(target=self._run, daemon=True, name="write-behind-shipper").start()
+
+    def enqueue(self, table, row):
+        """Spool a row for insertion and return its record_id without waiting for Supabase"""
+        record_id = self.spool.append(table, row)
+        with self._lock:
+            self.stats["enqueued"] += 1
+        self._wake.set()
+        return record_id
+
+    def _on_result(self, created_at, error):
+        with self._lock:
+            if error is None:
+                self.stats["flushed"] += 1
+                self._latencies.append(time.time() - created_at)
+            else:
+                # 버리는 행은 없으므로 실패한 시도는 모두 재시도가 됨
+                self.stats["retries"] += 1
+                self.stats["last_error"] = f"{type(error).__name__}: {error}"
+                if self.stats["failing_since"] is None:
+                    self.stats["failing_since"] = time.time()
+
+    def _on_requests(self, bulk, rows, fallbacks):
+        with self._lock:
+            self.stats["bulk_requests"] += bulk
+            self.stats["row_requests"] += rows
+            self.stats["bulk_fallbacks"] += fallbacks
+
+    def _collect(self):
+        """Wait up to WRITE_BEHIND_WINDOW_MS for more rows once some are pending, or until a full batch is there"""
+        deadline = time.monotonic() + WRITE_BEHIND_WINDOW_MS / 1000
+        while 0 < self.spool.depth() < WRITE_BEHIND_BATCH and time.monotonic() < deadline:
+            self._wake.wait(deadline - time.monotonic())
+            self._wake.clear()
+
+    def _keep_lease(self):
+        return self.spool.acquire_lease(self.owner, WRITE_BEHIND_LEASE)
+
+    def _run(self):
+        backoff = 0.0
+        while True:
+            self._wake.wait(WRITE_BEHIND_POLL)
+            self._wake.clear()
+            self._collect()
+            try:
+                ship_pending(self.spool, self.client, self._executor, self._on_result, self._keep_lease, self._on_requests)
+                backoff = 0.0
+                with self._lock:
+                    self.stats["failing_since"] = None
+            except Exception:
+                # 묶음이 포기되어도 행은 스풀에 그대로 남아 있으므로 점점 길게 기다렸다가 다시 보냄
+                backoff = min(WRITE_BEHIND_MAX_BACKOFF, backoff * 2 or WRITE_BEHIND_BACKOFF)
+                with self._lock:
+                    self.stats["failed"] += 1
+                time.sleep(backoff)
+            self.spool.save_metrics(self.owner, self.get_stats())
+
+    def delivery_status(self):
+        """{"depth", "last_error"} while spooled rows are failing to reach Supabase, None otherwise"""
+        depth = self.spool.depth()
+        if not depth:
+            return None
+        # 배송은 리스를 가진 프로세스만 하므로 그 프로세스의 지표로 판단
+        summary = self.spool.summary()
+        if summary["owner"] == self.owner:
+            stats = self.get_stats()
+        else:
+            stats = next((m for m in summary["metrics"] if m["owner"] == summary["owner"]), {})
+        if not stats.get("failing_since"):
+            return None
+        return {"depth": depth, "last_error": stats.get("last_error")}
+
+    def get_stats(self):
+        with self._lock:
+            ordered = sorted(self._latencies)
+            stats = dict(self.stats)
+        stats["depth"] = self.spool.depth()
+        stats["quarantined"] = self.spool.quarantine_count()
+        requests = stats["bulk_requests"] + stats["row_requests"]
+        stats["rows_per_request"] = round(stats["flushed"] / requests, 2) if requests else None
+        stats["flush_p50_ms"] = round(ordered[len(ordered) // 2] * 1000) if ordered else None
+        stats["flush_p95_ms"] = round(ordered[max(0, int(len(ordered) * 0.95) - 1)] * 1000) if ordered else None
+        return stats
+
+
+def get_write_behind(url, key):
+    """Return the process-wide write-behind queue for this Supabase project, starting it on first use"""
+    with _queues_lock:
+        writer = _queues.get((url, key))
+        if writer is None:
+            writer = WriteBehindQueue(get_supabase(url, key))
+            _queues[(url, key)] = writer
+        return writer
+
+
+def save_problem_message(status):
+    """Message for the completion page from WriteBehindQueue.delivery_status() (None when rows are being delivered)"""
+    if status is None:
+        return None
+    return (f"응답은 이 서버에 저장되었지만 데이터베이스 기록이 지연되고 있습니다 "
+            f"(대기 {status['depth']}건, 마지막 오류: {status['last_error']}).")
+
+
+def get_write_behind_stats():
+    """Return spool depth, flush latency and failures of every write-behind queue in this process"""
+    with _queues_lock:
+        writers = list(_queues.values())
+    return [writer.get_stats() for writer in writers]